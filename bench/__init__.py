@@ -0,0 +1,3 @@
+"""
+Benchmarks for fst. Not shipped with the package.
+"""
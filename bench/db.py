@@ -0,0 +1,163 @@
+"""
+Benchmarks the relationship queries of fst.rels on a large database.
+
+Usage: python -m bench.db [--instances N] [--templates N] [--repeat N]
+                          [--output results.json] [--baseline baseline.json]
+
+A temporary database is filled with --templates templates that share
+--instances instances, a tenth of them disconnected. Every lookup is timed
+with fst.rels.select() and with the single OR-filtered query it replaced,
+and the query plans of both are printed. "pull" cases also build the
+fst.rels.Relationships of the lookup. Results use the format of bench.run.
+"""
+import argparse
+import collections
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import fst.db
+import fst.rels
+from bench.run import compare
+
+LEGACY = """
+    SELECT
+        T.id AS t_id,
+        T.name AS t_name,
+        T.path AS t_path,
+        T.checksum AS t_checksum,
+        T.active AS t_active,
+        I.id AS i_id,
+        I.path AS i_path,
+        I.template_id AS i_template_id,
+        I.active AS i_active
+    FROM templates AS T
+    LEFT JOIN instances AS I ON T.id=I.template_id
+    WHERE
+        T.active=1 AND
+        (I.active=1 OR I.active IS NULL) AND
+        (T.path = ?  OR T.name = ?  OR I.path = ? OR true=?)
+"""
+
+
+def legacy_select(cursor, template=None, instance=None):
+    pull_all = not template and not instance
+    return cursor.execute(
+        LEGACY, [template, template, instance, pull_all]
+    ).fetchall()
+
+
+def populate(conn, templates, instances):
+    with conn:
+        conn.executemany(
+            "INSERT INTO templates (id, name, path, checksum) "
+            "VALUES (?, ?, ?, '')",
+            (
+                (t, "template{}".format(t), "/templates/{}".format(t))
+                for t in range(1, templates + 1)
+            )
+        )
+        conn.executemany(
+            "INSERT INTO instances (path, template_id, active) "
+            "VALUES (?, ?, ?)",
+            (
+                ("/instances/{}".format(i), i % templates + 1,
+                 int(i % 10 != 0))
+                for i in range(instances)
+            )
+        )
+        conn.execute("ANALYZE")
+
+
+def lookups(templates, instances):
+    middle = max(1, templates // 2)
+    return collections.OrderedDict([
+        ("template name", {"template": "template{}".format(middle)}),
+        ("template path", {"template": "/templates/{}".format(middle)}),
+        ("instance path", {"instance": "/instances/{}".format(instances - 1)}),
+        ("all", {}),
+    ])
+
+
+def best_of(repeat, func, *args, **kwargs):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def print_plan(cursor, sql, params):
+    for row in cursor.execute("EXPLAIN QUERY PLAN " + sql, params):
+        print("        " + row["detail"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--instances", type=int, default=100000)
+    parser.add_argument("--templates", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="Write results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare with this results file.")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Slowdown ratio above which a case regressed.")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="fst-bench-db-")
+    try:
+        conn = fst.db.connect(os.path.join(workdir, "fst.db"))
+        conn.set_trace_callback(None)
+        populate(conn, args.templates, args.instances)
+        cursor = conn.cursor()
+
+        results = collections.OrderedDict()
+        for name, kwargs in lookups(args.templates, args.instances).items():
+            for impl, func in (("legacy", legacy_select),
+                               ("rels", fst.rels.select),
+                               ("pull", fst.rels.pull)):
+                key = "{}/{}".format(impl, name)
+                result = func(cursor, **kwargs)
+                rows = (len(result.instances) or len(result.templates)
+                        if impl == "pull" else len(result))
+                wall = best_of(args.repeat, func, cursor, **kwargs)
+                results[key] = {"wall": wall, "rows": rows}
+                print("{:<45} {:.4f}s rows={}".format(key, wall, rows),
+                      flush=True)
+
+        print("\nQuery plans:")
+        template = "template{}".format(max(1, args.templates // 2))
+        print("    legacy by template name")
+        print_plan(cursor, LEGACY, [template, template, None, False])
+        print("    rels by template name")
+        print_plan(cursor, fst.rels.BY_TEMPLATE_NAME, [template])
+        print("    rels by instance path")
+        print_plan(cursor, fst.rels.BY_INSTANCE_PATH, ["/instances/1"])
+        conn.close()
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "meta": {
+                    "instances": args.instances,
+                    "templates": args.templates,
+                    "repeat": args.repeat,
+                },
+                "results": results,
+            }, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+"""
+Benchmarks the fst.dirdiff and fst.conform engine on synthetic trees.
+
+Usage: python -m bench.run [--scale N] [--repeat N] [--shape NAME]...
+                           [--output results.json] [--baseline baseline.json]
+
+Every function is timed on every shape from bench.trees. Wall time is the best
+of --repeat runs and peak memory is what tracemalloc reports for one run. With
+--syscalls and strace on PATH every case is also run once under strace -c.
+Results are written as JSON and compared with a baseline file of the same
+format if one is given.
+"""
+import argparse
+import collections
+import datetime
+import json
+import os
+import os.path
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import fst.conform
+import fst.dirdiff
+from bench import trees
+from bench.syscalls import count_syscalls
+
+# name -> (setup, run). setup(scenario, workdir) prepares the arguments of run
+# outside of the timed section.
+Benchmark = collections.namedtuple("Benchmark", ["setup", "run"])
+
+
+def _copy_instances(scenario, workdir):
+    copies = []
+    for i, instance in enumerate(scenario.instances):
+        copy = os.path.join(workdir, "copy{}".format(i))
+        shutil.copytree(instance, copy)
+        copies.append(copy)
+    return scenario.template, copies
+
+
+def _each_instance(func):
+    def run(template, instances):
+        for instance in instances:
+            func(template, instance)
+    return run
+
+
+def _shared_tree(setup):
+    # the template is walked once outside of the timed section like the CLI
+    # does once per command
+    def shared(scenario, workdir):
+        template, instances = setup(scenario, workdir)
+        return fst.dirdiff.DirTree.from_disk(template), instances
+    return shared
+
+
+BENCHMARKS = collections.OrderedDict([
+    ("flattened_subdirs", Benchmark(
+        lambda s, w: (s.template,),
+        fst.dirdiff.flattened_subdirs,
+    )),
+    ("difference", Benchmark(
+        lambda s, w: (s.template, s.instances),
+        _each_instance(fst.dirdiff.difference),
+    )),
+    ("is_subset", Benchmark(
+        lambda s, w: (s.template, s.instances),
+        _each_instance(fst.dirdiff.is_subset),
+    )),
+    ("missing_from", Benchmark(
+        lambda s, w: (s.template, s.instances),
+        _each_instance(lambda t, i: fst.dirdiff.missing_from(i, t)),
+    )),
+    ("missing_from_shared_tree", Benchmark(
+        _shared_tree(lambda s, w: (s.template, s.instances)),
+        _each_instance(lambda t, i: fst.dirdiff.missing_from(i, t)),
+    )),
+    ("conform_dir_to_template", Benchmark(
+        _copy_instances,
+        _each_instance(lambda t, i: fst.conform.conform_dir_to_template(i, t)),
+    )),
+    ("conform_shared_tree", Benchmark(
+        _shared_tree(_copy_instances),
+        _each_instance(lambda t, i: fst.conform.conform_dir_to_template(i, t)),
+    )),
+    ("copy_dir_tree", Benchmark(
+        lambda s, w: (s.template, w),
+        lambda t, w: fst.conform.copy_dir_tree(t, w, "copy"),
+    )),
+])
+
+
+def run_case(scenario, benchmark, repeat):
+    """ Returns the best wall time and the tracemalloc peak in KiB."""
+    best = None
+    peak = 0
+    for i in range(repeat):
+        workdir = tempfile.mkdtemp(prefix="fst-bench-work-")
+        try:
+            args = benchmark.setup(scenario, workdir)
+            trace_memory = i == 0
+            if trace_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            benchmark.run(*args)
+            elapsed = time.perf_counter() - start
+            if trace_memory:
+                peak = tracemalloc.get_traced_memory()[1] // 1024
+                tracemalloc.stop()
+            best = elapsed if best is None else min(best, elapsed)
+        finally:
+            shutil.rmtree(workdir)
+    return best, peak
+
+
+def run_once(shape, benchmark_name, root):
+    """ Runs one case once on an existing scenario - used under strace.
+
+    The "none" benchmark only loads the scenario so that the syscalls of
+    starting up can be subtracted.
+    """
+    scenario = _load_scenario(root)
+    if benchmark_name == "none":
+        return
+    benchmark = BENCHMARKS[benchmark_name]
+    workdir = tempfile.mkdtemp(prefix="fst-bench-work-")
+    try:
+        benchmark.run(*benchmark.setup(scenario, workdir))
+    finally:
+        shutil.rmtree(workdir)
+
+
+def _load_scenario(root):
+    with open(os.path.join(root, "scenario.json")) as f:
+        return trees.Scenario(**json.load(f))
+
+
+def _save_scenario(root, scenario):
+    with open(os.path.join(root, "scenario.json"), "w") as f:
+        json.dump(scenario._asdict(), f)
+
+
+def compare(results, baseline, threshold):
+    """ Prints a comparison table and returns the names of the regressions."""
+    regressions = []
+    row = "{:<45} {:>10} {:>10} {:>8}  {}"
+    print(row.format("CASE", "BASELINE", "CURRENT", "RATIO", ""))
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        ratio = result["wall"] / before["wall"] if before["wall"] else 1.0
+        regressed = ratio > 1 + threshold
+        if regressed:
+            regressions.append(name)
+        print(row.format(
+            name,
+            "{:.4f}s".format(before["wall"]),
+            "{:.4f}s".format(result["wall"]),
+            "{:.2f}".format(ratio),
+            "REGRESSION" if regressed else ""
+        ))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--shape", action="append", choices=list(trees.SHAPES))
+    parser.add_argument("--benchmark", action="append",
+                        choices=list(BENCHMARKS))
+    parser.add_argument("--syscalls", action="store_true",
+                        help="Count syscalls of every case with strace.")
+    parser.add_argument("--output", help="Write results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare with this results file.")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Slowdown ratio above which a case regressed.")
+    parser.add_argument("--once", nargs=3, metavar=("SHAPE", "BENCH", "ROOT"),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.once:
+        run_once(*args.once)
+        return
+
+    count = args.syscalls and shutil.which("strace") is not None
+    if args.syscalls and not count:
+        print("strace not found - syscalls are not counted.", file=sys.stderr)
+
+    results = collections.OrderedDict()
+    for shape in args.shape or trees.SHAPES:
+        root = tempfile.mkdtemp(prefix="fst-bench-")
+        try:
+            scenario = trees.SHAPES[shape](root, args.scale, args.seed)
+            _save_scenario(root, scenario)
+            if count:
+                startup = sum(count_syscalls(
+                    ["-m", "bench.run", "--once", shape, "none", root]
+                ).values())
+            for name in args.benchmark or BENCHMARKS:
+                wall, peak = run_case(scenario, BENCHMARKS[name], args.repeat)
+                result = {"wall": wall, "peak_kib": peak, "syscalls": None}
+                if count:
+                    result["syscalls"] = sum(count_syscalls(
+                        ["-m", "bench.run", "--once", shape, name, root]
+                    ).values()) - startup
+                key = "{}/{}".format(shape, name)
+                results[key] = result
+                print("{:<45} {:.4f}s {:>8}KiB syscalls={}".format(
+                    key, wall, peak, result["syscalls"]
+                ), flush=True)
+        finally:
+            shutil.rmtree(root)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "meta": {
+                    "date": datetime.datetime.now().isoformat(),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "scale": args.scale,
+                    "repeat": args.repeat,
+                    "seed": args.seed,
+                },
+                "results": results,
+            }, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Benchmarks the startup time of the fst command line app.
+
+Usage: python -m bench.startup [--repeat N] [--template NAME]
+                               [--output results.json]
+                               [--baseline baseline.json]
+
+"import fst.cli" is the cumulative import time python -X importtime reports
+for the module. The other cases are the wall time of running a command in a
+fresh interpreter with "python -c pass" as the floor. All of them are the best
+of --repeat runs. --template also times printing the path of a template, which
+needs an existing database. Results use the format of bench.run so the two
+share baselines and the comparison.
+"""
+import argparse
+import collections
+import json
+import re
+import subprocess
+import sys
+import time
+
+from bench.run import compare
+
+_IMPORT_TIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def import_times(module):
+    """ Returns (cumulative seconds, name) of every module imported with
+    :module: in a fresh interpreter."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True
+    )
+    times = []
+    for line in proc.stderr.splitlines():
+        match = _IMPORT_TIME.match(line)
+        if match:
+            times.append((int(match.group(2)) / 1e6, match.group(4)))
+    return times
+
+
+def time_command(argv):
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable] + argv,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True
+    )
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--template",
+                        help="Also time printing the path of this template.")
+    parser.add_argument("--top", type=int, default=10,
+                        help="Show this many of the slowest imports.")
+    parser.add_argument("--output", help="Write results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare with this results file.")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Slowdown ratio above which a case regressed.")
+    args = parser.parse_args()
+
+    commands = collections.OrderedDict([
+        ("python -c pass", ["-c", "pass"]),
+        ("fst --help", ["-m", "fst.cli", "--help"]),
+    ])
+    if args.template:
+        commands["fst -t TEMPLATE -p"] = [
+            "-m", "fst.cli", "-t", args.template, "-p"
+        ]
+
+    results = collections.OrderedDict()
+    best_times = None
+    for _ in range(args.repeat):
+        times = import_times("fst.cli")
+        if best_times is None or times[-1][0] < best_times[-1][0]:
+            best_times = times
+    results["import fst.cli"] = {"wall": best_times[-1][0]}
+    for name, argv in commands.items():
+        results[name] = {
+            "wall": min(time_command(argv) for _ in range(args.repeat))
+        }
+
+    for name, result in results.items():
+        print("{:<45} {:.4f}s".format(name, result["wall"]))
+    print("\nSlowest imports of fst.cli (cumulative):")
+    for seconds, module in sorted(best_times, reverse=True)[:args.top]:
+        print("    {:<41} {:.4f}s".format(module, seconds))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": {"repeat": args.repeat}, "results": results},
+                      f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
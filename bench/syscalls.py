@@ -0,0 +1,128 @@
+"""
+Counts the system calls made by the fst.dirdiff walker and the fst.conform
+materializer against the implementations they replaced.
+
+Usage: python -m bench.syscalls [--width N] [--depth N] [--files N]
+
+Syscall counts require strace to be on PATH, otherwise only wall time is shown.
+"""
+import argparse
+import os
+import os.path
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import fst.conform
+import fst.dirdiff
+from bench.trees import make_tree
+
+
+def legacy_flattened_subdirs(directory):
+    """ The listdir + isdir walk fst.dirdiff used before the scandir walker."""
+    def implementation(dir_path):
+        sd = []
+        for name in sorted(os.listdir(dir_path)):
+            path = os.path.join(dir_path, name)
+            if os.path.isdir(path):
+                sd.append(path)
+                sd.extend(implementation(path))
+        return sd
+
+    return implementation(directory)
+
+
+def legacy_materialize(root, rel_paths):
+    """ The mkdir by absolute path fst.conform used before materialize()."""
+    paths = [os.path.join(root, p) for p in sorted(rel_paths)]
+    for path in paths:
+        os.mkdir(path)
+    return paths
+
+
+def _copy_with(materialize):
+    def copy(root):
+        destination = tempfile.mkdtemp(prefix="fst-bench-copy-")
+        try:
+            return materialize(destination, fst.dirdiff.flattened_subdirs(root))
+        finally:
+            shutil.rmtree(destination)
+    return copy
+
+
+IMPLEMENTATIONS = {
+    "walk-legacy": legacy_flattened_subdirs,
+    "walk-scandir": fst.dirdiff.flattened_subdirs,
+    "mkdir-legacy": _copy_with(legacy_materialize),
+    "mkdir-materialize": _copy_with(fst.conform.materialize),
+}
+
+
+def run_one(name, root):
+    start = time.perf_counter()
+    # "none" only starts the interpreter, to subtract its syscalls
+    count = len(IMPLEMENTATIONS.get(name, lambda root: [])(root))
+    return count, time.perf_counter() - start
+
+
+def count_syscalls(argv):
+    """ Runs the interpreter with argv under strace -c and returns
+    {syscall: calls}."""
+    with tempfile.NamedTemporaryFile(mode="r") as out:
+        subprocess.run(
+            ["strace", "-f", "-c", "-o", out.name, sys.executable, *argv],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        counts = {}
+        for line in out:
+            match = re.match(
+                r"\s*[\d.]+\s+[\d.]+\s+\d+\s+(\d+)\s+(?:\d+\s+)?(\w+)$", line
+            )
+            if match:
+                counts[match.group(2)] = int(match.group(1))
+        return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--width", type=int, default=6)
+    parser.add_argument("--depth", type=int, default=5)
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--run", nargs=2, metavar=("IMPL", "ROOT"),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_one(*args.run)
+        return
+
+    root = tempfile.mkdtemp(prefix="fst-bench-")
+    try:
+        make_tree(root, args.width, args.depth, args.files)
+        has_strace = shutil.which("strace") is not None
+        if not has_strace:
+            print("strace not found - showing wall time only.")
+        baseline = {}
+        if has_strace:
+            baseline = count_syscalls(
+                ["-m", "bench.syscalls", "--run", "none", root]
+            )
+        for name in IMPLEMENTATIONS:
+            count, elapsed = run_one(name, root)
+            line = "{:18} dirs={} time={:.3f}s".format(name, count, elapsed)
+            if has_strace:
+                counts = count_syscalls(
+                    ["-m", "bench.syscalls", "--run", name, root]
+                )
+                total = sum(counts.values()) - sum(baseline.values())
+                line += " syscalls={}".format(total)
+            print(line)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
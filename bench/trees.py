@@ -0,0 +1,120 @@
+"""
+Repeatable synthetic directory trees for benchmarks.
+
+Every shape creates a template and instances that are copies of it with a
+fraction of their directories missing. The same seed always yields the same
+trees.
+"""
+import collections
+import os
+import os.path
+import random
+
+Scenario = collections.namedtuple("Scenario", ["template", "instances"])
+
+
+def make_tree(root, width, depth, files):
+    """ Creates a tree where every directory has :width: subdirectories and
+    :files: empty files down to :depth: levels."""
+    level = [root]
+    for _ in range(depth):
+        next_level = []
+        for parent in level:
+            for i in range(files):
+                open(os.path.join(parent, "f{}".format(i)), "w").close()
+            for i in range(width):
+                path = os.path.join(parent, "d{}".format(i))
+                os.mkdir(path)
+                next_level.append(path)
+        level = next_level
+    return root
+
+
+def make_chain(root, depth, width):
+    """ Creates :width: chains of nested directories :depth: levels deep."""
+    for i in range(width):
+        fd = os.open(root, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            name = "c{}".format(i)
+            for _ in range(depth):
+                os.mkdir(name, dir_fd=fd)
+                child = os.open(name, os.O_RDONLY | os.O_DIRECTORY, dir_fd=fd)
+                os.close(fd)
+                fd = child
+                name = "n"
+        finally:
+            os.close(fd)
+    return root
+
+
+def make_partial_copy(template, destination, missing, rng):
+    """ Copies the structure of template leaving out a :missing: fraction of
+    its directories together with their subtrees."""
+    os.mkdir(destination)
+    for dirpath, dirnames, _ in os.walk(template):
+        dirnames.sort()
+        rel_dir = os.path.relpath(dirpath, template)
+        kept = []
+        for name in dirnames:
+            if rng.random() < missing:
+                continue
+            kept.append(name)
+            os.mkdir(os.path.normpath(os.path.join(destination, rel_dir, name)))
+        dirnames[:] = kept
+    return destination
+
+
+def _scenario(root, build_template, instance_count, missing, seed):
+    rng = random.Random(seed)
+    template = os.path.join(root, "template")
+    os.mkdir(template)
+    build_template(template)
+    instances = [
+        make_partial_copy(
+            template,
+            os.path.join(root, "instance{}".format(i)),
+            missing,
+            rng
+        )
+        for i in range(instance_count)
+    ]
+    return Scenario(template, instances)
+
+
+def wide(root, scale=1, seed=0):
+    return _scenario(
+        root, lambda t: make_tree(t, 60 * scale, 2, 0), 1, 0.5, seed
+    )
+
+
+def deep(root, scale=1, seed=0):
+    return _scenario(
+        root, lambda t: make_chain(t, 400 * scale, 4), 1, 0.5, seed
+    )
+
+
+def sparse(root, scale=1, seed=0):
+    return _scenario(
+        root, lambda t: make_tree(t, 3, 4 + scale, 40), 1, 0.5, seed
+    )
+
+
+def mostly_conformed(root, scale=1, seed=0):
+    return _scenario(
+        root, lambda t: make_tree(t, 6 * scale, 4, 2), 1, 0.01, seed
+    )
+
+
+def many_instances(root, scale=1, seed=0):
+    return _scenario(
+        root, lambda t: make_tree(t, 4, 3, 1), 50 * scale, 0.1, seed
+    )
+
+
+SHAPES = collections.OrderedDict([
+    ("wide", wide),
+    ("deep", deep),
+    ("sparse", sparse),
+    ("mostly_conformed", mostly_conformed),
+    ("many_instances", many_instances),
+])
@@ -1,5 +1,5 @@
 BEGIN;
-CREATE TABLE templates (
+CREATE TABLE IF NOT EXISTS templates (
     id INTEGER PRIMARY KEY NOT NULL UNIQUE,
     name text UNIQUE NOT NULL,
     path text NOT NULL UNIQUE,
@@ -7,11 +7,55 @@ CREATE TABLE templates (
     active integer NOT NULL DEFAULT 1
 );
 
-CREATE TABLE instances (
+CREATE TABLE IF NOT EXISTS instances (
     id INTEGER PRIMARY KEY NOT NULL UNIQUE,
     path text NOT NULL UNIQUE,
     template_id int NOT NULL,
     active integer NOT NULL DEFAULT 1,
     FOREIGN KEY(template_id) REFERENCES templates
 );
+
+-- instances of a template are looked up on every command and daemon reload
+CREATE INDEX IF NOT EXISTS instances_by_template
+    ON instances (template_id, active);
+
+-- Structure of templates. Every subdirectory is one row where parent is the
+-- path of the containing directory relative to the template ('' at the top).
+CREATE TABLE IF NOT EXISTS template_dirs (
+    template_id int NOT NULL,
+    parent text NOT NULL,
+    name text NOT NULL,
+    PRIMARY KEY (template_id, parent, name),
+    FOREIGN KEY(template_id) REFERENCES templates
+) WITHOUT ROWID;
+
+-- Merkle checksums of template directories. Each one covers the whole subtree
+-- of the directory. path is relative to the template and '' is the template.
+CREATE TABLE IF NOT EXISTS template_checksums (
+    template_id int NOT NULL,
+    path text NOT NULL,
+    checksum text NOT NULL,
+    PRIMARY KEY (template_id, path),
+    FOREIGN KEY(template_id) REFERENCES templates
+) WITHOUT ROWID;
+
+-- mtimes of template directories when their listing in template_dirs was last
+-- read from disk. A directory whose mtime still matches doesn't need to be
+-- listed again to know its subdirectories.
+CREATE TABLE IF NOT EXISTS template_mtimes (
+    template_id int NOT NULL,
+    path text NOT NULL,
+    mtime_ns int NOT NULL,
+    PRIMARY KEY (template_id, path),
+    FOREIGN KEY(template_id) REFERENCES templates
+) WITHOUT ROWID;
+
+-- Shell patterns of directory names that are ignored in a template and its
+-- instances - see fst/ignore.py.
+CREATE TABLE IF NOT EXISTS template_ignores (
+    template_id int NOT NULL,
+    pattern text NOT NULL,
+    PRIMARY KEY (template_id, pattern),
+    FOREIGN KEY(template_id) REFERENCES templates
+) WITHOUT ROWID;
 COMMIT;
@@ -0,0 +1,26 @@
+"""
+Atomic replacement of files.
+
+A file is written to a temporary name next to it and renamed over it once
+complete, so readers see either the old or the new contents. The temporary
+file is removed if writing fails.
+"""
+import contextlib
+import os
+
+
+@contextlib.contextmanager
+def open_atomic(path, mode="w"):
+    """ Opens a temporary file that replaces :path: when the block exits
+    without an exception."""
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
@@ -0,0 +1,125 @@
+"""
+Catch up with template changes made while fstd wasn't running.
+
+The structure stored in the index is the snapshot of a template as the daemon
+last saw it. At startup the template is compared with it and only the missed
+changes are applied to the instances before live events are taken. The same
+is done while running when the watcher may have lost events of a template.
+"""
+import collections
+import os
+import os.path
+import time
+
+import fst.dirdiff
+import fst.index
+import fst.trace
+
+ScanResult = collections.namedtuple("ScanResult", ["tree", "mtimes", "listed"])
+CatchUpResult = collections.namedtuple(
+    "CatchUpResult",
+    ["listed", "scanned", "created", "deleted", "elapsed", "listed_mtimes"]
+)
+
+
+def scan(path, snapshot, mtimes, ignore=None):
+    """ Reads the structure of a directory reusing the listings of a snapshot.
+
+    A directory whose mtime is the one recorded in :mtimes: has the same
+    subdirectories as in the :snapshot: DirTree, so it costs one stat instead
+    of being listed. Directories matched by the :ignore: rules are skipped.
+    Returns a ScanResult with the current structure, the mtimes of all
+    directories in it and the paths of the directories that were listed.
+    """
+    children = {}
+    new_mtimes = {}
+    listed = []
+    stack = [""]
+    while stack:
+        rel_path = stack.pop()
+        dir_path = os.path.join(path, rel_path) if rel_path else path
+        try:
+            mtime_ns = os.stat(dir_path).st_mtime_ns
+        except FileNotFoundError:
+            if not rel_path:
+                raise
+            # only possible when the parent's listing came from the snapshot
+            # and it was changed after its stat
+            parent, name = os.path.split(rel_path)
+            children[parent].remove(name)
+            continue
+
+        if mtimes.get(rel_path) == mtime_ns:
+            names = snapshot.listing(rel_path)
+        else:
+            names = fst.dirdiff.listdir(dir_path)
+            if ignore:
+                names = ignore.filter(names)
+            listed.append(rel_path)
+        children[rel_path] = names
+        new_mtimes[rel_path] = mtime_ns
+        stack.extend(os.path.join(rel_path, name) for name in names)
+
+    return ScanResult(fst.dirdiff.DirTree(children), new_mtimes, listed)
+
+
+def catch_up(handler):
+    """ Applies the changes to a template since it was last indexed to its
+    instances through a TemplateEventHandler.
+
+    Returns a CatchUpResult with the number of directories that were listed
+    and scanned and of subtrees that were created and deleted. Its
+    listed_mtimes maps the listed directories to the mtimes they were scanned
+    with. They include every directory that's new since the last scan - see
+    changed_since().
+    """
+    start = time.perf_counter()
+    template = handler.template
+    cursor = handler.conn.cursor()
+    snapshot = fst.index.pull_tree(cursor, template["id"])
+    result = scan(
+        template["path"],
+        snapshot,
+        fst.index.pull_mtimes(cursor, template["id"]),
+        handler.ignore
+    )
+    diff = fst.dirdiff.changed_subtrees(snapshot, result.tree)
+    if diff.left:
+        handler.apply_deleted(diff.left)
+    if diff.right:
+        handler.apply_created(diff.right)
+    with handler.conn:
+        fst.index.store_mtimes(cursor, template["id"], result.mtimes)
+
+    caught_up = CatchUpResult(
+        len(result.listed),
+        len(result.mtimes),
+        len(diff.right),
+        len(diff.left),
+        time.perf_counter() - start,
+        {p: result.mtimes[p] for p in result.listed}
+    )
+    fst.trace.info(
+        "Caught up with template:%s in %.3fs - listed %s of %s directories, "
+        "%s subtrees added and %s removed.",
+        template["name"],
+        caught_up.elapsed,
+        caught_up.listed,
+        caught_up.scanned,
+        caught_up.created,
+        caught_up.deleted
+    )
+    return caught_up
+
+
+def changed_since(path, mtimes):
+    """ Returns whether a directory under :path: in :mtimes: was modified or
+    removed since it had that mtime."""
+    for rel_path, mtime_ns in mtimes.items():
+        try:
+            st = os.stat(os.path.join(path, rel_path) if rel_path else path)
+        except FileNotFoundError:
+            return True
+        if st.st_mtime_ns != mtime_ns:
+            return True
+    return False
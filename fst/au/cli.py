@@ -1,5 +1,7 @@
 import argparse
 import fst.au.daemon
+import fst.files
+from fst.config import CONFIG
 
 
 def main():
@@ -10,8 +12,65 @@ def main():
     parser.add_argument("db", help="Path to fst database.",
 			nargs='?',
 			default=fst.db.DB_PATH)
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=CONFIG['au'].get('debounce', 0.5),
+        help="Seconds without new events after which a burst is applied."
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=CONFIG['au'].get('batch_size', 1000),
+        help="Maximum number of events applied together."
+    )
+    parser.add_argument(
+        "--propagate-deletes",
+        action="store_true",
+        default=CONFIG['au'].get('propagate_deletes', False),
+        help=("Remove directories deleted from a template from its instances "
+              "as long as they are empty.")
+    )
+    parser.add_argument(
+        "--propagate-files",
+        choices=fst.files.MODES,
+        default=CONFIG['au'].get('propagate_files'),
+        help=("Also copy files created or changed in a template into its "
+              "instances. 'hardlink' links them instead where possible.")
+    )
+    parser.add_argument(
+        "--resync-interval",
+        type=float,
+        default=CONFIG['au'].get(
+            'resync_interval', fst.au.daemon.RESYNC_INTERVAL
+        ),
+        help=("Minimum seconds between two rescans of a template after the "
+              "watcher lost its events.")
+    )
+    parser.add_argument(
+        "--metrics-file",
+        default=CONFIG['au'].get('metrics_file'),
+        help=("Write propagation latency metrics in the Prometheus text "
+              "format to this file every second.")
+    )
+    parser.add_argument(
+        "--control-socket",
+        default=CONFIG['au'].get('control_socket'),
+        help="Unix socket on which fst sends changes to the daemon."
+    )
     args = parser.parse_args()
-    fst.au.daemon.start(args.db)
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1.")
+    fst.au.daemon.start(
+        args.db,
+        args.debounce,
+        args.batch_size,
+        args.propagate_deletes,
+        args.metrics_file,
+        args.control_socket,
+        args.propagate_files,
+        args.resync_interval
+    )
 
 
 if __name__ == "__main__":
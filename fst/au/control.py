@@ -0,0 +1,137 @@
+"""
+Control channel between the fst command line app and fstd.
+
+fstd listens on a unix socket. Clients send JSON messages, one per line, and
+get one JSON reply line for each. A message is an object with a "type" and the
+fields of that type:
+
+    ping                                -> {"pid"}
+    reload                              -> {"templates"}
+    template_added {template_id}        -> {"watched", "instances"}
+    template_removed {template_id}      -> {"watched", "instances"}
+    instance_connected {template_id}    -> {"watched", "instances"}
+    instance_disconnected {template_id} -> {"watched", "instances"}
+    template_changed {template_id}      -> {"watched", "instances"}
+    tree {template_id}                  -> {"paths", "pending"}
+    metrics                             -> {"metrics"}
+
+Every reply has an "ok" field. Failed replies carry an "error" instead of the
+fields above. Replies are only sent once the change has taken effect in the
+daemon.
+"""
+import json
+import os
+import select
+import socket
+import threading
+
+import fst.trace
+from fst.config import CONFIG
+
+SOCKET_PATH = CONFIG['au'].get('control_socket')
+# seconds a client waits for a reply and the daemon for a request line
+TIMEOUT = 10
+
+
+def request(message, path=SOCKET_PATH, timeout=TIMEOUT):
+    """ Sends a message to fstd and returns its reply or None if it isn't
+    listening or didn't reply in time."""
+    if not path:
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with sock:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            fst.trace.trace("Auto update daemon is not listening on %s.", path)
+            return None
+        try:
+            with sock.makefile("rwb") as stream:
+                stream.write(json.dumps(message).encode() + b"\n")
+                stream.flush()
+                line = stream.readline()
+        except OSError as exc:
+            fst.trace.warn(
+                "Auto update daemon did not reply to %r (%s).", message, exc
+            )
+            return None
+    if not line:
+        fst.trace.warn("Auto update daemon closed the connection.")
+        return None
+    return json.loads(line.decode())
+
+
+class ControlServer(threading.Thread):
+    """ Answers control messages with functions from :handlers:.
+
+    handlers maps message types to functions that take the message and return
+    a dict with the fields of the reply. Exceptions they raise are sent back
+    as failed replies. Clients are served one at a time.
+    """
+
+    def __init__(self, path, handlers):
+        super().__init__(name="fstd-control", daemon=True)
+        self.path = path
+        self.handlers = handlers
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        os.chmod(path, 0o600)
+        self._sock.listen()
+        self._stop_read, self._stop_write = os.pipe()
+
+    def stop(self):
+        os.write(self._stop_write, b"x")
+
+    def run(self):
+        try:
+            while True:
+                readable, _, _ = select.select(
+                    [self._sock, self._stop_read], [], []
+                )
+                if self._stop_read in readable:
+                    return
+                client, _ = self._sock.accept()
+                with client:
+                    client.settimeout(TIMEOUT)
+                    try:
+                        self._serve(client)
+                    except OSError:
+                        fst.trace.exception("Control client failed.")
+        finally:
+            self._sock.close()
+            os.close(self._stop_read)
+            os.close(self._stop_write)
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+    def _serve(self, client):
+        with client.makefile("rwb") as stream:
+            for line in stream:
+                reply = self.handle(line)
+                stream.write(json.dumps(reply).encode() + b"\n")
+                stream.flush()
+
+    def handle(self, line):
+        try:
+            message = json.loads(line.decode())
+            handler = self.handlers[message["type"]]
+        except (ValueError, KeyError, TypeError) as exc:
+            return {
+                "ok": False,
+                "error": "malformed message ({!r})".format(exc)
+            }
+        fst.trace.info("Received control message:%r", message)
+        try:
+            reply = handler(message)
+        except Exception as exc:
+            fst.trace.exception("Handling control message:%r failed.", message)
+            return {"ok": False, "error": str(exc)}
+        reply["ok"] = True
+        return reply
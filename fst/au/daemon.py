@@ -1,22 +1,93 @@
+import functools
 import grp
 import pwd
 import os
 import os.path
 import time
+import threading
 import signal
 
 
+import fst.au.catchup
+import fst.au.control
+import fst.au.events
+import fst.au.metrics
 import fst.au.watch
+import fst.conform
 import fst.db
-import fst.tmpl
+import fst.dirdiff
+import fst.files
+import fst.ignore
+import fst.index
+import fst.rels
 import fst.trace
 from fst.config import CONFIG
 
 
+# seconds
+RESYNC_INTERVAL = 60
+
+
+def _with_parents(rel_path):
+    """ Returns rel_path preceded by all of its parents."""
+    components = rel_path.split(os.sep)
+    return [os.path.join(*components[:i + 1]) for i in range(len(components))]
+
+
 class TemplateEventHandler(fst.au.watch.FileSystemEventHandler):
-    def __init__(self, template, instances):
+    def __init__(self, template, instances, conn, queue,
+                 propagate_deletes=False, ignore=None, propagate_files=None,
+                 resync_interval=RESYNC_INTERVAL):
         self.template = template
         self.instances = instances
+        self.ignore = ignore or fst.ignore.IgnoreRules()
+        self.conn = conn
+        self.queue = queue
+        self.metrics = queue.metrics
+        self.propagate_deletes = propagate_deletes
+        # one of fst.files.MODES or None to leave files alone
+        self.propagate_files = propagate_files
+        # minimum seconds between two resyncs - see request_resync()
+        self.resync_interval = resync_interval
+        self._resync_lock = threading.Lock()
+        self._resync_pending = False
+        self._last_resync = None
+        # set when the template is unwatched - a resync queued before then
+        # would record mtimes of listings filtered by outdated rules
+        self.unwatched = False
+        # set by the daemon to a function that watches directories of the
+        # template given relative to it - only the inotify observer has one
+        self.rewatch = None
+        # bumped after every change to the index so that the tree cached by
+        # current_tree() is dropped
+        self.version = 0
+        self._tree = None
+
+    def count(self, name, value=1):
+        self.metrics.inc(name, value, template=self.template["name"])
+
+    def current_tree(self, cursor):
+        """ Returns the structure of the template as indexed by the daemon.
+
+        The DirTree is kept in memory until the next event is applied.
+        """
+        version = self.version
+        cached = self._tree
+        if cached is None or cached[0] != version:
+            tree = fst.index.pull_tree(cursor, self.template["id"])
+            cached = (version, tree)
+            self._tree = cached
+        return cached[1]
+
+    def rel_path(self, path):
+        """ Returns path relative to the template or None if it's outside or
+        ignored."""
+        rel_path = os.path.relpath(path, start=self.template["path"])
+        if rel_path == os.curdir or rel_path.startswith(os.pardir):
+            return None
+        if self.ignore.ignores(rel_path):
+            return None
+        return rel_path
 
     def on_any_event(self, event):
         fst.trace.info(
@@ -27,49 +98,380 @@ class TemplateEventHandler(fst.au.watch.FileSystemEventHandler):
 
     def on_created(self, event):
         if isinstance(event, fst.au.watch.FileCreatedEvent):
-            fst.trace.warn(
+            self.on_file_changed(event.src_path, event)
+            return
+
+        rel_path = self.rel_path(event.src_path)
+        if rel_path:
+            self.queue.put(self, "created", rel_path)
+
+    def on_modified(self, event):
+        if isinstance(event, fst.au.watch.FileModifiedEvent):
+            self.on_file_changed(event.src_path, event)
+
+    def on_file_changed(self, path, event):
+        if not self.propagate_files:
+            fst.trace.trace(
                 "In template:%s ignoring event:%s",
                 self.template["name"],
                 event
             )
             return
+        rel_path = self.rel_path(path)
+        if rel_path:
+            self.queue.put(self, "file_changed", rel_path)
 
-        created = event.src_path
-        rel_path_in_template = os.path.relpath(created, start=self.template["path"])
+    def on_lost_events(self, reason):
+        """ Called by the observer when events of the template may have been
+        lost, e.g. when the kernel's event queue overflowed."""
+        fst.trace.warn(
+            "Events of template:%s may have been lost (%s).",
+            self.template["name"],
+            reason
+        )
+        self.request_resync(reason)
+
+    def request_resync(self, reason):
+        """ Queues a resync of the template, at most one per resync_interval.
+
+        Requests made while one is pending are folded into it, so a storm of
+        overflows costs a single rescan per interval.
+        """
+        self.metrics.inc(
+            "fstd_resync_requests_total",
+            template=self.template["name"],
+            reason=reason
+        )
+        with self._resync_lock:
+            if self._resync_pending:
+                return
+            self._resync_pending = True
+            delay = 0
+            if self._last_resync is not None:
+                delay = (self._last_resync + self.resync_interval -
+                         time.monotonic())
+        if delay <= 0:
+            self.queue.put(self, "resync", reason)
+            return
+        fst.trace.warn(
+            "Resyncing template:%s in %.1fs.", self.template["name"], delay
+        )
+        timer = threading.Timer(
+            delay, self.queue.put, [self, "resync", reason]
+        )
+        timer.daemon = True
+        timer.start()
+
+    def apply_resync(self, reasons):
+        """ Rescans the template and applies the changes that were missed.
 
-        assert os.path.exists(created)
+        Directories whose mtime didn't change since the last scan aren't
+        listed again - see fst.au.catchup.scan(). Only the listed ones are
+        watched again since a directory that was created or moved while
+        events were lost is always listed. A newly watched one that changed
+        between its scan and its watch left no event, so another resync is
+        requested then.
+        """
+        with self._resync_lock:
+            # events lost from now on need another resync
+            self._resync_pending = False
+            self._last_resync = time.monotonic()
+        if self.unwatched:
+            return
+        result = fst.au.catchup.catch_up(self)
+        if self.rewatch:
+            added = self.rewatch(result.listed_mtimes)
+            if fst.au.catchup.changed_since(
+                    self.template["path"],
+                    {p: result.listed_mtimes[p] for p in added}):
+                self.request_resync("rewatch")
+        if self.propagate_files:
+            # changed files leave no trace in the directories' mtimes
+            self._sync_files(list(fst.files.iter_files(
+                self.template["path"], self.ignore
+            )))
+        self.count("fstd_resyncs_total")
+        self.count("fstd_resync_listed_total", result.listed)
+        self.metrics.observe(
+            "fstd_resync_seconds",
+            result.elapsed,
+            template=self.template["name"]
+        )
+        fst.trace.warn(
+            "Resynced template:%s after %s - %s subtrees added and %s "
+            "removed.",
+            self.template["name"],
+            ", ".join(sorted(set(reasons))),
+            result.created,
+            result.deleted
+        )
 
-        for i in self.instances.values():
-            path_in_instance = os.path.join(
-                i["path"],
-                rel_path_in_template
+    def on_moved(self, event):
+        if isinstance(event, fst.au.watch.FileMovedEvent):
+            self.on_file_changed(event.dest_path, event)
+            return
+        if not isinstance(event, fst.au.watch.DirMovedEvent):
+            return
+        src = self.rel_path(event.src_path)
+        dest = self.rel_path(event.dest_path)
+        if src and dest:
+            self.queue.put(self, "moved", (src, dest))
+        elif src:
+            self.queue.put(self, "deleted", src)
+        elif dest:
+            self.queue.put(self, "created", dest)
+
+    def on_deleted(self, event):
+        if not isinstance(event, fst.au.watch.DirDeletedEvent):
+            return
+        rel_path = self.rel_path(event.src_path)
+        if rel_path:
+            self.queue.put(self, "deleted", rel_path)
+
+    def apply_created(self, rel_paths):
+        """ Creates the subtrees of created template directories in every
+        instance. rel_paths must not be nested in each other."""
+        with self.conn:
+            cursor = self.conn.cursor()
+            for rel_path in rel_paths:
+                self._apply_created(cursor, rel_path)
+        self.version += 1
+
+    def _apply_created(self, cursor, rel_path):
+        created = os.path.join(self.template["path"], rel_path)
+        try:
+            subdirs = fst.dirdiff.flattened_subdirs(
+                created, ignore=self.ignore
+            )
+        except FileNotFoundError:
+            fst.trace.info(
+                "Directory:%s was removed from template:%s before it was "
+                "handled",
+                rel_path,
+                self.template["name"]
             )
-            path_in_instance = os.path.abspath(path_in_instance)
+            return
+
+        # parents are normally already in the instances but are cheap to
+        # include since existing directories are skipped
+        plan = _with_parents(rel_path)
+        plan.extend(os.path.join(rel_path, p) for p in subdirs)
+        self._materialize(self.instances, rel_path, plan)
+
+        fst.index.add_dirs(cursor, self.template["id"], plan)
+        fst.index.update_checksums(cursor, self.template["id"], rel_path)
+        if self.propagate_files:
+            self._sync_subtree_files(self.instances, rel_path)
 
+    def _materialize(self, instances, rel_path, plan):
+        for i in instances:
             try:
-                os.mkdir(path_in_instance)
-            except FileExistsError:
-                # TODO this should be a config whether it happens
-                # and what the suffix/previx will be ?
-                os.rename(path_in_instance, path_in_instace + ".moved")
-                os.mkdir(path_in_instance)
-            except DirExistsError:
-                fst.trace.trace(
-                    "Directory:%s already exists in instance:%s",
-                    path_in_instance,
+                made = fst.conform.materialize(i["path"], plan)
+            except OSError:
+                self.count("fstd_errors_total")
+                fst.trace.exception(
+                    "Creating directory:%s in instance:%s failed",
+                    rel_path,
                     i["path"]
                 )
+                continue
+            self.count("fstd_mkdirs_total", len(made))
+            fst.trace.info(
+                "Created %s directories for:%s in instance:%s",
+                len(made),
+                rel_path,
+                i["path"]
+            )
+
+    def _sync_subtree_files(self, instances, rel_path):
+        # files written before the new directories were watched have no
+        # events of their own
+        try:
+            files = list(fst.files.iter_files(
+                self.template["path"], self.ignore, rel_path
+            ))
+        except FileNotFoundError:
+            files = []
+        self._sync_files(files, instances)
+
+    def apply_file_changed(self, rel_paths):
+        """ Copies changed template files into every instance."""
+        self._sync_files(list(dict.fromkeys(rel_paths)))
+
+    def _sync_files(self, rel_paths, instances=None):
+        if not rel_paths:
+            return
+        for i in self.instances if instances is None else instances:
+            try:
+                synced = fst.files.sync_files(
+                    self.template["path"],
+                    i["path"],
+                    rel_paths,
+                    self.propagate_files
+                )
+            except OSError:
+                self.count("fstd_errors_total")
+                fst.trace.exception(
+                    "Copying files into instance:%s failed", i["path"]
+                )
+                continue
+            for rel_path, method in synced:
+                if method:
+                    self.metrics.inc(
+                        "fstd_files_copied_total",
+                        template=self.template["name"],
+                        method=method
+                    )
+                else:
+                    self.count("fstd_files_skipped_total")
+            fst.trace.info(
+                "Copied %s of %s files into instance:%s",
+                sum(1 for _, method in synced if method),
+                len(synced),
+                i["path"]
+            )
+
+    def apply_moved(self, moves):
+        """ Renames moved template directories in every instance.
+
+        A move costs one rename per instance and one rewrite of the index
+        rows regardless of the size of the subtree. Instances where the
+        rename isn't possible get the new subtree created from the index
+        instead and keep the old one.
+        """
+        with self.conn:
+            cursor = self.conn.cursor()
+            for src, dest in moves:
+                self._apply_moved(cursor, src, dest)
+        self.version += 1
+
+    def _apply_moved(self, cursor, src, dest):
+        template_id = self.template["id"]
+        if (not fst.index.is_recorded(cursor, template_id, src) and
+                fst.index.is_recorded(cursor, template_id, dest)):
+            # moved with a parent whose move was applied in an earlier batch
+            fst.trace.trace("Directory:%s is already at:%s", src, dest)
+            return
+        dest_parent = os.path.dirname(dest)
+        failed = []
+        for i in self.instances:
+            try:
+                if dest_parent:
+                    fst.conform.materialize(
+                        i["path"], _with_parents(dest_parent)
+                    )
+                os.rename(
+                    os.path.join(i["path"], src),
+                    os.path.join(i["path"], dest)
+                )
+            except OSError as exc:
+                fst.trace.info(
+                    "Could not move:%s to:%s in instance:%s (%s). "
+                    "Creating it instead.",
+                    src,
+                    dest,
+                    i["path"],
+                    exc
+                )
+                failed.append(i)
+                continue
             fst.trace.info(
-                "Created directory:%s in instance:%s",
-                path_in_instance,
+                "Moved directory:%s to:%s in instance:%s",
+                src,
+                dest,
                 i["path"]
             )
 
+        if not fst.index.move_dirs(cursor, template_id, src, dest):
+            # src wasn't indexed so there's nothing to move - read dest from
+            # disk like a new directory
+            self._apply_created(cursor, dest)
+            return
+        if failed:
+            plan = _with_parents(dest)
+            plan.extend(
+                os.path.join(dest, p)
+                for p in fst.index.pull_subtree(cursor, template_id, dest)
+                .paths()
+            )
+            self._materialize(failed, dest, plan)
+            if self.propagate_files:
+                self._sync_subtree_files(failed, dest)
+
+    def apply_deleted(self, rel_paths):
+        """ Removes deleted template directories from the index and if
+        propagate_deletes is set from every instance as well.
+
+        Only empty directories are removed from instances, bottom-up, so
+        anything put in them is kept together with its parents.
+        """
+        with self.conn:
+            cursor = self.conn.cursor()
+            for rel_path in rel_paths:
+                if self.propagate_deletes:
+                    for i in self.instances:
+                        self._remove_empty(i["path"], rel_path)
+                fst.index.remove_dirs(cursor, self.template["id"], rel_path)
+                fst.index.update_checksums(
+                    cursor, self.template["id"], rel_path
+                )
+        self.version += 1
+
+    def _remove_empty(self, instance_path, rel_path):
+        root = os.path.join(instance_path, rel_path)
+        try:
+            subdirs = fst.dirdiff.flattened_subdirs(root, appended=True)
+        except FileNotFoundError:
+            return
+        removed = 0
+        for path in reversed([root] + subdirs):
+            try:
+                os.rmdir(path)
+                removed += 1
+            except OSError:
+                # not empty or already gone
+                pass
+        fst.trace.info(
+            "Removed %s of %s directories under:%s in instance:%s",
+            removed,
+            len(subdirs) + 1,
+            rel_path,
+            instance_path
+        )
+
 
 class Daemon:
-    def __init__(self, db_path):
+    def __init__(self, db_path, debounce, batch_size, propagate_deletes=False,
+                 metrics_file=None, control_socket=None,
+                 propagate_files=None, resync_interval=RESYNC_INTERVAL):
         self.db_path = db_path
-        self.event_handlers = []
+        self.control_socket = control_socket
+        self.propagate_deletes = propagate_deletes
+        self.propagate_files = propagate_files
+        self.resync_interval = resync_interval
+        self.metrics = fst.au.metrics.Metrics()
+        self.metrics_file = metrics_file
+        self.queue = fst.au.events.EventQueue(
+            debounce, batch_size, self.metrics
+        )
+        # template id -> (watch, handler)
+        self.watches = {}
+        # serializes changes to the watches between the main and control
+        # threads
+        self.lock = threading.RLock()
+        self.control_handlers = {
+            "ping": lambda message: {"pid": os.getpid()},
+            "reload": self.control_reload,
+            "template_added": self.control_sync,
+            "template_removed": self.control_sync,
+            "instance_connected": self.control_sync,
+            "instance_disconnected": self.control_sync,
+            "template_changed": self.control_sync,
+            "tree": self.control_tree,
+            "metrics": lambda message: {"metrics": self.metrics.render()},
+        }
+        self.control = None
+        self.control_conn = None
         self.received_signals = {}
         self.signal_handlers = {
             signal.SIGUSR1: self.reload_templates
@@ -91,34 +493,181 @@ class Daemon:
     def cleanup(self):
         os.remove(CONFIG['au']['pidfile'])
 
+    def write_metrics(self):
+        if not self.metrics_file:
+            return
+        try:
+            self.metrics.write(self.metrics_file)
+        except OSError:
+            fst.trace.exception(
+                "Writing metrics to %s failed.", self.metrics_file
+            )
+
     def immediate_signal_handler(self, signum, stackframe):
         self.received_signals[signum] = True
 
-    def reload_templates(self):
+    def reload_templates(self, cursor=None):
+        """ Brings watches in line with the relationships in the db.
+
+        Only templates that were added, removed or moved are watched or
+        unwatched. Handlers of the rest are kept and only get their instances
+        swapped, so events that are queued or in flight aren't lost.
+        """
         fst.trace.info('Reloading templates from db.')
-        self.observer.unschedule_all()
-        self.load_template_event_handlers()
-        # TODO race condition when an event get's triggered before
-        # unschedule_all and get's triggered again before it is handled
-        # after load_template_event_handlers
-
-    def load_template_event_handlers(self):
-        cursor = self.conn.cursor()
-        rels = fst.tmpl.pull_relationships_by_template(cursor)
-        for rel in rels.values():
-            event_handler = TemplateEventHandler(
-                template = rel["template_row"],
-                instances = rel["instances"]
+        cursor = cursor or self.conn.cursor()
+        rels = fst.rels.pull(cursor)
+        rules = fst.ignore.pull_all_rules(cursor)
+        with self.lock:
+            for template_id in set(self.watches) | set(rels.by_id):
+                self.sync_template(
+                    template_id,
+                    rels.by_id.get(template_id),
+                    rules.get(template_id)
+                )
+
+    def sync_template(self, template_id, template, ignore=None):
+        """ Watches, unwatches or swaps the instances of a template to match
+        its fst.rels.Template - None if it was removed - and its
+        fst.ignore.IgnoreRules. A template is watched anew and resynced when
+        its rules change.
+        Returns the handler of the template or None if it isn't watched.
+        """
+        ignore = ignore or fst.ignore.IgnoreRules()
+        rules_changed = False
+        with self.lock:
+            if template_id in self.watches:
+                watch, handler = self.watches[template_id]
+                if (template and
+                        template.path == handler.template["path"] and
+                        ignore == handler.ignore):
+                    handler.template = template
+                    handler.instances = template.instances
+                    return handler
+                rules_changed = ignore != handler.ignore
+                fst.trace.info(
+                    "Unwatching template:%s", handler.template["name"]
+                )
+                self.observer.unschedule(watch)
+                handler.unwatched = True
+                del self.watches[template_id]
+            if template is None:
+                return None
+
+            fst.trace.info("Watching template:%s", template.name)
+            handler = TemplateEventHandler(
+                template = template,
+                instances = template.instances,
+                conn = self.conn,
+                queue = self.queue,
+                propagate_deletes = self.propagate_deletes,
+                ignore = ignore,
+                propagate_files = self.propagate_files,
+                resync_interval = self.resync_interval
             )
             # TODO recompile and restart thread if it dies to due an exception
-            self.observer.schedule(event_handler, rel["template_row"]["path"], recursive=True)
-            self.event_handlers.append(event_handler)
+            watch = self.observer.schedule(
+                handler,
+                template.path,
+                recursive=True
+            )
+            self.watches[template_id] = (watch, handler)
+            rewatch = getattr(self.observer, "rewatch", None)
+            if rewatch:
+                handler.rewatch = functools.partial(rewatch, watch)
+            self.report_watches(handler, watch)
+        if rules_changed:
+            # directories that are no longer ignored are only in the template
+            handler.request_resync("ignore")
+        return handler
+
+    def control_cursor(self):
+        # the control thread has its own connection so that it isn't
+        # serialized with the event worker
+        if self.control_conn is None:
+            self.control_conn = fst.db.connect(self.db_path)
+        return self.control_conn.cursor()
+
+    def control_reload(self, message):
+        self.reload_templates(self.control_cursor())
+        return {"templates": len(self.watches)}
+
+    def control_sync(self, message):
+        """ Applies a change to a single template's relationships."""
+        template_id = message["template_id"]
+        cursor = self.control_cursor()
+        cursor.execute(
+            "SELECT path FROM templates WHERE id=? AND active=1",
+            [template_id]
+        )
+        row = cursor.fetchone()
+        template = None
+        if row:
+            rels = fst.rels.pull(cursor, template=row["path"])
+            template = rels.by_id.get(template_id)
+        handler = self.sync_template(
+            template_id, template, fst.ignore.pull_rules(cursor, template_id)
+        )
+        return {
+            "watched": handler is not None,
+            "instances": len(handler.instances) if handler else 0,
+        }
+
+    def control_tree(self, message):
+        """ Replies with the structure of a watched template as the daemon
+        knows it and the number of events that are yet to be applied."""
+        template_id = message["template_id"]
+        with self.lock:
+            entry = self.watches.get(template_id)
+        if entry is None:
+            raise ValueError("template {} is not watched".format(template_id))
+        tree = entry[1].current_tree(self.control_cursor())
+        return {"paths": tree.paths(), "pending": self.queue.qsize()}
+
+    def report_watches(self, handler, watch):
+        watch_count = getattr(self.observer, "watch_count", None)
+        if watch_count:
+            fst.trace.info(
+                "Template:%s uses %s inotify watches (%s in total).",
+                handler.template["name"],
+                watch_count(watch),
+                watch_count()
+            )
+
+    def catch_up(self):
+        """ Applies template changes missed while the daemon wasn't running."""
+        start = time.perf_counter()
+        for _, handler in self.watches.values():
+            try:
+                fst.au.catchup.catch_up(handler)
+            except Exception:
+                fst.trace.exception(
+                    "Catching up with template:%s failed.",
+                    handler.template["name"]
+                )
+        fst.trace.info(
+            "Caught up with %s templates in %.3fs.",
+            len(self.watches),
+            time.perf_counter() - start
+        )
 
     def start(self):
         # TODO truly daemonize and use systemd for control
         self.conn = fst.db.connect(self.db_path)
         self.observer = fst.au.watch.Observer()
+        # watch before catching up so that nothing falls in between. The
+        # native inotify observer watches as soon as a template is scheduled
+        # but watchdog's only once it's started. Events are queued until the
+        # worker starts and those for changes that were already caught up
+        # with are no-ops.
+        self.reload_templates()
         self.observer.start()
+        self.catch_up()
+        self.queue.start()
+        if self.control_socket:
+            self.control = fst.au.control.ControlServer(
+                self.control_socket, self.control_handlers
+            )
+            self.control.start()
 
         try:
             while True:
@@ -128,9 +677,15 @@ class Daemon:
                     if self.received_signals[signum]:
                         self.signal_handlers[signum]()
                         self.received_signals[signum] = False
+                self.write_metrics()
         finally:
+            if self.control:
+                self.control.stop()
+                self.control.join()
             self.observer.stop()
             self.observer.join()
+            self.queue.stop()
+            self.write_metrics()
 
 
 #Throws OSError exception (it will be thrown when the process is not allowed
@@ -155,8 +710,13 @@ def drop_privileges():
     old_umask = os.umask(0o22)
 
 
-def start(db_path):
-    daemon = Daemon(db_path)
+def start(db_path, debounce, batch_size, propagate_deletes=False,
+          metrics_file=None, control_socket=None, propagate_files=None,
+          resync_interval=RESYNC_INTERVAL):
+    daemon = Daemon(
+        db_path, debounce, batch_size, propagate_deletes, metrics_file,
+        control_socket, propagate_files, resync_interval
+    )
     drop_privileges()
     try:
         daemon.start()
@@ -0,0 +1,172 @@
+"""
+Ordered queue of template events handled by a single worker thread.
+
+Watchdog threads only put events on the queue. The worker waits for a burst of
+events to settle, coalesces it and hands it to the event handlers in the order
+the events arrived, so that one change is never applied concurrently with
+another.
+"""
+import os
+import queue
+import threading
+import time
+
+import fst.au.metrics
+import fst.trace
+
+_STOP = object()
+# kinds of events whose paths can be reduced to subtree roots
+_SUBTREE_KINDS = ("created", "deleted")
+
+
+def outer_moves(moves):
+    """ Drops (src, dest) moves that follow from an earlier move of a parent.
+
+    Some watchers report a move for every directory in a moved subtree, but
+    moving the parent moves them already.
+    """
+    outer = []
+    for src, dest in moves:
+        if not any(
+                src.startswith(outer_src + os.sep) and
+                dest == outer_dest + src[len(outer_src):]
+                for outer_src, outer_dest in outer):
+            outer.append((src, dest))
+    return outer
+
+
+def subtree_roots(rel_paths):
+    """ Returns the sorted paths that aren't under another one of rel_paths."""
+    roots = []
+    for components in sorted(os.path.normpath(p).split(os.sep)
+                             for p in rel_paths):
+        if roots and components[:len(roots[-1])] == roots[-1]:
+            continue
+        roots.append(components)
+    return [os.path.join(*components) for components in roots]
+
+
+class EventQueue:
+    """ Batches events for their handlers.
+
+    A batch is closed once no event arrived for :debounce: seconds or it holds
+    :batch_size: events. Events of the same handler and kind are then passed
+    together to its apply_<kind>(rel_paths) method, e.g. a burst of created
+    directories becomes one apply_created() call - see coalesce().
+
+    The time every event waited in the queue and the time until its handler
+    returned are recorded in :metrics: per template.
+    """
+
+    def __init__(self, debounce, batch_size, metrics=None):
+        assert batch_size > 0
+        self.debounce = debounce
+        self.batch_size = batch_size
+        if metrics is None:
+            metrics = fst.au.metrics.Metrics()
+        self.metrics = metrics
+        self.metrics.gauge("fstd_queue_depth", self.qsize)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run,
+            name="fstd-events",
+            daemon=True
+        )
+
+    def put(self, handler, kind, rel_path):
+        self._queue.put((handler, kind, rel_path, time.monotonic()))
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """ Applies events that are already queued and stops the worker."""
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def _next_batch(self):
+        item = self._queue.get()
+        if item is _STOP:
+            return None
+        batch = [item]
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get(timeout=self.debounce)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                self._queue.put(_STOP)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            fst.trace.trace("Applying a batch of %s events.", len(batch))
+            for handler, kind, rel_paths, queued in coalesce(batch):
+                self._apply(handler, kind, rel_paths, queued)
+
+    def _apply(self, handler, kind, rel_paths, queued):
+        template = handler.template["name"]
+        started = time.monotonic()
+        for queued_at in queued:
+            self.metrics.observe(
+                "fstd_queue_wait_seconds", started - queued_at,
+                template=template
+            )
+        try:
+            getattr(handler, "apply_" + kind)(rel_paths)
+        except Exception:
+            self.metrics.inc("fstd_errors_total", template=template)
+            fst.trace.exception(
+                "Applying %s events %r failed.", kind, rel_paths
+            )
+        finished = time.monotonic()
+        for queued_at in queued:
+            self.metrics.observe(
+                "fstd_propagation_seconds", finished - queued_at,
+                template=template
+            )
+        self.metrics.inc(
+            "fstd_events_total", len(queued), template=template, kind=kind
+        )
+
+
+def coalesce(batch):
+    """ Groups (handler, kind, rel_path, queued_at) events into
+    (handler, kind, rel_paths, queued) where queued holds the queueing times
+    of the grouped events.
+
+    Handlers are independent of each other so all events of a handler are
+    grouped together while consecutive events of the same kind are merged
+    keeping their order. Created and deleted directories are reduced to the
+    roots of the created or deleted subtrees and moves of directories to the
+    moves of the outermost ones.
+    """
+    by_handler = {}
+    for handler, kind, rel_path, queued_at in batch:
+        runs = by_handler.setdefault(handler, [])
+        if runs and runs[-1][0] == kind:
+            runs[-1][1].append(rel_path)
+            runs[-1][2].append(queued_at)
+        else:
+            runs.append((kind, [rel_path], [queued_at]))
+    return [
+        (handler, kind, _reduce(kind, rel_paths), queued)
+        for handler, runs in by_handler.items()
+        for kind, rel_paths, queued in runs
+    ]
+
+
+def _reduce(kind, rel_paths):
+    if kind in _SUBTREE_KINDS:
+        return subtree_roots(rel_paths)
+    if kind == "moved":
+        return outer_moves(rel_paths)
+    return rel_paths
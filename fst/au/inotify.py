@@ -0,0 +1,379 @@
+"""
+Native inotify observer that only watches for directory changes.
+
+It has the same schedule/unschedule/start/stop/join interface as the watchdog
+observers and dispatches the same event classes, but subscribes only to the
+events that can change the structure of a tree. File events that still arrive
+(creations and deletions share their mask with directories) are dropped before
+any event object is made.
+
+Handlers with a true propagate_files attribute also get a FileModifiedEvent
+when a file written in their tree is closed and a FileCreatedEvent when one is
+moved into it.
+
+Events can be lost when the kernel's queue overflows, when a directory can't
+be watched or when handling a batch fails. Handlers that have an
+on_lost_events(reason) method are then called with "overflow" or
+"watch_error" so that they can rescan their tree.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import os.path
+import select
+import struct
+import threading
+
+import watchdog.events
+
+import fst.dirdiff
+import fst.trace
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_MASK_ADD = 0x20000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+# added to the mask of directories watched for handlers that want file events
+FILE_MASK = IN_CLOSE_WRITE
+
+MAX_USER_WATCHES_PATH = "/proc/sys/fs/inotify/max_user_watches"
+# warn once this fraction of max_user_watches is used by the daemon
+WATCH_HEADROOM_WARNING = 0.9
+READ_SIZE = 256 * 1024
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32
+        ]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        _libc = libc
+    return _libc
+
+
+def available():
+    try:
+        return hasattr(_load_libc(), "inotify_init1")
+    except OSError:
+        return False
+
+
+def max_user_watches():
+    try:
+        with open(MAX_USER_WATCHES_PATH) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def _check(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+class Watch:
+    """ A scheduled handler for a path and the descriptors it uses."""
+
+    def __init__(self, handler, path, recursive):
+        self.handler = handler
+        self.path = path
+        self.is_recursive = recursive
+        # directories the handler ignores aren't watched
+        self.ignore = getattr(handler, "ignore", None)
+        self.files = bool(getattr(handler, "propagate_files", None))
+        self.wds = set()
+
+    def __repr__(self):
+        return "<Watch path={} watches={}>".format(self.path, len(self.wds))
+
+
+class InotifyObserver(threading.Thread):
+    def __init__(self):
+        super().__init__(name="fstd-inotify", daemon=True)
+        self._fd = _check(_load_libc().inotify_init1(IN_CLOEXEC))
+        self._stop_read, self._stop_write = os.pipe()
+        self._lock = threading.RLock()
+        # wd -> path of the watched directory
+        self._paths = {}
+        # wd -> Watch objects that want its events
+        self._watchers = {}
+        self._max_watches = max_user_watches()
+
+    def watch_count(self, watch=None):
+        """ Returns the number of kernel watches a Watch or all of them use."""
+        with self._lock:
+            if watch is None:
+                return len(self._paths)
+            return len(watch.wds)
+
+    def schedule(self, event_handler, path, recursive=False):
+        path = os.path.abspath(path)
+        watch = Watch(event_handler, path, recursive)
+        with self._lock:
+            self._add_tree(watch, path)
+        self._check_headroom()
+        return watch
+
+    def rewatch(self, watch, rel_paths):
+        """ Watches directories of a Watch's tree given relative to its path,
+        e.g. those created while events were lost.
+
+        Nothing is walked - the subdirectories that need watches must be
+        given as well. Directories that are already watched keep their watch
+        under their current path, which also corrects the path of ones that
+        were moved. Returns the relative paths that weren't watched before.
+        """
+        added = []
+        watched = True
+        with self._lock:
+            for rel_path in rel_paths:
+                path = os.path.join(watch.path, rel_path) if rel_path \
+                    else watch.path
+                count = len(watch.wds)
+                watched &= self._add_watch(watch, path)
+                if len(watch.wds) > count:
+                    added.append(rel_path)
+            if not watched:
+                self._lost_events("watch_error", [watch])
+        self._check_headroom()
+        return added
+
+    def unschedule(self, watch):
+        with self._lock:
+            for wd in list(watch.wds):
+                self._drop(watch, wd)
+
+    def unschedule_all(self):
+        with self._lock:
+            for watchers in list(self._watchers.values()):
+                for watch in list(watchers):
+                    self.unschedule(watch)
+
+    def stop(self):
+        os.write(self._stop_write, b"x")
+
+    def run(self):
+        try:
+            while True:
+                readable, _, _ = select.select(
+                    [self._fd, self._stop_read], [], []
+                )
+                if self._stop_read in readable:
+                    return
+                try:
+                    data = os.read(self._fd, READ_SIZE)
+                except InterruptedError:
+                    continue
+                with self._lock:
+                    try:
+                        self._handle_batch(data)
+                    except Exception:
+                        fst.trace.exception("Handling inotify events failed.")
+                        self._lost_events("watch_error")
+        finally:
+            os.close(self._fd)
+            os.close(self._stop_read)
+            os.close(self._stop_write)
+
+    def _check_headroom(self):
+        if not self._max_watches:
+            return
+        used = self.watch_count()
+        if used >= self._max_watches * WATCH_HEADROOM_WARNING:
+            fst.trace.warn(
+                "Using %s of %s inotify watches (%s). Raise it for large "
+                "templates.",
+                used,
+                self._max_watches,
+                MAX_USER_WATCHES_PATH
+            )
+
+    def _lost_events(self, reason, watches=None):
+        """ Tells the handlers of :watches: - all by default - that some of
+        their events were lost."""
+        if watches is None:
+            watches = set()
+            for watchers in self._watchers.values():
+                watches.update(watchers)
+        for watch in watches:
+            on_lost_events = getattr(watch.handler, "on_lost_events", None)
+            if on_lost_events:
+                on_lost_events(reason)
+
+    def _add_watch(self, watch, path):
+        """ Watches a directory for a Watch. Returns False if it couldn't be
+        watched for a reason other than it being gone."""
+        try:
+            # watches are shared between handlers so masks are only ever
+            # widened - one without file events must keep another's
+            mask = WATCH_MASK | IN_MASK_ADD | (FILE_MASK if watch.files else 0)
+            wd = _check(_load_libc().inotify_add_watch(
+                self._fd, os.fsencode(path), mask
+            ))
+        except OSError as exc:
+            if exc.errno == errno.ENOSPC:
+                fst.trace.error(
+                    "Out of inotify watches (%s is %s). %s is not watched.",
+                    MAX_USER_WATCHES_PATH,
+                    self._max_watches,
+                    path
+                )
+                return False
+            elif exc.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            return True
+        self._paths[wd] = path
+        self._watchers.setdefault(wd, set()).add(watch)
+        watch.wds.add(wd)
+        return True
+
+    def _add_tree(self, watch, path):
+        ignore = watch.ignore
+        if (ignore and path != watch.path and
+                ignore.match(os.path.basename(path))):
+            return
+        watched = self._add_watch(watch, path)
+        if watch.is_recursive:
+            try:
+                for rel_path in fst.dirdiff.flattened_subdirs(
+                        path, ignore=ignore):
+                    watched &= self._add_watch(
+                        watch, os.path.join(path, rel_path)
+                    )
+            except OSError:
+                # removed while being walked - its events will follow
+                fst.trace.trace("Could not walk %s for watches.", path)
+        if not watched:
+            self._lost_events("watch_error", [watch])
+
+    def _drop(self, watch, wd):
+        watch.wds.discard(wd)
+        watchers = self._watchers.get(wd)
+        if watchers is None:
+            return
+        watchers.discard(watch)
+        if not watchers:
+            del self._watchers[wd]
+            del self._paths[wd]
+            # fails with EINVAL if the kernel already dropped it
+            _load_libc().inotify_rm_watch(self._fd, wd)
+
+    def _forget(self, wd):
+        for watch in self._watchers.pop(wd, ()):
+            watch.wds.discard(wd)
+        self._paths.pop(wd, None)
+
+    def _dispatch(self, wd, event):
+        for watch in list(self._watchers.get(wd, ())):
+            watch.handler.dispatch(event)
+
+    def _dispatch_file(self, wd, event):
+        for watch in list(self._watchers.get(wd, ())):
+            if watch.files:
+                watch.handler.dispatch(event)
+
+    def _events(self, data):
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            yield wd, mask, cookie, os.fsdecode(name)
+
+    def _handle_batch(self, data):
+        moved_from = {}
+        for wd, mask, cookie, name in self._events(data):
+            if mask & IN_Q_OVERFLOW:
+                fst.trace.error("inotify event queue overflowed.")
+                self._lost_events("overflow")
+                continue
+            if mask & IN_IGNORED:
+                self._forget(wd)
+                continue
+            if wd not in self._paths:
+                continue
+            path = os.path.join(self._paths[wd], name)
+            if not mask & IN_ISDIR:
+                if mask & IN_CLOSE_WRITE:
+                    self._dispatch_file(
+                        wd, watchdog.events.FileModifiedEvent(path)
+                    )
+                elif mask & IN_MOVED_TO:
+                    self._dispatch_file(
+                        wd, watchdog.events.FileCreatedEvent(path)
+                    )
+                continue
+
+            if mask & IN_CREATE:
+                self._created(wd, path)
+            elif mask & IN_DELETE:
+                self._dispatch(wd, watchdog.events.DirDeletedEvent(path))
+            elif mask & IN_MOVED_FROM:
+                moved_from[cookie] = (wd, path)
+            elif mask & IN_MOVED_TO:
+                if cookie in moved_from:
+                    src_wd, src_path = moved_from.pop(cookie)
+                    self._moved(src_wd, src_path, wd, path)
+                else:
+                    self._created(wd, path)
+
+        # the other half of these moves is outside any watched tree
+        for wd, path in moved_from.values():
+            self._remove_prefix(path)
+            self._dispatch(wd, watchdog.events.DirDeletedEvent(path))
+
+    def _created(self, wd, path):
+        for watch in list(self._watchers.get(wd, ())):
+            if watch.is_recursive:
+                self._add_tree(watch, path)
+        self._dispatch(wd, watchdog.events.DirCreatedEvent(path))
+
+    def _moved(self, src_wd, src_path, dest_wd, dest_path):
+        if self._watchers.get(src_wd) != self._watchers.get(dest_wd):
+            # moved between trees that aren't watched by the same handlers
+            self._remove_prefix(src_path)
+            self._dispatch(src_wd, watchdog.events.DirDeletedEvent(src_path))
+            self._created(dest_wd, dest_path)
+            return
+
+        prefix = src_path + os.sep
+        for moved_wd, path in list(self._paths.items()):
+            if path == src_path:
+                self._paths[moved_wd] = dest_path
+            elif path.startswith(prefix):
+                self._paths[moved_wd] = dest_path + path[len(src_path):]
+        self._dispatch(
+            src_wd,
+            watchdog.events.DirMovedEvent(src_path, dest_path)
+        )
+
+    def _remove_prefix(self, src_path):
+        prefix = src_path + os.sep
+        for wd, path in list(self._paths.items()):
+            if path == src_path or path.startswith(prefix):
+                for watch in list(self._watchers.get(wd, ())):
+                    self._drop(watch, wd)
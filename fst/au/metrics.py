@@ -0,0 +1,141 @@
+"""
+Counters and latency histograms of the auto update daemon in the Prometheus
+text format.
+
+Metrics are labelled by template. The daemon writes them to a file that can be
+picked up by the node exporter's textfile collector or read directly.
+"""
+import bisect
+import collections
+import threading
+
+import fst.atomic
+
+# latency buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# name -> (type, help)
+DESCRIPTIONS = collections.OrderedDict([
+    ("fstd_events_total",
+     ("counter", "Template events applied by kind.")),
+    ("fstd_mkdirs_total",
+     ("counter", "Directories created in instances.")),
+    ("fstd_files_copied_total",
+     ("counter", "Template files copied into instances by method.")),
+    ("fstd_files_skipped_total",
+     ("counter", "Template files that were already current in instances.")),
+    ("fstd_errors_total",
+     ("counter", "Failures to apply an event to an instance.")),
+    ("fstd_resync_requests_total",
+     ("counter", "Rescans of a template asked for after events may have "
+                 "been lost, by reason.")),
+    ("fstd_resyncs_total",
+     ("counter", "Rescans of a template done to recover lost events.")),
+    ("fstd_resync_listed_total",
+     ("counter", "Directories listed by rescans. The rest were pruned by "
+                 "their mtime.")),
+    ("fstd_queue_depth",
+     ("gauge", "Events waiting to be applied.")),
+    ("fstd_queue_wait_seconds",
+     ("histogram", "Time from queueing an event to handling it.")),
+    ("fstd_propagation_seconds",
+     ("histogram", "Time from queueing an event to the last instance "
+                   "being updated.")),
+    ("fstd_resync_seconds",
+     ("histogram", "Time a rescan of a template took.")),
+])
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in pairs
+    ) + "}"
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = collections.defaultdict(float)
+        self._histograms = {}
+        self._gauges = {}
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[name, _labels(labels)] += value
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(value)
+
+    def gauge(self, name, func):
+        """ Sets a gauge whose value is read from func at render time."""
+        self._gauges[name] = func
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (kind, help_text) in DESCRIPTIONS.items():
+                lines.append("# HELP {} {}".format(name, help_text))
+                lines.append("# TYPE {} {}".format(name, kind))
+                if name in self._gauges:
+                    lines.append("{} {}".format(name, self._gauges[name]()))
+                for (counter, labels), value in sorted(self._counters.items()):
+                    if counter == name:
+                        lines.append("{}{} {:g}".format(
+                            name, _format_labels(labels), value
+                        ))
+                for (histogram_name, labels), histogram in sorted(
+                        self._histograms.items(), key=lambda item: item[0]):
+                    if histogram_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets,
+                                            histogram.counts):
+                        cumulative += count
+                        le = ("le", "{:g}".format(bound))
+                        lines.append("{}_bucket{} {}".format(
+                            name, _format_labels(labels, [le]), cumulative
+                        ))
+                    lines.append("{}_bucket{} {}".format(
+                        name,
+                        _format_labels(labels, [("le", "+Inf")]),
+                        histogram.count
+                    ))
+                    lines.append("{}_sum{} {:g}".format(
+                        name, _format_labels(labels), histogram.sum
+                    ))
+                    lines.append("{}_count{} {}".format(
+                        name, _format_labels(labels), histogram.count
+                    ))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """ Atomically writes the metrics to path."""
+        with fst.atomic.open_atomic(path) as f:
+            f.write(self.render())
@@ -1,12 +1,23 @@
 """
 Module wrapper of the watchdog lib.
+
+The observer is the native inotify one where it's available unless the
+watch_backend option in the au config is set to "watchdog".
 """
 
 import watchdog.observers
 import watchdog.events
 
+import fst.au.inotify
+from fst.config import CONFIG
+
+
+BACKEND = CONFIG['au'].get('watch_backend', 'inotify')
 
-Observer = watchdog.observers.Observer
+if BACKEND == 'inotify' and fst.au.inotify.available():
+    Observer = fst.au.inotify.InotifyObserver
+else:
+    Observer = watchdog.observers.Observer
 FileSystemEventHandler = watchdog.events.FileSystemEventHandler
 
 FileSystemEvent = watchdog.events.FileSystemEvent
@@ -1,16 +1,26 @@
 import argparse
+import collections
+import glob
+import json
 import sqlite3
 import os
 import sys
 import functools
+import time
 
 import fst.conform
 import fst.db
 import fst.dirdiff
+import fst.ignore
+import fst.listcache
+import fst.rels
 import fst.tmpl
+from fst.config import CONFIG
 from fst.err import *
 from fst.trace import trace, info, warn, error
 
+DEFAULT_JOBS = 8
+
 
 def add(cursor, templates, instances, args):
     fst.tmpl.add_template(
@@ -34,18 +44,127 @@ def connect(cursor, templates, instances, args):
         "template {} does not exist.".format(args.template),
         "CLI-USR-CON-001"
     )
+    progress = ConformProgress(args.connect)
     fst.tmpl.connect(
         cursor=cursor,
         instance_path=args.connect,
-        template=templates[0]
+        template=templates[0],
+        progress=progress
+    )
+    if progress:
+        progress.finish()
+
+
+class ConformProgress:
+    """ Reports the progress of conforming a directory on stderr while it's
+    a terminal. Instances are falsy otherwise and shouldn't be passed on."""
+
+    # seconds between two reports
+    interval = 0.1
+
+    def __init__(self, path):
+        self.path = path
+        self.enabled = sys.stderr.isatty()
+        self.done = 0
+        self._last = 0
+
+    def __bool__(self):
+        return self.enabled
+
+    def __call__(self, done, total):
+        self.done = done
+        now = time.perf_counter()
+        if now - self._last >= self.interval:
+            self._last = now
+            self._write(total)
+
+    def _write(self, total):
+        of = "/{}".format(total) if total else ""
+        print("\rConforming {}: {}{} directories".format(
+            self.path, self.done, of
+        ), end="", file=sys.stderr, flush=True)
+
+    def finish(self):
+        self._write(None)
+        print("", file=sys.stderr)
+
+
+def connect_many(cursor, templates, instances, args):
+    assert_user(
+        len(templates) == 1,
+        "template {} does not exist.".format(args.template),
+        "CLI-USR-CON-001"
+    )
+    paths = read_instance_paths(args.connect_many)
+    fst.tmpl.connect_many(
+        cursor=cursor,
+        instance_paths=paths,
+        template=templates[0],
+        jobs=args.jobs
+    )
+    print("Connected {} instance(s) to {}.".format(
+        len(paths), templates[0]['name']
+    ))
+
+
+def read_instance_paths(source):
+    """ Returns the unique absolute paths named by a --connect-many source.
+
+    A source is '-' for one path per line on stdin, '@FILE' for one per line
+    in FILE or otherwise a glob pattern.
+    """
+    if source == '-':
+        lines = sys.stdin.read().splitlines()
+    elif source.startswith('@'):
+        try:
+            with open(source[1:]) as f:
+                lines = f.read().splitlines()
+        except OSError as exc:
+            assert_user(
+                0,
+                "could not read {} ({})".format(source[1:], exc.strerror),
+                "CLI-USR-CON-002",
+                from_exc=exc
+            )
+    else:
+        lines = sorted(glob.glob(os.path.expanduser(source)))
+    paths = collections.OrderedDict()
+    for line in lines:
+        if line:
+            paths[os.path.abspath(line)] = None
+    return list(paths)
+
+
+def ignore(cursor, templates, instances, args):
+    assert_user(
+        len(templates) == 1,
+        "template {} does not exist.".format(args.template),
+        "CLI-USR-IGN-001"
+    )
+    fst.tmpl.ignore(
+        cursor=cursor,
+        template=templates[0],
+        patterns=args.ignore
+    )
+
+
+def unignore(cursor, templates, instances, args):
+    assert_user(
+        len(templates) == 1,
+        "template {} does not exist.".format(args.template),
+        "CLI-USR-IGN-001"
+    )
+    fst.tmpl.unignore(
+        cursor=cursor,
+        template=templates[0],
+        patterns=args.unignore
     )
 
 
 def disconnect(cursor, templates, instances, args):
     fst.tmpl.disconnect(
         cursor=cursor,
-        instance=args.instance,
-        template=args.template
+        instance=args.disconnect
     )
 
 
@@ -53,6 +172,7 @@ def list_command(cursor, templates, instances, args):
     print_struct = 'struct' in args.list
     print_conformity = 'status' in args.list
     print_relationships = 'rel' in args.list
+    print_ignored = 'ignore' in args.list
     info('Executing list command with flags: print_struct=%s '
          'print_conformity=%s print_relationships=%s',
          print_struct,
@@ -66,7 +186,10 @@ def list_command(cursor, templates, instances, args):
             instances=instances,
             print_struct = print_struct,
             print_conformity = print_conformity,
-            print_relationships=print_relationships
+            print_relationships=print_relationships,
+            print_ignored=print_ignored,
+            jobs=args.jobs,
+            json_lines=args.json
         )
     elif args.instance:
         assert len(templates) == 1
@@ -86,32 +209,178 @@ def list_command(cursor, templates, instances, args):
             instances=instances,
             print_struct=print_struct,
             print_conformity=print_conformity,
-            print_relationships=print_relationships
+            print_relationships=print_relationships,
+            jobs=args.jobs,
+            json_lines=args.json
         )
 
 
 def update(cursor, templates, instances, args):
+    pairs = []
     for t in templates:
-        children = [i for i in instances if i['template_id'] == t['id']]
-        for child in children:
-            fst.conform.conform_dir_to_template(
-                dir_path=child['path'],
-                template_path=t['path']
-            )
+        tree = fst.tmpl.template_tree(cursor, t)
+        pairs.extend((child['path'], tree) for child in t['instances'])
+
+    results = fst.conform.conform_dirs(pairs, jobs=args.jobs)
+    failed = print_update_results(results)
+    assert_user(
+        not failed,
+        "{} instance(s) failed to update".format(failed),
+        "CLI-USR-UPD-001"
+    )
+    if not args.files:
+        return
+    # only imported when files are synced
+    import fst.files
+
+    triples = []
+    for t in templates:
+        rules = fst.ignore.pull_rules(cursor, t['id'])
+        triples.extend(
+            (child['path'], t['path'], rules) for child in t['instances']
+        )
+    print("")
+    results = fst.files.sync_instances(triples, args.files, jobs=args.jobs)
+    failed = print_update_results(results, column="copied")
+    assert_user(
+        not failed,
+        "{} instance(s) failed to get the template files".format(failed),
+        "CLI-USR-UPD-002"
+    )
+
+def hook(cursor, templates, instances, args):
+    # subprocess and the pool are only imported when a hook runs
+    import fst.hooks
+
+    assert_user(
+        instances,
+        "no instances to run the hook in",
+        "CLI-USR-HOK-001"
+    )
+    by_id = {t['id']: t for t in templates}
+    # a single argument is a shell command line, e.g. --hook 'make && ls'
+    command = args.hook[0] if len(args.hook) == 1 else args.hook
+    results = fst.hooks.run_hooks(
+        command,
+        ((by_id[i['template_id']], i['path']) for i in instances),
+        jobs=args.jobs,
+        timeout=args.hook_timeout
+    )
+    failed = print_hook_results(list(results))
+    assert_user(
+        not failed,
+        "hook failed in {} of {} instance(s)".format(failed, len(instances)),
+        "CLI-USR-HOK-002"
+    )
+
 
 COMMANDS = {
     "add": add,
     "remove": remove,
     "connect": connect,
+    "connect_many": connect_many,
     "disconnect": disconnect,
+    "ignore": ignore,
+    "unignore": unignore,
     "list": list_command,
-    "update": update
+    "update": update,
+    "hook": hook
 }
 
 
+def print_statuses(template, instances, statuses, json_lines, indent=""):
+    """ Prints the conformity of instances as their statuses arrive."""
+    for instance, status in zip(instances, statuses):
+        if json_lines:
+            line = json.dumps({
+                "template": template['name'],
+                "instance": instance['path'],
+                "conformed": status.conformed,
+                "elapsed": round(status.elapsed, 6),
+                "error": status.error and str(status.error),
+            })
+        else:
+            if status.error:
+                label = 'ERROR ({})'.format(status.error)
+            else:
+                label = 'OK' if status.conformed else 'NOT OK'
+            line = "{}{} -> {} ({:.3f}s)".format(
+                indent, instance['path'], label, status.elapsed
+            )
+        print(line, flush=True)
+
+
+def print_hook_results(results):
+    """ Prints the exit status of the hook in every instance and a summary.
+    Returns the number of instances in which it failed."""
+    row = "{:<60} {:>6} {:>9}  {}"
+    print("")
+    print(row.format("INSTANCE", "EXIT", "TIME", "STATUS"))
+    failed = timed_out = 0
+    for result in results:
+        if result.error:
+            status = 'ERROR ({})'.format(result.error)
+        elif result.timed_out:
+            timed_out += 1
+            status = 'TIMEOUT'
+        elif result.returncode:
+            status = 'FAILED'
+        else:
+            status = 'OK'
+        if status != 'OK':
+            failed += 1
+        print(row.format(
+            result.path,
+            '-' if result.returncode is None else result.returncode,
+            "{:.3f}s".format(result.elapsed),
+            status
+        ))
+    print("TOTAL {} ok, {} failed ({} timed out) of {}".format(
+        len(results) - failed, failed, timed_out, len(results)
+    ))
+    return failed
+
+
+def print_update_results(results, column="created"):
+    """ Prints a table row per instance as results arrive and a summary at the
+    end. :column: is the field of the results with the changed paths.
+    Returns the number of failed instances."""
+    row = "{:<60} {:>8} {:>9}  {}"
+    print(row.format("INSTANCE", column.upper(), "TIME", "STATUS"),
+          flush=True)
+    count = failed = created = 0
+    start = time.perf_counter()
+    for result in results:
+        count += 1
+        changed = getattr(result, column)
+        created += len(changed)
+        if result.error:
+            failed += 1
+            error("Updating instance %s failed.", result.path,
+                  exc_info=result.error)
+            status = 'ERROR ({})'.format(result.error)
+        else:
+            status = 'OK'
+        print(row.format(
+            result.path,
+            len(changed),
+            "{:.3f}s".format(result.elapsed),
+            status
+        ), flush=True)
+    print(row.format(
+        "TOTAL ({} failed of {})".format(failed, count),
+        created,
+        "{:.3f}s".format(time.perf_counter() - start),
+        ''
+    ))
+    return failed
+
+
 def print_template_info(cursor, template, instances, print_struct,
-                        print_conformity, print_relationships):
-    flag_count = sum([print_struct, print_conformity, print_relationships])
+                        print_conformity, print_relationships,
+                        print_ignored=False, jobs=1, json_lines=False):
+    flag_count = sum([print_struct, print_conformity, print_relationships,
+                      print_ignored])
     multiple_flags = flag_count > 0
     if print_relationships:
         if multiple_flags:
@@ -120,103 +389,130 @@ def print_template_info(cursor, template, instances, print_struct,
             print(i['path'])
         print("")
     if print_conformity:
-        if multiple_flags:
+        if multiple_flags and not json_lines:
             print("Status of relationships:")
-        for i in instances:
-            conformed = fst.dirdiff.is_subset(template['path'], i['path'])
-            status = {
-                True: 'OK',
-                False: 'NOT OK'
-            }
-            print("{} -> {}".format(i['path'], status[conformed]))
-        print("")
+        tree = fst.tmpl.template_tree(cursor, template)
+        statuses = fst.conform.check_conformity(
+            ((i['path'], tree) for i in instances),
+            jobs=jobs
+        )
+        print_statuses(template, instances, statuses, json_lines)
+        if not json_lines:
+            print("")
     if print_struct:
         if multiple_flags:
             print("Structure:")
-        for path in fst.fst.dirdiff.flattened_subdirs(template['path']):
+        rules = fst.ignore.pull_rules(cursor, template['id'])
+        for path in fst.dirdiff.iter_subdirs(template['path'], ignore=rules):
             print(path)
         print("")
+    if print_ignored:
+        if multiple_flags:
+            print("Ignored:")
+        for pattern in fst.ignore.pull_rules(cursor, template['id']).patterns:
+            print(pattern)
+        print("")
 
 
 def print_instance_info(cursor, instance, template, print_conformity,
                         print_struct, print_relationships):
     if print_conformity:
-        if fst.dirdiff.is_subset(instance['path'], template['path']):
+        tree = fst.tmpl.template_tree(cursor, template)
+        if fst.conform.is_conformed(instance['path'], tree):
             print("OK")
         else:
             print("NOT OK")
     if print_struct:
-        for path in fst.dirdiff.flattened_subdirs(instance['path']):
+        rules = fst.ignore.pull_rules(cursor, template['id'])
+        for path in fst.dirdiff.iter_subdirs(instance['path'], ignore=rules):
             print(path)
 
 
 def print_all_info(cursor, templates, instances, print_conformity, print_struct,
-                   print_relationships):
+                   print_relationships, jobs=1, json_lines=False):
     fst.trace.info('Printing all info')
+    trees = {t['id']: fst.tmpl.template_tree(cursor, t) for t in templates}
+    # one pool for all templates so that templates with few instances
+    # don't leave it idle
+    statuses = fst.conform.check_conformity(
+        (
+            (i['path'], trees[t['id']])
+            for t in templates for i in t['instances']
+        ),
+        jobs=jobs
+    )
     for t in templates:
-        instances_info = []
-        for instance in instances:
-            if(instance['template_id'] == t['id']):
-                is_conformed = fst.dirdiff.is_subset(instance['path'], t['path'])
-                conformity_status = 'OK' if is_conformed else 'NOT OK'
-                instances_info.append(
-                    '{}({})'.format(instance['path'], conformity_status)
-                )
+        if not json_lines:
+            print("{} ({}) ->".format(t['name'], t['path']), flush=True)
+        print_statuses(t, t['instances'], statuses, json_lines, indent="    ")
 
-        print("{} ({}) -> {}".format(
-            t['name'],
-            t['path'],
-            ' : '.join(instances_info))
+
+def print_template_path(template):
+    """ Prints the path of a template given its name or path and returns
+    whether it exists.
+
+    Only a read-only connection to the db is opened so nothing is created,
+    logged or walked, which keeps `cd "$(fst -t music -p)"` instant.
+    """
+    try:
+        conn = fst.db.connect_readonly(fst.db.DB_PATH)
+    except sqlite3.OperationalError:
+        return False
+    try:
+        row = conn.execute(
+            "SELECT path FROM templates WHERE (name=? OR path=?) AND active=1",
+            [template, template]
+        ).fetchone()
+    except sqlite3.OperationalError:
+        # the schema was never created
+        row = None
+    finally:
+        conn.close()
+    if row:
+        print(row['path'])
+    return row is not None
+
+
+def walks_directories(args):
+    """ Returns whether the command line runs a command that lists
+    directories, the only ones the listing cache is loaded for."""
+    if args.add or args.connect or args.connect_many or args.update:
+        return True
+    if not args.list:
+        return False
+    # without a template or an instance every template is walked
+    return (not (args.template or args.instance) or
+            'struct' in args.list or 'status' in args.list)
+
+
+def load_listing_cache():
+    """ Sets the listing cache of fst.dirdiff from the configured file and
+    returns its path or None if it isn't configured."""
+    path = CONFIG['fstctl'].get('listing_cache')
+    if not path:
+        return None
+    fst.dirdiff.listing_cache = fst.listcache.ListingCache.load(
+        path,
+        max_entries=CONFIG['fstctl'].get(
+            'listing_cache_size',
+            fst.listcache.DEFAULT_MAX_ENTRIES
         )
+    )
+    return path
 
 
-def pull_relationships(cursor, template, instance):
-    pull_all = not template and not instance
-    cursor.execute(
-        """
-        SELECT
-            T.id AS t_id,
-            T.name AS t_name,
-            T.path AS t_path,
-            T.checksum AS t_checksum,
-            T.active AS t_active,
-            I.id AS i_id,
-            I.path AS i_path,
-            I.template_id AS i_template_id,
-            I.active AS i_active
-        FROM templates AS T
-        LEFT JOIN instances AS I ON T.id=I.template_id
-        WHERE
-            T.active=1 AND
-            (I.active=1 OR I.active IS NULL) AND
-            (T.path = ?  OR T.name = ?  OR I.path = ? OR true=?)
-        """,
-        [template, template, instance, pull_all],
-    )
-    templates = []
-    instances = []
-    for row in cursor.fetchall():
-        template = {
-            col[2:]: row[col]
-            for col in row.keys() if col.startswith("t_")
-        }
-        instance = {
-            col[2:]: row[col]
-            for col in row.keys() if col.startswith("i_")
-        }
-        if all(template['id'] != t['id'] for t in templates):
-            templates.append(template)
-        if instance and instance['id'] is not None:
-            for other_instance in instances:
-                assert other_instance["id"] != instance["id"]
-            instances.append(instance)
-    trace("Templates: %r", templates)
-    trace("Instances: %r", instances)
-
-    return {
-        'templates': templates,
-        'instances': instances
-    }
+def save_listing_cache(path):
+    """ Saves the listing cache of fst.dirdiff unless nothing was added to
+    it."""
+    cache = fst.dirdiff.listing_cache
+    trace("Listing cache hits=%s misses=%s added=%s",
+          cache.hits, cache.misses, cache.added)
+    if not cache.added:
+        return
+    try:
+        cache.save(path)
+    except OSError:
+        warn("Could not save listing cache to %s.", path, exc_info=True)
 
 
 def main():
@@ -236,7 +532,7 @@ def main():
     parser.add_argument(
         "-l",
         "--list",
-        choices=["struct", "status", "rel"],
+        choices=["struct", "status", "rel", "ignore"],
         action="append",
         help="List structure.",
     )
@@ -259,6 +555,28 @@ def main():
             "Connects a template to a path. The -t argument provides the"
             " template. This flag's argument must be path to an instance."),
     )
+    parser.add_argument(
+        "--connect-many",
+        metavar="SOURCE",
+        help=(
+            "Connects many paths to the template at once. SOURCE is a glob"
+            " pattern, '@FILE' for a file with one path per line or '-' to"
+            " read them from stdin."),
+    )
+    parser.add_argument(
+        "--ignore",
+        metavar="PATTERN",
+        action="append",
+        help=(
+            "Ignore directories whose name matches a shell pattern (e.g."
+            " .git or node_modules) in the template and its instances."),
+    )
+    parser.add_argument(
+        "--unignore",
+        metavar="PATTERN",
+        action="append",
+        help="Stop ignoring a pattern added with --ignore.",
+    )
     parser.add_argument(
         "-d",
         "--disconnect",
@@ -272,20 +590,76 @@ def main():
         "are updated. Otherwise if it's an instance it alone"
         "is updated to it's template.",
     )
+    parser.add_argument(
+        "--files",
+        nargs="?",
+        const="copy",
+        choices=["copy", "hardlink"],
+        default=CONFIG['fstctl'].get('propagate_files'),
+        help=(
+            "With -u also copy the template's files into the instances."
+            " Files that are already current are skipped. 'hardlink' links"
+            " them instead where possible."),
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=DEFAULT_JOBS,
+        help="Number of instances to check or update concurrently.",
+    )
+    parser.add_argument(
+        "--json",
+        action='store_true',
+        help="List the status of instances as JSON lines.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action='store_true',
+        help="Read every directory instead of using the listing cache.",
+    )
+    parser.add_argument(
+        "-p",
+        "--path",
+        action='store_true',
+        help="Print the path of the template and exit.",
+    )
+    parser.add_argument(
+        "--hook-timeout",
+        type=float,
+        metavar="SECONDS",
+        default=CONFIG['fstctl'].get('hook_timeout'),
+        help="Terminate a hook that runs longer than this in an instance.",
+    )
     parser.add_argument(
         "--hook",
         nargs=argparse.REMAINDER,
-        help="Execute a command hook.",
+        help=(
+            "Run the rest of the command line in every instance, --jobs at a"
+            " time. A single argument is run by the shell. Must come last."),
     )
 
     args = parser.parse_args()
+    if args.path:
+        if not args.template:
+            parser.error("-p needs a template (-t).")
+        if not print_template_path(args.template):
+            print("Error: template {} does not exist. (CLI-USR-PTH-001)"
+                  .format(args.template), file=sys.stderr)
+            sys.exit(1)
+        return
+
     trace("Command line args: %r", args)
     if not (args.template or args.instance) and not args.list:
         parser.error("A template or instance needs to be specified.")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1.")
+    if args.hook is not None and not "".join(args.hook).strip():
+        parser.error("--hook needs a command.")
 
     try:
-        cursor = fst.db.conn.cursor()
-        rels = pull_relationships(
+        cursor = fst.db.get_conn().cursor()
+        rels = fst.rels.pull(
             cursor,
             template=args.template,
             instance=args.instance
@@ -298,35 +672,41 @@ def main():
         parser.error('An unknown error occurred. Please view the logs and/or'
                      'submit a ticket with them.')
 
-    templates = rels['templates']
-    instances = rels['instances']
+    templates = rels.templates
+    instances = rels.instances
+    listing_cache_path = None
+    if not args.no_cache and walks_directories(args):
+        listing_cache_path = load_listing_cache()
 
-    for arg_name in vars(args):
-        if (arg_name in ("instance", "template") or
-            not getattr(args, arg_name, None)):
-            continue
-
-        try:
-            cursor.execute("BEGIN")
-            info("Command to run is: %s", arg_name)
-            COMMANDS[arg_name](
-                cursor=cursor,
-                instances=instances,
-                templates=templates,
-                args=args
-            )
-            cursor.execute("COMMIT")
-        except Exception as exc:
-            cursor.execute("ROLLBACK")
-            error("User command failed.", exc_info=exc)
-            msg = getattr(exc, "msg", 'Unknown error occurred.')
-            code = getattr(exc, "code", "CLIUNHANDLED")
-            print("Error: {} ({})".format(msg, code))
-            sys.exit(1)
-
-    if args.hook:
-        print("Error: Not implemented. (CLI002)", file=sys.stderr)
-        sys.exit(1)
+    try:
+        for arg_name in vars(args):
+            if (arg_name not in COMMANDS or
+                not getattr(args, arg_name, None)):
+                continue
+
+            try:
+                cursor.execute("BEGIN")
+                info("Command to run is: %s", arg_name)
+                COMMANDS[arg_name](
+                    cursor=cursor,
+                    instances=instances,
+                    templates=templates,
+                    args=args
+                )
+                cursor.execute("COMMIT")
+            except Exception as exc:
+                cursor.execute("ROLLBACK")
+                fst.tmpl.pending_notifications.clear()
+                error("User command failed.", exc_info=exc)
+                msg = getattr(exc, "msg", 'Unknown error occurred.')
+                code = getattr(exc, "code", "CLIUNHANDLED")
+                print("Error: {} ({})".format(msg, code))
+                sys.exit(1)
+            fst.tmpl.notify_au_daemon()
+
+    finally:
+        if listing_cache_path:
+            save_listing_cache(listing_cache_path)
 
 
 if __name__ == '__main__':
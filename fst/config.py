@@ -1,6 +1,6 @@
 import os
 import json
-import inspect
 
-FST_DIR = os.path.dirname(inspect.getfile(inspect.currentframe()))
-CONFIG = json.loads(open(os.path.join(FST_DIR, "config.json")).read())
+FST_DIR = os.path.dirname(os.path.abspath(__file__))
+with open(os.path.join(FST_DIR, "config.json")) as f:
+    CONFIG = json.load(f)
@@ -1,15 +1,84 @@
 import fst.dirdiff
+import collections
 import os
 import os.path
+import stat
 
+ConformityStatus = collections.namedtuple(
+    "ConformityStatus", ["path", "conformed", "elapsed", "error"]
+)
+UpdateResult = collections.namedtuple(
+    "UpdateResult", ["path", "created", "elapsed", "error"]
+)
 
-def copy_dir_tree(source_dir_path, destination_dir_path, destination_name):
-    relative_subdirs = fst.dirdiff.flattened_subdirs(source_dir_path)
+
+def materialize(root, rel_paths, progress=None):
+    """ Creates directories under root from a plan of relative paths.
+
+    Parents must come before their children in the plan - the sorted
+    pre-order of fst.dirdiff.iter_missing and missing_from is such. The plan
+    can be a stream and is consumed as it's produced. Every directory is
+    created with a single mkdir relative to an open descriptor of its parent
+    and descriptors stay open while their subtree is being created, so the
+    kernel never resolves a full path. Plans in pre-order keep every
+    descriptor open exactly once. Directories that already exist are skipped,
+    anything else in their place raises FileExistsError.
+
+    :progress: is called with the number of processed paths and their total
+    after every one of them. The total is None for plans without a length.
+    Returns the absolute paths that were created.
+    """
+    total = len(rel_paths) if hasattr(rel_paths, "__len__") else None
+    plan = (os.path.normpath(p).split(os.sep) for p in rel_paths)
+    created = []
+    # stack[i] is an fd of the directory at the first i components of the
+    # current path, stack[0] being root
+    stack = [fst.dirdiff.open_dir(root)]
+    opened = []
+    try:
+        for done, components in enumerate(plan, start=1):
+            parent = components[:-1]
+            common = 0
+            while (common < len(parent) and common < len(opened) and
+                   opened[common] == parent[common]):
+                common += 1
+            while len(opened) > common:
+                opened.pop()
+                os.close(stack.pop())
+            for name in parent[common:]:
+                stack.append(fst.dirdiff.open_dir(name, dir_fd=stack[-1]))
+                opened.append(name)
+
+            try:
+                os.mkdir(components[-1], dir_fd=stack[-1])
+                created.append(os.path.join(root, *components))
+            except FileExistsError:
+                st = os.stat(components[-1], dir_fd=stack[-1])
+                if not stat.S_ISDIR(st.st_mode):
+                    raise
+            if progress:
+                progress(done, total)
+    finally:
+        for fd in stack:
+            os.close(fd)
+    return created
+
+
+def _is_within(path, parent):
+    path = os.path.abspath(path)
+    parent = os.path.abspath(parent)
+    return os.path.commonpath([path, parent]) == parent
+
+
+def copy_dir_tree(source_dir_path, destination_dir_path, destination_name,
+                  progress=None):
+    relative_subdirs = fst.dirdiff.iter_subdirs(source_dir_path)
+    if _is_within(destination_dir_path, source_dir_path):
+        # streaming would walk into the copy while it's being made
+        relative_subdirs = list(relative_subdirs)
     root_path = os.path.join(destination_dir_path, destination_name)
     os.mkdir(root_path)
-    paths = [os.path.join(root_path, rel_path) for rel_path in relative_subdirs]
-    for path in paths:
-        os.mkdir(path)
+    paths = materialize(root_path, relative_subdirs, progress=progress)
     return [root_path, *paths]
 
 
@@ -17,13 +86,56 @@ def is_conformed(dir_path, template_path):
     return fst.dirdiff.is_subset(template_path, dir_path)
 
 
-def conform_dir_to_template(dir_path, template_path):
-    """ Finds the missing directories between directory and template and creates them."""
+def check_conformity(pairs, jobs):
+    """ Checks (dir_path, template_path) pairs on a pool of :jobs: threads.
+
+    A ConformityStatus is yielded for every pair in their order - see
+    fst.pool.ordered_map(). Directories that can't be read are reported
+    through the status' error instead of raising.
+    """
+    # the pool imports concurrent.futures, which slows down the startup of
+    # commands that never start one
+    import fst.pool
+
+    for result in fst.pool.ordered_map(
+            fst.pool.timed(lambda pair: is_conformed(*pair)), pairs, jobs):
+        yield ConformityStatus(
+            result.item[0], bool(result.value), result.elapsed, result.error
+        )
+
+
+def conform_dir_to_template(dir_path, template_path, progress=None):
+    """ Finds the missing directories between directory and template and
+    creates them.
+
+    :template_path: can also be a DirTree of the template's structure.
+    Returns the absolute paths of the created directories.
+    """
     dir_path = os.path.abspath(dir_path)
-    template_path = os.path.abspath(template_path)
-    missing_dirs = fst.dirdiff.missing_from(
-        target=dir_path, origin=template_path, append_to_target=True
+    if not isinstance(template_path, fst.dirdiff.DirTree):
+        template_path = os.path.abspath(template_path)
+    missing_dirs = fst.dirdiff.iter_missing(
+        target=dir_path, origin=template_path
     )
-    for dir_path in missing_dirs:
-        os.mkdir(dir_path)
-    return missing_dirs
+    if (not isinstance(template_path, fst.dirdiff.DirTree) and
+            _is_within(dir_path, template_path)):
+        # streaming would walk into the directories while they are made
+        missing_dirs = list(missing_dirs)
+    return materialize(dir_path, missing_dirs, progress=progress)
+
+
+def conform_dirs(pairs, jobs):
+    """ Conforms (dir_path, template_path) pairs on a pool of :jobs: threads.
+
+    An UpdateResult is yielded for every pair in their order. A failure to
+    conform one directory is reported through its result and doesn't stop
+    the others.
+    """
+    import fst.pool
+
+    for result in fst.pool.ordered_map(
+            fst.pool.timed(lambda pair: conform_dir_to_template(*pair)),
+            pairs, jobs):
+        yield UpdateResult(
+            result.item[0], result.value or [], result.elapsed, result.error
+        )
@@ -2,22 +2,63 @@ import sqlite3
 import os
 
 from fst.trace import trace
-from fst.config import CONFIG
+from fst.config import CONFIG, FST_DIR
 
 # TODO load dynamically and guess current app
 DB_PATH = CONFIG['fstctl']['db_path']
-
-exists = os.path.exists(DB_PATH)
-conn = sqlite3.connect(DB_PATH)
-conn.set_trace_callback(trace)
-conn.row_factory = sqlite3.Row
-trace("Database path is: %s", DB_PATH)
-if not exists:
-    trace("Database does not exist. Creating...")
-    cursor = conn.cursor()
-    with open("db/schema.sql") as f:
-        cursor.executescript(f.read())
+SCHEMA_PATH = os.path.join(os.path.dirname(FST_DIR), "db", "schema.sql")
+# Bump when db/schema.sql changes. Every statement in it is idempotent so older
+# databases are upgraded by running it again.
+SCHEMA_VERSION = 6
+# seconds to wait for a lock held by another connection before failing
+BUSY_TIMEOUT = 30
 
 
 def connect(path):
+    """ Opens a connection to the database at path and creates or upgrades its
+    schema if needed.
+
+    The database is kept in WAL mode so that readers and the writer don't
+    block each other. The connection can be shared between threads but it's
+    up to the caller to serialize its use.
+    """
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    conn.set_trace_callback(trace)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    # with WAL a commit is durable once the log is synced at a checkpoint
+    conn.execute("PRAGMA synchronous=NORMAL")
+    trace("Database path is: %s", path)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version < SCHEMA_VERSION:
+        trace("Database schema is at version %s. Upgrading to %s...",
+              version, SCHEMA_VERSION)
+        with open(SCHEMA_PATH) as f:
+            conn.executescript(f.read())
+        conn.execute("PRAGMA user_version = {:d}".format(SCHEMA_VERSION))
+    return conn
+
+
+def connect_readonly(path):
+    """ Opens the database at path for reading only.
+
+    The schema is neither created nor upgraded, so this is the cheapest way to
+    look something up. Raises sqlite3.OperationalError if there is no database.
+    """
+    uri = "file:{}?mode=ro".format(
+        path.replace("%", "%25").replace("?", "%3f").replace("#", "%23")
+    )
+    conn = sqlite3.connect(uri, uri=True)
+    conn.row_factory = sqlite3.Row
     return conn
+
+
+_conn = None
+
+
+def get_conn():
+    """ Returns the connection to DB_PATH, opening it on the first call."""
+    global _conn
+    if _conn is None:
+        _conn = connect(DB_PATH)
+    return _conn
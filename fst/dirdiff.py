@@ -1,9 +1,268 @@
 import os
 import os.path
 import collections
+import hashlib
 
 ContentDiff = collections.namedtuple("ContentDiff", ["left", "common", "right"])
 
+# Directories nested deeper than this are opened by path and closed right after
+# they are listed instead of keeping a descriptor open for every level. This
+# bounds the number of fds a single walk can hold.
+FD_DEPTH_LIMIT = 64
+
+_OPEN_FLAGS = os.O_RDONLY | os.O_DIRECTORY | getattr(os, "O_CLOEXEC", 0)
+
+# Optional fst.listcache.ListingCache that is asked for the subdirectories of a
+# directory before it's read.
+listing_cache = None
+
+_Frame = collections.namedtuple(
+    "_Frame", ["rel_path", "depth", "fds", "names", "members"]
+)
+
+
+class DirTree:
+    """ Immutable in-memory structure of a directory.
+
+    Maps the relative path of every directory to the sorted names of its
+    subdirectories. A DirTree can be passed to walk() and the functions built
+    on it wherever a path to a directory is expected.
+
+    Everything derived from the structure is computed on first use and kept,
+    so one tree can be shared by every instance of a template.
+    """
+
+    __slots__ = ("_children", "_checksums", "_paths", "_spans")
+
+    def __init__(self, children):
+        self._children = {
+            parent: tuple(sorted(names)) for parent, names in children.items()
+        }
+        self._checksums = None
+        self._paths = None
+        self._spans = None
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """ Builds a tree from (parent, name) pairs of relative paths."""
+        children = {"": []}
+        for parent, name in pairs:
+            children.setdefault(parent, []).append(name)
+        return cls(children)
+
+    @classmethod
+    def from_disk(cls, directory, ignore=None):
+        return cls({
+            rel_path: listing
+            for rel_path, (listing,) in walk(directory, ignore=ignore)
+        })
+
+    def listing(self, rel_path=""):
+        return list(self._children.get(rel_path, ()))
+
+    def paths(self):
+        """ Returns the relative paths of all subdirectories in sorted
+        pre-order."""
+        if self._paths is None:
+            self._paths = tuple(iter_subdirs(self))
+        return list(self._paths)
+
+    def subtree(self, rel_path):
+        """ Returns rel_path and the paths of all directories under it in sorted
+        pre-order, e.g. what has to be made when rel_path is missing."""
+        if self._spans is None:
+            paths = self.paths()
+            spans = {}
+            # (path, index) of the directories whose subtree isn't closed yet
+            stack = []
+            for index, path in enumerate(paths):
+                while stack and not path.startswith(stack[-1][0] + os.sep):
+                    top, start = stack.pop()
+                    spans[top] = (start, index)
+                stack.append((path, index))
+            for top, start in stack:
+                spans[top] = (start, len(paths))
+            self._spans = spans
+        start, end = self._spans[rel_path]
+        return self._paths[start:end]
+
+    def checksums(self):
+        """ Returns a dict of the merkle checksum of every directory in the tree
+        keyed by relative path.
+        """
+        if self._checksums is None:
+            checksums = {}
+            # children come after their parents in pre-order
+            for rel_path in reversed([""] + self.paths()):
+                checksums[rel_path] = dir_checksum(
+                    (name, checksums[os.path.join(rel_path, name)])
+                    for name in self._children.get(rel_path, ())
+                )
+            self._checksums = checksums
+        return self._checksums
+
+    def checksum(self, rel_path=""):
+        return self.checksums()[rel_path]
+
+    def __eq__(self, other):
+        if not isinstance(other, DirTree):
+            return NotImplemented
+        return self.paths() == other.paths()
+
+    def __repr__(self):
+        return "DirTree({!r})".format(self._children)
+
+
+def dir_checksum(children):
+    """ Returns the merkle checksum of a directory from (name, checksum) pairs
+    of its subdirectories.
+
+    Two directories have the same checksum only if their whole subtrees have
+    the same structure.
+    """
+    md5_hash = hashlib.md5()
+    for name, checksum in sorted(children):
+        md5_hash.update(os.fsencode(name))
+        md5_hash.update(b"\0")
+        md5_hash.update(checksum.encode("ascii"))
+    return md5_hash.hexdigest()
+
+
+def open_dir(path, dir_fd=None):
+    """ Opens a directory for listing it or for calls relative to it.
+
+    :path: is relative to the directory open at :dir_fd: if one is given.
+    """
+    return os.open(path, _OPEN_FLAGS, dir_fd=dir_fd)
+
+
+def _list_subdirs(fd):
+    """ Returns the sorted names of the subdirectories of an open directory.
+
+    Entry types are taken from d_type so no stat is made unless the file system
+    doesn't report it or the entry is a symlink. With a listing cache set a
+    directory that wasn't modified since it was cached costs one fstat.
+    """
+    cache = listing_cache
+    if cache is not None:
+        stat_result = os.fstat(fd)
+        names = cache.get(stat_result)
+        if names is not None:
+            return list(names)
+    with os.scandir(fd) as entries:
+        names = sorted(e.name for e in entries if e.is_dir())
+    if cache is not None:
+        cache.put(stat_result, names)
+    return names
+
+
+def _members(listings):
+    # sets for membership tests of names from the first root in the others
+    return (None,) + tuple(None if l is None else set(l) for l in listings[1:])
+
+
+def _close_all(fds):
+    for fd in fds:
+        if fd is not None:
+            os.close(fd)
+
+
+def walk(*roots, prune=False, ignore=None):
+    """ Walks one or more directory trees side by side in sorted pre-order.
+
+    The walk follows the tree of the first root. For every directory in it a
+    tuple of (rel_path, listings) is yielded where listings holds the sorted
+    names of the subdirectories of rel_path under each root in order or None
+    if rel_path does not exist under that root. rel_path is '' for the roots.
+    With :prune: set directories that are missing under one of the other
+    roots are yielded but not walked into. Names that fst.ignore.IgnoreRules
+    in :ignore: match are dropped from all listings, so ignored directories
+    are never opened.
+
+    A root is either a path or a DirTree. Directories on disk are walked
+    iteratively and children are opened relative to the descriptor of their
+    parent so the kernel doesn't resolve the full path of every directory.
+    Closing the generator early releases all descriptors.
+    """
+    assert roots
+    stack = []
+    try:
+        fds = tuple(
+            None if isinstance(root, DirTree) else open_dir(root)
+            for root in roots
+        )
+        listings = tuple(
+            root.listing() if isinstance(root, DirTree) else _list_subdirs(fd)
+            for root, fd in zip(roots, fds)
+        )
+        if ignore:
+            listings = tuple(ignore.filter(l) for l in listings)
+        stack.append(_Frame("", 0, fds, iter(listings[0]),
+                            _members(listings)))
+        yield "", listings
+
+        while stack:
+            frame = stack[-1]
+            name = next(frame.names, None)
+            if name is None:
+                stack.pop()
+                _close_all(frame.fds)
+                continue
+
+            rel_path = (frame.rel_path + os.sep + name if frame.rel_path
+                        else name)
+            depth = frame.depth + 1
+            fds = []
+            listings = []
+            try:
+                for i, root in enumerate(roots):
+                    # every name comes from the listing of the first root
+                    if i and (frame.members[i] is None or
+                              name not in frame.members[i]):
+                        fds.append(None)
+                        listings.append(None)
+                        continue
+                    if isinstance(root, DirTree):
+                        fds.append(None)
+                        listings.append(root.listing(rel_path))
+                        continue
+                    parent_fd = frame.fds[i]
+                    if parent_fd is None:
+                        fd = open_dir(os.path.join(root, rel_path))
+                    else:
+                        fd = open_dir(name, dir_fd=parent_fd)
+                    fds.append(fd)
+                    listings.append(_list_subdirs(fd))
+                    if depth >= FD_DEPTH_LIMIT:
+                        fds[-1] = None
+                        os.close(fd)
+            except BaseException:
+                _close_all(fds)
+                raise
+            if ignore:
+                listings = [
+                    None if l is None else ignore.filter(l) for l in listings
+                ]
+
+            if prune and None in listings:
+                _close_all(fds)
+            else:
+                stack.append(_Frame(rel_path, depth, fds, iter(listings[0]),
+                                    _members(listings)))
+            yield rel_path, tuple(listings)
+    finally:
+        for frame in stack:
+            _close_all(frame.fds)
+
+
+def listdir(directory):
+    """ Returns the sorted names of the subdirectories of a directory."""
+    fd = open_dir(directory)
+    try:
+        return _list_subdirs(fd)
+    finally:
+        os.close(fd)
+
 
 def difference(dir_1, dir_2):
     """ Returns the difference between two directories.
@@ -12,12 +271,9 @@ def difference(dir_1, dir_2):
     specifying the paths only in the left argument, in both and only in the
     right one respectively.
     """
-    left_contents = set(
-        p for p in os.listdir(dir_1) if os.path.isdir(os.path.join(dir_1, p))
-    )
-    right_contents = set(
-        p for p in os.listdir(dir_2) if os.path.isdir(os.path.join(dir_2, p))
-    )
+    _, (left, right) = next(walk(dir_1, dir_2))
+    left_contents = set(left)
+    right_contents = set(right)
     common_names = left_contents.intersection(right_contents)
     left_contents -= common_names
     right_contents -= common_names
@@ -28,20 +284,40 @@ def difference(dir_1, dir_2):
 def is_subset(dir_1, dir_2):
     """ Returns a boolean whether a directory's entire structure is in another.
 
-    Check is purely path based.
+    Check is purely path based and stops at the first directory of dir_1
+    that is missing from dir_2.
     """
-    diff = difference(dir_1, dir_2)
-    if not diff.left:
-        return True
-    elif diff.common == diff.left:
-        for name in diff.common:
-            left_path = os.path.join(dir_1, name)
-            right_path = os.path.join(dir_2, name)
-            if not is_subset(left_path, right_path):
-                return False
-        return True
-    else:
-        return False
+    for _, (left, right) in walk(dir_1, dir_2):
+        if right is None or not set(left).issubset(right):
+            return False
+    return True
+
+
+def iter_missing(target, origin):
+    """ Yields the relative paths of directories that :origin: has, but
+    :target: does not, in sorted pre-order.
+
+    Every directory is yielded as the walk reaches it, so it comes after its
+    parent and the stream can be fed to fst.conform.materialize as it's
+    produced. Memory use is bounded by the depth and width of the trees
+    instead of their size. :origin: can also be a DirTree, in which case
+    missing subtrees are taken from its precomputed paths instead of being
+    walked for every target.
+    """
+    if isinstance(origin, DirTree):
+        walker = walk(origin, target, prune=True)
+        next(walker)
+        for rel_path, (_, in_target) in walker:
+            if in_target is None:
+                # not walked into with prune set
+                yield from origin.subtree(rel_path)
+        return
+
+    walker = walk(origin, target)
+    next(walker)
+    for rel_path, (_, in_target) in walker:
+        if in_target is None:
+            yield rel_path
 
 
 def missing_from(target, origin, append_to_target=False):
@@ -53,9 +329,9 @@ def missing_from(target, origin, append_to_target=False):
 
     The list is sorted in ascending order and if the :append_to_target: flag is
     set to True it can be safely fed in sequence to os.mkdir to make the target
-    directory a superset of origin.
+    directory a superset of origin. :origin: can also be a DirTree.
     """
-    missing = set(flattened_subdirs(origin)) - set(flattened_subdirs(target))
+    missing = iter_missing(target, origin)
     if append_to_target:
         result = sorted(os.path.join(target, p) for p in missing)
     else:
@@ -63,27 +339,56 @@ def missing_from(target, origin, append_to_target=False):
     return result
 
 
-def flattened_subdirs(directory, appended=False):
+def changed_subtrees(old, new):
+    """ Returns the subtrees that were added to and removed from a DirTree.
+
+    The return value is a ContentDiff of sorted relative paths. 'left' holds the
+    roots of subtrees only in :old:, 'right' those only in :new: and 'common'
+    the directories that exist in both but whose structure changed. Subtrees
+    with matching checksums are skipped without being looked at.
+    """
+    removed = []
+    changed = []
+    added = []
+    old_checksums = old.checksums()
+    new_checksums = new.checksums()
+    stack = [""]
+    while stack:
+        rel_path = stack.pop()
+        if old_checksums[rel_path] == new_checksums[rel_path]:
+            continue
+        changed.append(rel_path)
+        old_names = set(old.listing(rel_path))
+        new_names = set(new.listing(rel_path))
+        for name in old_names - new_names:
+            removed.append(os.path.join(rel_path, name))
+        for name in new_names - old_names:
+            added.append(os.path.join(rel_path, name))
+        stack.extend(
+            os.path.join(rel_path, name) for name in old_names & new_names
+        )
+    return ContentDiff(sorted(removed), sorted(changed), sorted(added))
+
+
+def iter_subdirs(directory, appended=False, ignore=None):
+    """ Yields the paths of all subdirectories under the root in sorted
+    pre-order.
+
+    Paths are relative unless :appended: is set, see flattened_subdirs(). Memory
+    use is bounded by the depth and width of the tree instead of its size.
+    Subtrees matched by :ignore: are skipped.
+    """
+    walker = walk(directory, ignore=ignore)
+    next(walker)
+    for rel_path, _ in walker:
+        yield os.path.join(directory, rel_path) if appended else rel_path
+
+
+def flattened_subdirs(directory, appended=False, ignore=None):
     """ Returns a sorted and unnested list of all subdirectories under the root.
 
     The paths may or may not be relative - depending on the passed argument.
     They are simply appended to it so a relative argument yields relative paths
     to the current working directory and an absolute, absolute paths.
     """
-
-    def implementation(dir_path):
-        sd = []
-        for name in sorted(os.listdir(dir_path)):
-            path = os.path.join(dir_path, name)
-            if os.path.isdir(path):
-                sd.append(path)
-                sd.extend(implementation(path))
-        return sd
-
-    if appended:
-        return implementation(dir_path=directory)
-    else:
-        return [
-            os.path.relpath(path=p, start=directory)
-            for p in implementation(directory)
-        ]
+    return list(iter_subdirs(directory, appended=appended, ignore=ignore))
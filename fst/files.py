@@ -0,0 +1,214 @@
+"""
+Propagation of template files into instances.
+
+fst only tracks directories, files are copied on request. A file is copied to
+a temporary name next to its target and renamed over it, so instances never
+see a partial file. The data is shared with the template where the filesystem
+allows it:
+
+    reflink          FICLONE ioctl - copy on write clone (btrfs, xfs, ...)
+    copy_file_range  in kernel copy, server side on network filesystems
+    buffered         read and write through user space
+
+In "hardlink" mode targets are hard links to the template's files instead.
+Changes to them through an instance change the template, which is why it must
+be asked for. Files that can't be linked (e.g. on another device) are copied.
+
+Targets that are already current are skipped. A copy is current when its size
+and mtime are the ones of the template's file or, if only the mtime differs,
+when their contents hash the same. A link is current when it's the same file.
+"""
+import collections
+import errno
+import fcntl
+import hashlib
+import os
+import os.path
+import shutil
+import stat
+
+import fst.pool
+
+MODES = ("copy", "hardlink")
+
+SyncResult = collections.namedtuple(
+    "SyncResult", ["path", "copied", "skipped", "elapsed", "error"]
+)
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+# errors of FICLONE and copy_file_range meaning the filesystems can't do it
+_UNSUPPORTED = frozenset([
+    errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+    errno.EBADF, errno.EPERM,
+])
+_UNLINKABLE = frozenset([errno.EXDEV, errno.EPERM, errno.EMLINK])
+CHUNK_SIZE = 1024 * 1024
+
+
+def iter_files(root, ignore=None, rel_path=""):
+    """ Yields the paths of regular files under a directory relative to it.
+
+    Only the subtree at :rel_path: is walked. Directories matched by the
+    :ignore: rules and symbolic links are skipped.
+    """
+    stack = [rel_path]
+    while stack:
+        rel_dir = stack.pop()
+        with os.scandir(os.path.join(root, rel_dir)) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not (ignore and ignore.match(entry.name)):
+                        stack.append(os.path.join(rel_dir, entry.name))
+                elif entry.is_file(follow_symlinks=False):
+                    yield os.path.join(rel_dir, entry.name)
+
+
+def file_digest(path):
+    md5_hash = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            md5_hash.update(chunk)
+    return md5_hash.hexdigest()
+
+
+def is_current(src, dest, src_stat, mode="copy"):
+    """ Returns whether :dest: doesn't need to be copied from :src:.
+
+    A copy with the same content but another mtime is current and gets the
+    mtime of :src: so that the next check is a single stat.
+    """
+    try:
+        dest_stat = os.stat(dest)
+    except FileNotFoundError:
+        return False
+    if mode == "hardlink":
+        return os.path.samestat(src_stat, dest_stat)
+    if not stat.S_ISREG(dest_stat.st_mode):
+        return False
+    if dest_stat.st_size != src_stat.st_size:
+        return False
+    if dest_stat.st_mtime_ns == src_stat.st_mtime_ns:
+        return True
+    if file_digest(src) != file_digest(dest):
+        return False
+    os.utime(dest, ns=(dest_stat.st_atime_ns, src_stat.st_mtime_ns))
+    return True
+
+
+def _copy_data(src_file, dest_file):
+    """ Copies the contents of an open file into an empty one and returns
+    the method that was used."""
+    src_fd = src_file.fileno()
+    dest_fd = dest_file.fileno()
+    try:
+        fcntl.ioctl(dest_fd, FICLONE, src_fd)
+        return "reflink"
+    except OSError as exc:
+        if exc.errno not in _UNSUPPORTED:
+            raise
+
+    if hasattr(os, "copy_file_range"):
+        try:
+            while os.copy_file_range(src_fd, dest_fd, CHUNK_SIZE):
+                pass
+            return "copy_file_range"
+        except OSError as exc:
+            if exc.errno not in _UNSUPPORTED:
+                raise
+            src_file.seek(0)
+            dest_file.seek(0)
+            dest_file.truncate()
+
+    shutil.copyfileobj(src_file, dest_file, CHUNK_SIZE)
+    return "buffered"
+
+
+def _temp_path(dest):
+    head, tail = os.path.split(dest)
+    return os.path.join(head, ".{}.{}.fst-tmp".format(tail, os.getpid()))
+
+
+def copy_file(src, dest, mode="copy"):
+    """ Copies or links the file at :src: to :dest: unless it's current.
+
+    Returns the method that was used - see the module docstring - or None if
+    :dest: was current.
+    """
+    assert mode in MODES
+    src_stat = os.stat(src)
+    if is_current(src, dest, src_stat, mode):
+        return None
+
+    temp = _temp_path(dest)
+    try:
+        if mode == "hardlink":
+            try:
+                os.link(src, temp)
+            except OSError as exc:
+                if exc.errno not in _UNLINKABLE:
+                    raise
+            else:
+                os.replace(temp, dest)
+                return "hardlink"
+        with open(src, "rb") as src_file, open(temp, "wb") as dest_file:
+            method = _copy_data(src_file, dest_file)
+        os.chmod(temp, stat.S_IMODE(src_stat.st_mode))
+        os.utime(temp, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+        os.replace(temp, dest)
+    except BaseException:
+        try:
+            os.unlink(temp)
+        except FileNotFoundError:
+            pass
+        raise
+    return method
+
+
+def sync_files(template_path, instance_path, rel_paths, mode="copy"):
+    """ Copies files of a template into an instance creating their parent
+    directories if they are missing.
+
+    Returns (rel_path, method) pairs of the copied files. Skipped files have
+    a method of None.
+    """
+    synced = []
+    for rel_path in rel_paths:
+        src = os.path.join(template_path, rel_path)
+        dest = os.path.join(instance_path, rel_path)
+        try:
+            method = copy_file(src, dest, mode)
+        except FileNotFoundError:
+            if not os.path.exists(src):
+                # removed from the template in the meantime
+                continue
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            method = copy_file(src, dest, mode)
+        synced.append((rel_path, method))
+    return synced
+
+
+def sync_instances(triples, mode, jobs):
+    """ Copies all files of templates into instances from
+    (instance_path, template_path, ignore) triples on a pool of :jobs:
+    threads.
+
+    A SyncResult is yielded for every triple in their order. A failure stops
+    copying into its instance only and is reported through its result.
+    """
+    def sync(triple):
+        instance_path, template_path, ignore = triple
+        return sync_files(
+            template_path, instance_path, iter_files(template_path, ignore),
+            mode
+        )
+
+    for result in fst.pool.ordered_map(fst.pool.timed(sync), triples, jobs):
+        synced = result.value or []
+        yield SyncResult(
+            result.item[0],
+            [rel_path for rel_path, method in synced if method],
+            sum(1 for _, method in synced if not method),
+            result.elapsed,
+            result.error
+        )
@@ -0,0 +1,153 @@
+"""
+Command hooks that run in every instance of a template.
+
+A hook is started in the directory of each instance with FST_TEMPLATE,
+FST_TEMPLATE_PATH and FST_INSTANCE set in its environment. At most :jobs:
+hooks run at a time. Their stdout and stderr are merged and every line is
+written as soon as it's read, prefixed by the instance it came from.
+
+A hook that runs longer than its timeout gets SIGTERM and, KILL_GRACE seconds
+later, SIGKILL. Both are sent to its whole process group so that commands it
+started don't outlive it. Hooks run in their own session, so a ^C of fst
+doesn't reach them directly - run_hooks() terminates the running ones when it
+is interrupted.
+"""
+import collections
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import fst.pool
+
+HookResult = collections.namedtuple(
+    "HookResult", ["path", "returncode", "elapsed", "timed_out", "error"]
+)
+
+# seconds between SIGTERM and SIGKILL of a hook that timed out
+KILL_GRACE = 5
+
+
+class TaggedOutput:
+    """ Writes lines of concurrent hooks to a stream without interleaving
+    them."""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._lock = threading.Lock()
+
+    def write(self, tag, line):
+        with self._lock:
+            self.stream.write("[{}] {}\n".format(tag, line.rstrip("\n")))
+            self.stream.flush()
+
+
+def _terminate(proc, timed_out):
+    timed_out.set()
+    for signum in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, signum)
+        except ProcessLookupError:
+            return
+        try:
+            proc.wait(timeout=KILL_GRACE)
+            return
+        except subprocess.TimeoutExpired:
+            pass
+
+
+def run_hook(command, instance_path, env, timeout=None, output=None,
+             running=None):
+    """ Runs a hook in an instance and waits for it to exit.
+
+    :command: is an argv list or a string for the shell. The process is kept
+    in the :running: set while it runs. Returns a HookResult. A hook that
+    couldn't be started has an error and a returncode of None.
+    """
+    output = output or TaggedOutput()
+    start = time.perf_counter()
+    try:
+        proc = subprocess.Popen(
+            command,
+            shell=isinstance(command, str),
+            cwd=instance_path,
+            env=env,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+            universal_newlines=True,
+            errors="replace",
+        )
+    except OSError as exc:
+        return HookResult(
+            instance_path, None, time.perf_counter() - start, False, exc
+        )
+
+    if running is not None:
+        running.add(proc)
+    timed_out = threading.Event()
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, _terminate, [proc, timed_out])
+        timer.daemon = True
+        timer.start()
+    try:
+        with proc.stdout:
+            for line in proc.stdout:
+                output.write(instance_path, line)
+        returncode = proc.wait()
+    finally:
+        if timer:
+            timer.cancel()
+        if running is not None:
+            running.discard(proc)
+    return HookResult(
+        instance_path,
+        returncode,
+        time.perf_counter() - start,
+        timed_out.is_set(),
+        None
+    )
+
+
+def hook_env(template, instance_path):
+    env = dict(os.environ)
+    env["FST_TEMPLATE"] = template["name"]
+    env["FST_TEMPLATE_PATH"] = template["path"]
+    env["FST_INSTANCE"] = instance_path
+    return env
+
+
+def run_hooks(command, pairs, jobs, timeout=None, output=None):
+    """ Runs a hook for (template, instance_path) pairs on a pool of :jobs:
+    threads, each waiting for one process.
+
+    A HookResult is yielded for every pair in their order - see
+    fst.pool.ordered_map(). Hooks that are still running when the caller
+    stops, e.g. on KeyboardInterrupt, are terminated.
+    """
+    output = output or TaggedOutput()
+    running = set()
+
+    def run(pair):
+        template, instance_path = pair
+        return run_hook(
+            command,
+            instance_path,
+            hook_env(template, instance_path),
+            timeout=timeout,
+            output=output,
+            running=running
+        )
+
+    try:
+        yield from fst.pool.ordered_map(run, pairs, jobs)
+    finally:
+        for proc in list(running):
+            try:
+                os.killpg(proc.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,92 @@
+"""
+Ignore rules of templates.
+
+A rule is a shell pattern matched against the names of directories at any
+depth, e.g. .git, node_modules or *.cache. The rules of a template are kept in
+the template_ignores table and compiled into a single regular expression.
+Ignored directories are treated as if they didn't exist: walks don't descend
+into them, they aren't indexed or created in instances and the daemon drops
+their events.
+"""
+import fnmatch
+import os
+import re
+
+
+class IgnoreRules:
+    __slots__ = ("patterns", "_regex")
+
+    def __init__(self, patterns=()):
+        self.patterns = tuple(sorted(set(patterns)))
+        self._regex = None
+        if self.patterns:
+            self._regex = re.compile(
+                "|".join(fnmatch.translate(p) for p in self.patterns)
+            )
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def __eq__(self, other):
+        if not isinstance(other, IgnoreRules):
+            return NotImplemented
+        return self.patterns == other.patterns
+
+    def __repr__(self):
+        return "IgnoreRules({!r})".format(self.patterns)
+
+    def match(self, name):
+        """ Returns whether a directory with this name is ignored."""
+        return self._regex is not None and self._regex.match(name) is not None
+
+    def ignores(self, rel_path):
+        """ Returns whether a path is ignored or is under an ignored
+        directory."""
+        return self._regex is not None and any(
+            self._regex.match(name) for name in rel_path.split(os.sep)
+        )
+
+    def filter(self, names):
+        """ Returns the names that aren't ignored keeping their order."""
+        if self._regex is None:
+            return list(names)
+        match = self._regex.match
+        return [name for name in names if not match(name)]
+
+
+def pull_rules(cursor, template_id):
+    cursor.execute(
+        "SELECT pattern FROM template_ignores WHERE template_id=?",
+        [template_id]
+    )
+    return IgnoreRules(row['pattern'] for row in cursor.fetchall())
+
+
+def pull_all_rules(cursor):
+    """ Returns the IgnoreRules of every template that has any keyed by id."""
+    cursor.execute("SELECT template_id, pattern FROM template_ignores")
+    patterns = {}
+    for row in cursor.fetchall():
+        patterns.setdefault(row['template_id'], []).append(row['pattern'])
+    return {
+        template_id: IgnoreRules(p) for template_id, p in patterns.items()
+    }
+
+
+def add_patterns(cursor, template_id, patterns):
+    cursor.executemany(
+        """
+        INSERT OR IGNORE INTO template_ignores (template_id, pattern)
+        VALUES (?, ?)
+        """,
+        ((template_id, p) for p in patterns)
+    )
+
+
+def remove_patterns(cursor, template_id, patterns):
+    """ Removes patterns of a template and returns how many there were."""
+    cursor.executemany(
+        "DELETE FROM template_ignores WHERE template_id=? AND pattern=?",
+        ((template_id, p) for p in patterns)
+    )
+    return cursor.rowcount
@@ -0,0 +1,296 @@
+"""
+Persistent index of template structures kept in the fst database.
+
+Every subdirectory of a template is one row of the template_dirs table holding
+the path of its parent relative to the template ('' at the top) and its name.
+The merkle checksum of every directory, including the template itself, is kept
+in template_checksums and the one of the template is also its checksum in the
+templates table. template_mtimes holds the mtimes directories had when they
+were last listed - changes made through this module drop the ones they affect.
+"""
+import os.path
+
+import fst.dirdiff
+
+
+def _split(rel_path):
+    return os.path.split(os.path.normpath(rel_path))
+
+
+def _ancestors(rel_path):
+    while rel_path:
+        rel_path = os.path.dirname(rel_path)
+        yield rel_path
+
+
+def store_tree(cursor, template_id, tree):
+    """ Replaces the stored structure of a template with a DirTree."""
+    cursor.execute(
+        "DELETE FROM template_dirs WHERE template_id=?",
+        [template_id]
+    )
+    cursor.execute(
+        "DELETE FROM template_checksums WHERE template_id=?",
+        [template_id]
+    )
+    cursor.execute(
+        "DELETE FROM template_mtimes WHERE template_id=?",
+        [template_id]
+    )
+    add_dirs(cursor, template_id, tree.paths())
+    _store_checksums(cursor, template_id, tree.checksums())
+
+
+def add_dirs(cursor, template_id, rel_paths):
+    """ Records directories of a template. Parents must be recorded as well.
+
+    Checksums are not touched - see update_checksums().
+    """
+    cursor.executemany(
+        """
+        INSERT OR IGNORE INTO template_dirs (template_id, parent, name)
+        VALUES (?, ?, ?)
+        """,
+        ((template_id, *_split(p)) for p in rel_paths)
+    )
+
+
+def remove_dirs(cursor, template_id, rel_path):
+    """ Removes a directory of a template and everything recorded under it.
+
+    Checksums are not touched - see update_checksums().
+    """
+    rel_path = os.path.normpath(rel_path)
+    parent, name = _split(rel_path)
+    cursor.execute(
+        """
+        DELETE FROM template_dirs
+        WHERE template_id=? AND (
+            (parent=? AND name=?) OR
+            parent=? OR
+            substr(parent, 1, ?)=?
+        )
+        """,
+        [template_id, parent, name, rel_path,
+         len(rel_path) + 1, rel_path + os.sep]
+    )
+
+
+def remove_ignored(cursor, template_id, ignore):
+    """ Removes the recorded directories matched by fst.ignore.IgnoreRules and
+    everything under them. Returns the paths of the removed subtrees."""
+    removed = [
+        p for p in pull_tree(cursor, template_id).paths()
+        if ignore.match(os.path.basename(p)) and
+        not ignore.ignores(os.path.dirname(p))
+    ]
+    for rel_path in removed:
+        remove_dirs(cursor, template_id, rel_path)
+        update_checksums(cursor, template_id, rel_path)
+    return removed
+
+
+def update_checksums(cursor, template_id, rel_path):
+    """ Recomputes checksums after the recorded subtree at rel_path changed.
+
+    Only the subtree itself and the directories on the way up to the template
+    are rehashed.
+    """
+    assert rel_path, "use store_tree() to rehash the whole template"
+    rel_path = os.path.normpath(rel_path)
+    _drop_mtimes(cursor, template_id, rel_path)
+    cursor.execute(
+        """
+        DELETE FROM template_checksums
+        WHERE template_id=? AND (path=? OR substr(path, 1, ?)=?)
+        """,
+        [template_id, rel_path, len(rel_path) + 1, rel_path + os.sep]
+    )
+    if is_recorded(cursor, template_id, rel_path):
+        subtree = pull_subtree(cursor, template_id, rel_path)
+        _store_checksums(cursor, template_id, {
+            os.path.join(rel_path, p) if p else rel_path: checksum
+            for p, checksum in subtree.checksums().items()
+        })
+    _update_ancestors(cursor, template_id, rel_path)
+
+
+def move_dirs(cursor, template_id, src, dest):
+    """ Moves the recorded subtree at src to dest.
+
+    The rows of the subtree and their checksums are renamed in place, so only
+    the directories above src and dest are rehashed. Whatever was recorded at
+    dest is replaced and missing parents of dest are added. Returns False
+    without changing anything if src isn't recorded.
+    """
+    src = os.path.normpath(src)
+    dest = os.path.normpath(dest)
+    if not is_recorded(cursor, template_id, src):
+        return False
+
+    _drop_mtimes(cursor, template_id, src)
+    _drop_mtimes(cursor, template_id, dest)
+    remove_dirs(cursor, template_id, dest)
+    cursor.execute(
+        """
+        DELETE FROM template_checksums
+        WHERE template_id=? AND (path=? OR substr(path, 1, ?)=?)
+        """,
+        [template_id, dest, len(dest) + 1, dest + os.sep]
+    )
+    cursor.execute(
+        """
+        UPDATE template_dirs SET parent=?, name=?
+        WHERE template_id=? AND parent=? AND name=?
+        """,
+        [*_split(dest), template_id, *_split(src)]
+    )
+    cursor.execute(
+        """
+        UPDATE template_dirs SET parent=? || substr(parent, ?)
+        WHERE template_id=? AND (parent=? OR substr(parent, 1, ?)=?)
+        """,
+        [dest, len(src) + 1, template_id, src, len(src) + 1, src + os.sep]
+    )
+    cursor.execute(
+        """
+        UPDATE template_checksums SET path=? || substr(path, ?)
+        WHERE template_id=? AND (path=? OR substr(path, 1, ?)=?)
+        """,
+        [dest, len(src) + 1, template_id, src, len(src) + 1, src + os.sep]
+    )
+    add_dirs(cursor, template_id, [p for p in _ancestors(dest) if p])
+    _update_ancestors(cursor, template_id, src)
+    # last because new parents of dest only get their checksums here
+    _update_ancestors(cursor, template_id, dest)
+    return True
+
+
+def pull_subtree(cursor, template_id, rel_path):
+    """ Returns the recorded structure under a directory of a template as a
+    DirTree relative to it."""
+    rel_path = os.path.normpath(rel_path)
+    cursor.execute(
+        """
+        SELECT parent, name FROM template_dirs
+        WHERE template_id=? AND (parent=? OR substr(parent, 1, ?)=?)
+        """,
+        [template_id, rel_path, len(rel_path) + 1, rel_path + os.sep]
+    )
+    prefix_len = len(rel_path) + 1
+    return fst.dirdiff.DirTree.from_pairs(
+        (row['parent'][prefix_len:], row['name'])
+        for row in cursor.fetchall()
+    )
+
+
+def is_recorded(cursor, template_id, rel_path):
+    """ Returns whether a directory of a template is recorded."""
+    cursor.execute(
+        """
+        SELECT 1 FROM template_dirs
+        WHERE template_id=? AND parent=? AND name=?
+        """,
+        [template_id, *_split(rel_path)]
+    )
+    return cursor.fetchone() is not None
+
+
+def _update_ancestors(cursor, template_id, rel_path):
+    """ Rehashes the directories above rel_path bottom-up from the stored
+    checksums of their children.
+
+    Ancestors that aren't recorded, e.g. because a subtree above rel_path was
+    removed first, are skipped.
+    """
+    ancestors = list(_ancestors(rel_path))
+    while len(ancestors) > 1 and not is_recorded(
+            cursor, template_id, ancestors[0]):
+        ancestors.pop(0)
+    for ancestor in ancestors:
+        cursor.execute(
+            """
+            SELECT D.name AS name, C.checksum AS checksum
+            FROM template_dirs AS D
+            JOIN template_checksums AS C
+                ON C.template_id=D.template_id AND
+                   C.path=(CASE D.parent WHEN '' THEN D.name
+                           ELSE D.parent || ? || D.name END)
+            WHERE D.template_id=? AND D.parent=?
+            """,
+            [os.sep, template_id, ancestor]
+        )
+        checksum = fst.dirdiff.dir_checksum(
+            (row['name'], row['checksum']) for row in cursor.fetchall()
+        )
+        _store_checksums(cursor, template_id, {ancestor: checksum})
+
+
+def _drop_mtimes(cursor, template_id, rel_path):
+    cursor.executemany(
+        "DELETE FROM template_mtimes WHERE template_id=? AND path=?",
+        ((template_id, p) for p in _ancestors(rel_path))
+    )
+    cursor.execute(
+        """
+        DELETE FROM template_mtimes
+        WHERE template_id=? AND (path=? OR substr(path, 1, ?)=?)
+        """,
+        [template_id, rel_path, len(rel_path) + 1, rel_path + os.sep]
+    )
+
+
+def store_mtimes(cursor, template_id, mtimes):
+    """ Replaces the recorded mtimes of a template's directories.
+
+    :mtimes: maps relative paths to st_mtime_ns and must describe the listings
+    that are currently stored.
+    """
+    cursor.execute(
+        "DELETE FROM template_mtimes WHERE template_id=?",
+        [template_id]
+    )
+    cursor.executemany(
+        """
+        INSERT INTO template_mtimes (template_id, path, mtime_ns)
+        VALUES (?, ?, ?)
+        """,
+        ((template_id, p, mtime_ns) for p, mtime_ns in mtimes.items())
+    )
+
+
+def pull_mtimes(cursor, template_id):
+    cursor.execute(
+        "SELECT path, mtime_ns FROM template_mtimes WHERE template_id=?",
+        [template_id]
+    )
+    return {row['path']: row['mtime_ns'] for row in cursor.fetchall()}
+
+
+def _store_checksums(cursor, template_id, checksums):
+    cursor.executemany(
+        """
+        INSERT OR REPLACE INTO template_checksums (template_id, path, checksum)
+        VALUES (?, ?, ?)
+        """,
+        ((template_id, p, checksum) for p, checksum in checksums.items())
+    )
+    if "" in checksums:
+        cursor.execute(
+            "UPDATE templates SET checksum=? WHERE id=?",
+            [checksums[""], template_id]
+        )
+
+
+def pull_tree(cursor, template_id):
+    """ Returns the stored structure of a template as a DirTree.
+
+    A template without any recorded directories yields an empty tree.
+    """
+    cursor.execute(
+        "SELECT parent, name FROM template_dirs WHERE template_id=?",
+        [template_id]
+    )
+    return fst.dirdiff.DirTree.from_pairs(
+        (row['parent'], row['name']) for row in cursor.fetchall()
+    )
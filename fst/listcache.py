@@ -0,0 +1,98 @@
+"""
+Cache of directory listings keyed by (st_dev, st_ino, st_mtime_ns).
+
+The mtime of a directory changes whenever an entry is added to, removed from
+or renamed in it, so while the key of a directory is the same so are its
+subdirectories. The cache is kept in memory with LRU eviction and can be saved
+to and loaded from a compact file between runs.
+"""
+import collections
+import threading
+import time
+
+import fst.trace
+
+FORMAT_VERSION = 1
+DEFAULT_MAX_ENTRIES = 200000
+# Listings of directories modified this recently (in ns) aren't cached since
+# another change in the same clock tick would leave the mtime as it is.
+RACY_WINDOW_NS = 2 * 10 ** 9
+
+
+def _key(stat_result):
+    return (stat_result.st_dev, stat_result.st_ino, stat_result.st_mtime_ns)
+
+
+class ListingCache:
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        assert max_entries > 0
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # listings put since the cache was made or loaded
+        self.added = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, stat_result):
+        """ Returns the cached subdirectory names of a directory or None."""
+        key = _key(stat_result)
+        with self._lock:
+            names = self._entries.get(key)
+            if names is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return names
+
+    def put(self, stat_result, names):
+        if time.time_ns() - stat_result.st_mtime_ns < RACY_WINDOW_NS:
+            return
+        key = _key(stat_result)
+        with self._lock:
+            self.added += 1
+            self._entries[key] = tuple(names)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    @classmethod
+    def load(cls, path, max_entries=DEFAULT_MAX_ENTRIES):
+        """ Loads a saved cache. A missing or unreadable file yields an empty
+        one."""
+        # imported here to keep it out of the startup of commands that don't
+        # walk directories
+        import pickle
+
+        cache = cls(max_entries)
+        try:
+            with open(path, "rb") as f:
+                version, entries = pickle.load(f)
+        except FileNotFoundError:
+            return cache
+        except Exception:
+            fst.trace.warn("Ignoring unreadable listing cache %s.", path,
+                           exc_info=True)
+            return cache
+        if version != FORMAT_VERSION:
+            return cache
+        # entries are saved from least to most recently used
+        for key, names in entries[-max_entries:]:
+            cache._entries[key] = names
+        return cache
+
+    def save(self, path):
+        """ Atomically writes the cache to path."""
+        import pickle
+
+        import fst.atomic
+
+        with self._lock:
+            entries = list(self._entries.items())
+        with fst.atomic.open_atomic(path, "wb") as f:
+            pickle.dump((FORMAT_VERSION, entries), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,46 @@
+"""
+Thread pool for running a function over independent instances.
+
+Work on instances is I/O bound - walks, copies and processes - so it's spread
+over threads and the results are handed back in the order of the instances.
+"""
+import collections
+import concurrent.futures
+import time
+
+Timed = collections.namedtuple("Timed", ["item", "value", "elapsed", "error"])
+
+
+def ordered_map(func, items, jobs):
+    """ Calls func on every item on a pool of :jobs: threads.
+
+    The result of every item is yielded in the order of the items as soon as
+    it and all items before it are done. Items that haven't started when the
+    caller stops, e.g. on KeyboardInterrupt, are dropped. Ones that are
+    running aren't waited for.
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    try:
+        yield from executor.map(func, items)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def timed(func, errors=(OSError,)):
+    """ Wraps func so that it returns a Timed result of its item.
+
+    Exceptions of the :errors: types are returned through the result instead
+    of being raised, so that one failing item doesn't stop the others. Its
+    value is None then.
+    """
+    def wrapped(item):
+        start = time.perf_counter()
+        try:
+            value = func(item)
+            error = None
+        except errors as exc:
+            value = None
+            error = exc
+        return Timed(item, value, time.perf_counter() - start, error)
+
+    return wrapped
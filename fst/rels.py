@@ -0,0 +1,211 @@
+"""
+Queries of the relationships between templates and their instances.
+
+Every lookup - by template name, template path, instance path or of everything
+- is its own query with a constant text. Each one can be answered from an
+index and sqlite3 reuses its prepared statement from the connection's
+statement cache on every call. Rows have the columns of a template prefixed
+with t_ and of an instance with i_. i_ columns are NULL for templates without
+active instances.
+
+pull() turns the rows into Template and Instance records in one pass. The CLI
+and the daemon both work with them. Everything is pulled with a scan of each
+table instead of the join, which would read every instance through the index
+of its template.
+"""
+
+_COLUMNS = """
+    T.id AS t_id,
+    T.name AS t_name,
+    T.path AS t_path,
+    T.checksum AS t_checksum,
+    T.active AS t_active,
+    I.id AS i_id,
+    I.path AS i_path,
+    I.template_id AS i_template_id,
+    I.active AS i_active
+"""
+
+_BY_TEMPLATE = """
+    SELECT {}
+    FROM templates AS T
+    LEFT JOIN instances AS I ON I.template_id=T.id AND I.active=1
+    WHERE T.active=1
+""".format(_COLUMNS)
+
+BY_TEMPLATE_NAME = _BY_TEMPLATE + " AND T.name=? ORDER BY I.id"
+
+BY_TEMPLATE_PATH = _BY_TEMPLATE + " AND T.path=? ORDER BY I.id"
+
+ALL = _BY_TEMPLATE + " ORDER BY T.id, I.id"
+
+ALL_TEMPLATES = """
+    SELECT id, name, path, checksum, active
+    FROM templates
+    WHERE active=1
+    ORDER BY id
+"""
+
+ALL_INSTANCES = """
+    SELECT id, path, template_id, active
+    FROM instances
+    WHERE active=1
+    ORDER BY id
+"""
+
+BY_INSTANCE_PATH = """
+    SELECT {}
+    FROM instances AS I
+    JOIN templates AS T ON T.id=I.template_id
+    WHERE I.path=? AND I.active=1 AND T.active=1
+""".format(_COLUMNS)
+
+
+def select(cursor, template=None, instance=None):
+    """ Returns the relationship rows of the active template whose name or path
+    is :template: and of the active instance at :instance:. All of them are
+    returned when neither is given.
+
+    Rows are sorted by template and instance id and every template with
+    matches is listed with all of its instances unless it only matched
+    through :instance:.
+    """
+    if not template and not instance:
+        return cursor.execute(ALL).fetchall()
+
+    rows = []
+    if template:
+        rows.extend(cursor.execute(BY_TEMPLATE_NAME, [template]))
+        rows.extend(cursor.execute(BY_TEMPLATE_PATH, [template]))
+    if instance:
+        rows.extend(cursor.execute(BY_INSTANCE_PATH, [instance]))
+
+    unique = {(row["t_id"], row["i_id"] or 0): row for row in rows}
+    return [unique[key] for key in sorted(unique)]
+
+
+class Template:
+    """ Active template with the instances of it that were pulled.
+
+    Fields can also be read by subscription like the rows they are made from.
+    """
+
+    __slots__ = ("id", "name", "path", "checksum", "active", "instances")
+
+    def __init__(self, id, name, path, checksum, active):
+        self.id = id
+        self.name = name
+        self.path = path
+        self.checksum = checksum
+        self.active = active
+        self.instances = []
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __repr__(self):
+        return "<Template id={} name={!r} path={!r} instances={}>".format(
+            self.id, self.name, self.path, len(self.instances)
+        )
+
+
+class Instance:
+    """ Active instance of a template.
+
+    Fields can also be read by subscription like the rows they are made from.
+    """
+
+    __slots__ = ("id", "path", "template_id", "active")
+
+    def __init__(self, id, path, template_id, active):
+        self.id = id
+        self.path = path
+        self.template_id = template_id
+        self.active = active
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __repr__(self):
+        return "<Instance id={} path={!r} template_id={}>".format(
+            self.id, self.path, self.template_id
+        )
+
+
+class Relationships:
+    """ Templates and instances pulled by one lookup.
+
+    templates and instances are lists in id order. Templates are indexed by
+    id, name and path and instances by id and path. Every template holds its
+    instances so nothing needs to be searched linearly.
+    """
+
+    __slots__ = ("templates", "instances", "by_id", "by_name", "by_path",
+                 "instances_by_id", "instances_by_path")
+
+    def __init__(self, rows=()):
+        self.templates = []
+        self.instances = []
+        self.by_id = {}
+        self.by_name = {}
+        self.by_path = {}
+        self.instances_by_id = {}
+        self.instances_by_path = {}
+        for row in rows:
+            template = self.by_id.get(row["t_id"])
+            if template is None:
+                template = Template(row["t_id"], row["t_name"], row["t_path"],
+                                    row["t_checksum"], row["t_active"])
+                self.templates.append(template)
+                self.by_id[template.id] = template
+                self.by_name[template.name] = template
+                self.by_path[template.path] = template
+            if row["i_id"] is None:
+                continue
+            assert row["i_id"] not in self.instances_by_id
+            instance = Instance(row["i_id"], row["i_path"],
+                                row["i_template_id"], row["i_active"])
+            template.instances.append(instance)
+            self.instances.append(instance)
+            self.instances_by_id[instance.id] = instance
+            self.instances_by_path[instance.path] = instance
+
+    def template(self, name_or_path):
+        """ Returns the template with the name or path or None."""
+        return (self.by_name.get(name_or_path) or
+                self.by_path.get(name_or_path))
+
+
+def pull(cursor, template=None, instance=None):
+    """ Returns the Relationships of the rows select() returns."""
+    if not template and not instance:
+        return _pull_all(cursor)
+    return Relationships(select(cursor, template=template, instance=instance))
+
+
+def _pull_all(cursor):
+    rels = Relationships()
+    for row in cursor.execute(ALL_TEMPLATES):
+        template = Template(*row)
+        rels.templates.append(template)
+        rels.by_id[template.id] = template
+        rels.by_name[template.name] = template
+        rels.by_path[template.path] = template
+
+    # the rows are streamed from the cursor and looked up with local names,
+    # it's the one loop that runs per instance
+    by_id = rels.by_id
+    instances = rels.instances
+    instances_by_id = rels.instances_by_id
+    instances_by_path = rels.instances_by_path
+    for row in cursor.execute(ALL_INSTANCES):
+        template = by_id.get(row[2])
+        if template is None:
+            # instance of an inactive template
+            continue
+        instance = Instance(*row)
+        template.instances.append(instance)
+        instances.append(instance)
+        instances_by_id[instance.id] = instance
+        instances_by_path[instance.path] = instance
+    return rels
@@ -1,37 +1,64 @@
 import sqlite3
 import os
-import hashlib
-import signal
 
 from fst.err import *
 import fst.dirdiff
 import fst.conform
-from fst.config import CONFIG
+import fst.ignore
+import fst.index
+import fst.trace
 
 
-au_daemon_pid = None
-try:
-    au_daemon_pid = int(open(CONFIG['au']['pidfile']).read())
-    fst.trace.trace('Auto update daemon pid is: %s', daemon_pid)
-except FileNotFoundError:
-    fst.trace.warn('Auto update daemon is not running.')
+# control messages for the auto update daemon about changes that are yet to be
+# committed - see notify_au_daemon()
+pending_notifications = []
 
 
-def signal_au_daemon(signum):
+def au_daemon_message(message_type):
+    """ Decorates a function that changes relationships and returns the ids of
+    the templates it changed. A message of :message_type: is queued for each
+    of them until the changes are committed.
+    """
     def decorator(func):
         def wrapped(*args, **kwargs):
-            result = func(*args, **kwargs)
-            if au_daemon_pid:
-                os.kill(daemon_pid, signum)
-            return result
+            template_ids = func(*args, **kwargs)
+            for template_id in template_ids:
+                pending_notifications.append({
+                    "type": message_type,
+                    "template_id": template_id,
+                })
+            return template_ids
 
         return wrapped
 
     return decorator
 
 
-@signal_au_daemon(signal.SIGUSR1)
-def connect(cursor, instance_path, template):
+def notify_au_daemon():
+    """ Sends the pending notifications to the auto update daemon and waits
+    for each to be applied. Call after the changes are committed."""
+    # imported when needed to keep sockets out of the startup of fst
+    import fst.au.control
+
+    while pending_notifications:
+        message = pending_notifications.pop(0)
+        reply = fst.au.control.request(message)
+        if reply is None:
+            fst.trace.info(
+                'Auto update daemon is not running. It will pick up the '
+                'changes when started.'
+            )
+            pending_notifications.clear()
+        elif not reply["ok"]:
+            fst.trace.warn(
+                'Auto update daemon failed to apply %r: %s',
+                message,
+                reply["error"]
+            )
+
+
+@au_daemon_message("instance_connected")
+def connect(cursor, instance_path, template, progress=None):
     assert template['id']
     assert_user(
         os.path.isdir(instance_path),
@@ -45,7 +72,8 @@ def connect(cursor, instance_path, template):
     )
     fst.conform.conform_dir_to_template(
         dir_path=instance_path,
-        template_path=template['path']
+        template_path=template_tree(cursor, template),
+        progress=progress
     )
     try:
         cursor.execute(
@@ -71,11 +99,135 @@ def connect(cursor, instance_path, template):
             cursor.rowcount),
         "TMPUSRR004",
     )
-    return
+    return [template['id']]
+
+
+@au_daemon_message("instance_connected")
+def connect_many(cursor, instance_paths, template, jobs):
+    """ Connects many directories to a template at once.
+
+    Every path is validated before anything is changed. The directories are
+    then conformed on a pool of :jobs: threads and inserted by one
+    executemany() in the caller's transaction, so the daemon is notified once.
+    :instance_paths: must not repeat a path.
+    """
+    assert template['id']
+    paths = list(instance_paths)
+    assert_user(paths, "no instances to connect", "TMPUSRR005")
+    assert_user(
+        os.path.isdir(template['path']),
+        "template {} is not a directory".format(template['path']),
+        "TMPUSRR002",
+    )
+    not_dirs = [p for p in paths if not os.path.isdir(p)]
+    assert_user(
+        not not_dirs,
+        "{} path(s) are not directories: {}".format(
+            len(not_dirs), _sample(not_dirs)
+        ),
+        "TMPUSRR001",
+    )
+    registered = []
+    for path in paths:
+        cursor.execute("SELECT 1 FROM instances WHERE path=?", [path])
+        if cursor.fetchone():
+            registered.append(path)
+    assert_user(
+        not registered,
+        "{} instance(s) already registered (but might be inactive): {}".format(
+            len(registered), _sample(registered)
+        ),
+        "TMPUSRR003",
+    )
 
+    tree = template_tree(cursor, template)
+    failed = [
+        result.path
+        for result in fst.conform.conform_dirs(
+            ((p, tree) for p in paths), jobs=jobs
+        )
+        if result.error
+    ]
+    assert_user(
+        not failed,
+        "{} instance(s) could not be conformed: {}".format(
+            len(failed), _sample(failed)
+        ),
+        "TMPUSRR006",
+    )
 
-@signal_au_daemon(signal.SIGUSR1)
+    try:
+        cursor.executemany(
+            """
+                INSERT INTO instances (path, template_id)
+                    SELECT ?, id FROM templates AS T
+                    WHERE T.id=? AND T.active=1
+            """,
+            ((p, template['id']) for p in paths),
+        )
+    except sqlite3.IntegrityError as e:
+        assert_user(
+            0,
+            "an instance is already registered or given twice",
+            "TMPUSRR003",
+            from_exc=e
+        )
+    assert_user(
+        cursor.rowcount == len(paths),
+        "template {} does not exist.".format(template['name']),
+        "TMPUSRR004",
+    )
+    fst.trace.info(
+        "Connected %s instances to template:%s", len(paths), template['name']
+    )
+    return [template['id']]
+
+
+@au_daemon_message("template_changed")
+def ignore(cursor, template, patterns):
+    """ Ignores directories matching shell patterns in a template and its
+    instances and drops them from its index."""
+    fst.ignore.add_patterns(cursor, template['id'], patterns)
+    fst.index.remove_ignored(
+        cursor, template['id'], fst.ignore.pull_rules(cursor, template['id'])
+    )
+    return [template['id']]
+
+
+@au_daemon_message("template_changed")
+def unignore(cursor, template, patterns):
+    """ Stops ignoring directories matching shell patterns.
+
+    The index is left to the auto update daemon, which creates the
+    directories in the instances when it scans the template next. Their
+    parents are listed again because the recorded mtimes are dropped.
+    """
+    removed = fst.ignore.remove_patterns(cursor, template['id'], patterns)
+    assert_user(
+        removed == len(set(patterns)),
+        "template {} does not ignore all of {}".format(
+            template['name'], ", ".join(patterns)
+        ),
+        "TMPUSRIG001",
+    )
+    fst.index.store_mtimes(cursor, template['id'], {})
+    return [template['id']]
+
+
+def _sample(paths, count=5):
+    sample = ", ".join(paths[:count])
+    if len(paths) > count:
+        sample += ", ..."
+    return sample
+
+
+@au_daemon_message("instance_disconnected")
 def disconnect(cursor, instance):
+    cursor.execute(
+        "SELECT template_id FROM instances WHERE path=? AND active=1",
+        [instance],
+    )
+    template_ids = [row['template_id'] for row in cursor.fetchall()]
     cursor.execute(
         """
         UPDATE instances SET active=0
@@ -88,19 +240,17 @@ def disconnect(cursor, instance):
         "Path {} is not a connected instance.".format(instance),
         "TMPUSRU001",
     )
-    return
+    return template_ids
 
 
-@signal_au_daemon(signal.SIGUSR1)
+@au_daemon_message("template_added")
 def add_template(cursor, path, name):
     assert_user(
         os.path.isdir(path), "{} is not a directory".format(path), "TMPUSRAT001"
     )
 
-    md5_hash = hashlib.md5()
-    for p in fst.dirdiff.flattened_subdirs(path):
-        md5_hash.update(p.encode("utf-8"))
-    checksum = md5_hash.hexdigest()
+    tree = fst.dirdiff.DirTree.from_disk(path)
+    checksum = tree.checksum()
 
     try:
         cursor.execute(
@@ -117,13 +267,46 @@ def add_template(cursor, path, name):
             "TMPUSRAT002",
             from_exc=err,
         )
+    template_id = cursor.lastrowid
+    fst.index.store_tree(cursor, template_id, tree)
+
+    return [template_id]
+
+
+def template_tree(cursor, template):
+    """ Returns the structure of a template as a DirTree.
 
-    return
+    While the auto update daemon watches the template the structure it holds
+    in memory is used because it's the one keeping it current. Otherwise the
+    template is walked. The index isn't touched - it's the snapshot the daemon
+    catches up from when it starts.
+    """
+    import fst.au.control
+
+    reply = fst.au.control.request(
+        {"type": "tree", "template_id": template['id']}
+    )
+    if reply and reply["ok"]:
+        if reply["pending"]:
+            fst.trace.info(
+                'Auto update daemon has %s events to apply.', reply["pending"]
+            )
+        return fst.dirdiff.DirTree.from_pairs(
+            os.path.split(p) for p in reply["paths"]
+        )
+    return fst.dirdiff.DirTree.from_disk(
+        template['path'], ignore=fst.ignore.pull_rules(cursor, template['id'])
+    )
 
 
-@signal_au_daemon(signal.SIGUSR1)
+@au_daemon_message("template_removed")
 def rm_template(cursor, path=None, name=None):
     assert path or name
+    cursor.execute(
+        "SELECT id FROM templates WHERE (path=? or name=?) AND active=1",
+        [path, name],
+    )
+    template_ids = [row['id'] for row in cursor.fetchall()]
     cursor.execute(
         """
         UPDATE templates SET active=0
@@ -136,47 +319,4 @@ def rm_template(cursor, path=None, name=None):
         "Templates with path={} or name={} does not exist".format(path, name),
         "TMPUSRRT001",
     )
-
-
-def pull_relationships_by_template(cursor, template=None, instance=None):
-    pull_all = not template and not instance
-    cursor.execute(
-        """
-        SELECT
-            T.id AS t_id,
-            T.name AS t_name,
-            T.path AS t_path,
-            T.checksum AS t_checksum,
-            T.active AS t_active,
-            I.id AS i_id,
-            I.path AS i_path,
-            I.template_id AS i_template_id,
-            I.active AS i_active
-        FROM templates AS T
-        LEFT JOIN instances AS I ON T.id=I.template_id
-        WHERE
-            T.active=1 AND
-            (I.active=1 OR I.active IS NULL) AND
-            (T.path = ?  OR T.name = ?  OR I.path = ? OR true=?)
-        """,
-        [template, template, instance, pull_all],
-    )
-    templates = {}
-    for row in cursor.fetchall():
-        template = {
-            col[2:]: row[col]
-            for col in row.keys() if col.startswith("t_")
-        }
-        instance = {
-            col[2:]: row[col]
-            for col in row.keys() if col.startswith("i_")
-        }
-        if all(template['id'] != t for t in templates):
-            templates[template['id']] = {
-                'template_row': template,
-                'instances': {},
-            }
-        if instance and instance['id'] is not None:
-            templates[template['id']]['instances'][instance['id']] = instance
-
-    return templates
+    return template_ids
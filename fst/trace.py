@@ -1,25 +1,58 @@
+"""
+Logging shortcuts used throughout fst.
+
+logging is imported and the handlers are attached by the first call so that
+commands which never log, like `fst --help`, don't pay for either.
+"""
 import os
-import logging
-
-
-root = logging.getLogger()
-root.setLevel(logging.DEBUG)
-formatter = logging.Formatter(
-    "%(asctime)-15s %(module)s %(lineno)d %(message)s"
-)
-file_handler = logging.FileHandler(
-    filename=os.path.join(os.environ['HOME'], '.fst.log')
-)
-file_handler.setFormatter(formatter)
-file_handler.setLevel(logging.DEBUG)
-root.addHandler(file_handler)
-stream_handler = logging.StreamHandler()
-stream_handler.setLevel(logging.DEBUG)
-stream_handler.setFormatter(formatter)
-root.addHandler(stream_handler)
-
-trace = logging.debug
-info = logging.info
-warn = logging.warn
-error = logging.error
-exception = logging.exception
+import sys
+
+_logging = None
+# attribute records to the caller of the shortcut instead of this module
+_CALLER = {"stacklevel": 2} if sys.version_info >= (3, 8) else {}
+
+
+def _setup():
+    global _logging
+    if _logging is not None:
+        return _logging
+
+    import logging
+
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG)
+    formatter = logging.Formatter(
+        "%(asctime)-15s %(module)s %(lineno)d %(message)s"
+    )
+    file_handler = logging.FileHandler(
+        filename=os.path.join(os.environ['HOME'], '.fst.log')
+    )
+    file_handler.setFormatter(formatter)
+    file_handler.setLevel(logging.DEBUG)
+    root.addHandler(file_handler)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setLevel(logging.DEBUG)
+    stream_handler.setFormatter(formatter)
+    root.addHandler(stream_handler)
+    _logging = logging
+    return logging
+
+
+def trace(msg, *args, **kwargs):
+    _setup().debug(msg, *args, **kwargs, **_CALLER)
+
+
+def info(msg, *args, **kwargs):
+    _setup().info(msg, *args, **kwargs, **_CALLER)
+
+
+def warn(msg, *args, **kwargs):
+    _setup().warning(msg, *args, **kwargs, **_CALLER)
+
+
+def error(msg, *args, **kwargs):
+    _setup().error(msg, *args, **kwargs, **_CALLER)
+
+
+def exception(msg, *args, **kwargs):
+    _setup().exception(msg, *args, **kwargs, **_CALLER)
@@ -126,8 +126,8 @@ setup(
     author=AUTHOR,
     author_email=EMAIL,
     url=URL,
-    packages=find_packages(exclude=("tests",)),
-    python_requires=">=3.6",
+    packages=find_packages(exclude=("tests", "bench", "bench.*")),
+    python_requires=">=3.7",
     # If your package is a single module, use this instead of 'packages':
     # py_modules=['mypackage'],
     entry_points={
@@ -140,7 +140,7 @@ setup(
         "Development Status :: 3 - Alpha",
         "Operating System :: POSIX :: Linux",
         "License :: OSI Approved :: MIT License",
-        "Programming Language :: Python :: 3.6",
+        "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: Implementation :: CPython",
     ],
     # $ setup.py publish support.
@@ -0,0 +1,43 @@
+import random
+
+import pytest
+
+import fst.au.daemon
+import fst.au.events
+import fst.db
+import fst.dirdiff
+import fst.index
+from tests.trees import make_dirs, walk_oracle
+
+
+@pytest.fixture(params=range(8))
+def rng(request):
+    return random.Random(request.param)
+
+
+@pytest.fixture
+def handler(tmp_path):
+    """ A handler of a template with two conformed instances whose events are
+    applied by calling its apply_ methods."""
+    template_path = make_dirs(str(tmp_path / "template"), ["a/b/c", "a/d"])
+    instances = [
+        {"path": make_dirs(str(tmp_path / name), walk_oracle(template_path))}
+        for name in ("i1", "i2")
+    ]
+    conn = fst.db.connect(str(tmp_path / "fst.db"))
+    with conn:
+        conn.execute(
+            "INSERT INTO templates (path, name, checksum) VALUES (?, ?, ?)",
+            [template_path, "template", ""]
+        )
+        fst.index.store_tree(
+            conn.cursor(), 1, fst.dirdiff.DirTree.from_disk(template_path)
+        )
+    handler = fst.au.daemon.TemplateEventHandler(
+        template={"id": 1, "name": "template", "path": template_path},
+        instances=instances,
+        conn=conn,
+        queue=fst.au.events.EventQueue(debounce=0, batch_size=1)
+    )
+    yield handler
+    conn.close()
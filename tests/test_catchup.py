@@ -0,0 +1,82 @@
+import os
+import os.path
+
+import fst.au.catchup
+import fst.dirdiff
+import fst.ignore
+import fst.index
+from tests.trees import make_dirs, random_paths, walk_oracle
+
+
+def test_scan(tmp_path, rng):
+    root = make_dirs(str(tmp_path), random_paths(rng, 30))
+    empty = fst.dirdiff.DirTree({})
+    result = fst.au.catchup.scan(root, empty, {})
+    assert result.tree.paths() == walk_oracle(root)
+    assert sorted(result.listed) == sorted([""] + walk_oracle(root))
+
+    # unchanged directories come from the snapshot
+    again = fst.au.catchup.scan(root, result.tree, result.mtimes)
+    assert again.listed == []
+    assert again.tree == result.tree
+
+    rel_path = rng.choice(walk_oracle(root))
+    os.mkdir(os.path.join(root, rel_path, "new"))
+    again = fst.au.catchup.scan(root, result.tree, result.mtimes)
+    assert sorted(again.listed) == [rel_path, os.path.join(rel_path, "new")]
+    assert again.tree.paths() == walk_oracle(root)
+
+
+def test_scan_ignore(tmp_path, rng):
+    root = make_dirs(str(tmp_path), random_paths(rng, 30))
+    ignore = fst.ignore.IgnoreRules(["b"])
+    result = fst.au.catchup.scan(root, fst.dirdiff.DirTree({}), {}, ignore)
+    assert result.tree.paths() == [
+        p for p in walk_oracle(root) if "b" not in p.split(os.sep)
+    ]
+
+
+def test_catch_up(handler):
+    template_path = handler.template["path"]
+    first = fst.au.catchup.catch_up(handler)
+    assert (first.created, first.deleted) == (0, 0)
+    assert first.listed == first.scanned == 5
+
+    unchanged = fst.au.catchup.catch_up(handler)
+    assert unchanged.listed == 0
+    assert unchanged.listed_mtimes == {}
+
+    make_dirs(template_path, ["a/b/n/m", "x"])
+    os.rmdir(os.path.join(template_path, "a/d"))
+    handler.propagate_deletes = True
+    caught_up = fst.au.catchup.catch_up(handler)
+    assert (caught_up.created, caught_up.deleted) == (2, 1)
+    # the parents whose listings changed and the new directories
+    assert sorted(caught_up.listed_mtimes) == [
+        "", "a", "a/b", "a/b/n", "a/b/n/m", "x"
+    ]
+    assert not fst.au.catchup.changed_since(
+        template_path, caught_up.listed_mtimes
+    )
+    for i in handler.instances:
+        assert walk_oracle(i["path"]) == walk_oracle(template_path)
+    cursor = handler.conn.cursor()
+    assert fst.index.pull_tree(cursor, 1).paths() == \
+        walk_oracle(template_path)
+    assert set(fst.index.pull_mtimes(cursor, 1)) == \
+        set([""] + walk_oracle(template_path))
+
+
+def test_changed_since(tmp_path):
+    root = make_dirs(str(tmp_path), ["a/b"])
+    mtimes = {
+        rel_path: os.stat(os.path.join(root, rel_path)).st_mtime_ns
+        for rel_path in ["", "a", "a/b"]
+    }
+    assert not fst.au.catchup.changed_since(root, mtimes)
+    os.mkdir(os.path.join(root, "a/b/c"))
+    assert fst.au.catchup.changed_since(root, mtimes)
+    assert not fst.au.catchup.changed_since(root, {"": mtimes[""]})
+    os.rmdir(os.path.join(root, "a/b/c"))
+    os.rmdir(os.path.join(root, "a/b"))
+    assert fst.au.catchup.changed_since(root, {"a/b": mtimes["a/b"]})
@@ -0,0 +1,102 @@
+import os
+import os.path
+
+import pytest
+
+import fst.conform
+import fst.dirdiff
+from tests.trees import make_dirs, random_paths, walk_oracle
+
+
+def test_materialize_creates_plan(tmp_path, rng):
+    template = make_dirs(str(tmp_path / "template"), random_paths(rng, 30))
+    root = make_dirs(str(tmp_path / "root"), [])
+    plan = walk_oracle(template)
+    created = fst.conform.materialize(root, iter(plan))
+    assert created == [os.path.join(root, p) for p in plan]
+    assert walk_oracle(root) == plan
+
+
+def test_materialize_skips_existing_directories(tmp_path):
+    root = make_dirs(str(tmp_path / "root"), ["a/b", "c"])
+    created = fst.conform.materialize(root, ["a", "a/b", "a/b/x", "c", "d"])
+    assert created == [
+        os.path.join(root, "a/b/x"), os.path.join(root, "d")
+    ]
+    assert walk_oracle(root) == ["a", "a/b", "a/b/x", "c", "d"]
+
+
+def test_materialize_follows_symlinked_directories(tmp_path):
+    root = make_dirs(str(tmp_path / "root"), ["real"])
+    os.symlink(os.path.join(root, "real"), os.path.join(root, "link"))
+    fst.conform.materialize(root, ["link", "link/x"])
+    assert os.path.isdir(os.path.join(root, "real", "x"))
+
+
+def test_materialize_rejects_files_in_the_way(tmp_path):
+    root = make_dirs(str(tmp_path / "root"), [])
+    open(os.path.join(root, "a"), "w").close()
+    with pytest.raises(FileExistsError):
+        fst.conform.materialize(root, ["a", "a/b"])
+
+
+def test_materialize_progress(tmp_path):
+    root = make_dirs(str(tmp_path / "root"), ["a"])
+    calls = []
+    fst.conform.materialize(root, ["a", "a/b", "c"],
+                            progress=lambda *args: calls.append(args))
+    assert calls == [(1, 3), (2, 3), (3, 3)]
+    calls.clear()
+    fst.conform.materialize(root, iter(["d"]),
+                            progress=lambda *args: calls.append(args))
+    assert calls == [(1, None)]
+
+
+def test_conform_dir_to_template(tmp_path, rng):
+    template = make_dirs(str(tmp_path / "template"), random_paths(rng, 30))
+    instance = make_dirs(str(tmp_path / "instance"), random_paths(rng, 10))
+    before = set(walk_oracle(instance))
+    created = fst.conform.conform_dir_to_template(instance, template)
+    assert created == [
+        os.path.join(instance, p)
+        for p in walk_oracle(template) if p not in before
+    ]
+    assert fst.dirdiff.is_subset(template, instance)
+
+
+def test_conform_dir_inside_its_template(tmp_path, rng):
+    template = make_dirs(str(tmp_path / "template"), random_paths(rng, 10))
+    instance = make_dirs(os.path.join(template, "instance"), [])
+    expected = set(walk_oracle(template))
+    fst.conform.conform_dir_to_template(instance, template)
+    # only what the template had before the instance got filled
+    assert set(walk_oracle(instance)) == expected
+
+
+def test_conform_dirs(tmp_path, rng):
+    template = make_dirs(str(tmp_path / "template"), random_paths(rng, 20))
+    instances = [
+        make_dirs(str(tmp_path / "i{}".format(n)), random_paths(rng, 5))
+        for n in range(4)
+    ]
+    missing = str(tmp_path / "missing")
+    tree = fst.dirdiff.DirTree.from_disk(template)
+    statuses = list(fst.conform.check_conformity(
+        [(i, tree) for i in instances + [missing]], jobs=3
+    ))
+    assert [s.path for s in statuses] == instances + [missing]
+    assert not any(s.conformed for s in statuses)
+    assert isinstance(statuses[-1].error, FileNotFoundError)
+
+    results = list(fst.conform.conform_dirs(
+        [(i, tree) for i in instances + [missing]], jobs=3
+    ))
+    assert [r.path for r in results] == instances + [missing]
+    assert all(r.error is None for r in results[:-1])
+    assert results[-1].created == [] and results[-1].error
+    assert all(
+        s.conformed and s.error is None
+        for s in fst.conform.check_conformity(
+            [(i, template) for i in instances], jobs=2
+        )
+    )
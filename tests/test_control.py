@@ -0,0 +1,63 @@
+import json
+import os
+import socket
+
+import pytest
+
+import fst.au.control
+
+
+def fail(message):
+    raise ValueError("no template {}".format(message["template_id"]))
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = fst.au.control.ControlServer(str(tmp_path / "ctl"), {
+        "ping": lambda message: {"pid": os.getpid()},
+        "tree": fail,
+    })
+    server.start()
+    yield server
+    server.stop()
+    server.join()
+
+
+def test_request(server):
+    assert fst.au.control.request({"type": "ping"}, server.path) == {
+        "ok": True, "pid": os.getpid()
+    }
+    assert oct(os.stat(server.path).st_mode & 0o777) == oct(0o600)
+
+
+def test_failed_requests(server):
+    assert fst.au.control.request(
+        {"type": "tree", "template_id": 7}, server.path
+    ) == {"ok": False, "error": "no template 7"}
+    reply = fst.au.control.request({"type": "unknown"}, server.path)
+    assert not reply["ok"]
+    assert reply["error"].startswith("malformed message")
+
+
+def test_one_reply_per_line(server):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(fst.au.control.TIMEOUT)
+        sock.connect(server.path)
+        with sock.makefile("rwb") as stream:
+            stream.write(b'{"type": "ping"}\nnot json\n{"type": "ping"}\n')
+            stream.flush()
+            replies = [json.loads(stream.readline()) for _ in range(3)]
+    assert [reply["ok"] for reply in replies] == [True, False, True]
+
+
+def test_not_listening(tmp_path):
+    path = str(tmp_path / "ctl")
+    assert fst.au.control.request({"type": "ping"}, path) is None
+    assert fst.au.control.request({"type": "ping"}, None) is None
+    server = fst.au.control.ControlServer(path, {})
+    server.start()
+    server.stop()
+    server.join()
+    # the socket is removed when the server stops
+    assert not os.path.exists(path)
+    assert fst.au.control.request({"type": "ping"}, path) is None
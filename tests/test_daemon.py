@@ -0,0 +1,36 @@
+import os
+import os.path
+
+import fst.index
+from tests.trees import walk_oracle
+
+
+def indexed(handler):
+    return fst.index.pull_tree(handler.conn.cursor(), 1).paths()
+
+
+def test_apply_moved_renames_in_instances(handler):
+    template_path = handler.template["path"]
+    os.rename(os.path.join(template_path, "a/b"),
+              os.path.join(template_path, "m"))
+    handler.apply_moved([("a/b", "m")])
+    # moves of descendants reported in a later batch are already done
+    handler.apply_moved([("a/b/c", "m/c")])
+    for i in handler.instances:
+        assert walk_oracle(i["path"]) == walk_oracle(template_path)
+    assert indexed(handler) == walk_oracle(template_path)
+
+
+def test_apply_moved_creates_where_rename_fails(handler):
+    template_path = handler.template["path"]
+    os.rename(os.path.join(template_path, "a/b"),
+              os.path.join(template_path, "m"))
+    broken, intact = handler.instances
+    os.rename(os.path.join(broken["path"], "a/b"),
+              os.path.join(broken["path"], "elsewhere"))
+    handler.apply_moved([("a/b", "m")])
+    assert walk_oracle(intact["path"]) == walk_oracle(template_path)
+    # created from the index and the old subtree is kept
+    assert set(walk_oracle(broken["path"])) == set(
+        walk_oracle(template_path) + ["elsewhere", "elsewhere/c"]
+    )
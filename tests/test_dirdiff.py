@@ -0,0 +1,117 @@
+import os.path
+
+import pytest
+
+import fst.dirdiff
+import fst.ignore
+from tests.trees import make_dirs, random_paths, walk_oracle
+
+
+@pytest.fixture
+def pair(tmp_path, rng):
+    """ Two random trees with many directories in common."""
+    target = make_dirs(str(tmp_path / "target"), random_paths(rng, 20))
+    origin = make_dirs(str(tmp_path / "origin"), random_paths(rng, 20))
+    return target, origin
+
+
+def test_walk_matches_os_walk(tmp_path, rng):
+    root = make_dirs(str(tmp_path), random_paths(rng, 30))
+    walked = list(fst.dirdiff.walk(root))
+    assert walked[0][0] == ""
+    assert [rel_path for rel_path, _ in walked[1:]] == walk_oracle(root)
+    for rel_path, (listing,) in walked:
+        assert listing == sorted(
+            e.name for e in os.scandir(os.path.join(root, rel_path))
+            if e.is_dir()
+        )
+
+
+def test_walk_side_by_side(pair):
+    target, origin = pair
+    in_target = set(walk_oracle(target))
+    for rel_path, (_, listing) in fst.dirdiff.walk(origin, target):
+        assert (listing is not None) == (not rel_path or rel_path in in_target)
+
+
+def test_walk_prune(pair):
+    target, origin = pair
+    in_target = set(walk_oracle(target))
+    walked = [p for p, _ in fst.dirdiff.walk(origin, target, prune=True)]
+    # missing directories are yielded but their subtrees aren't
+    assert walked[1:] == [
+        p for p in walk_oracle(origin)
+        if os.path.dirname(p) in in_target or not os.path.dirname(p)
+    ]
+
+
+def test_is_subset(pair):
+    target, origin = pair
+    expected = set(walk_oracle(origin)) <= set(walk_oracle(target))
+    assert fst.dirdiff.is_subset(origin, target) == expected
+    make_dirs(target, walk_oracle(origin))
+    assert fst.dirdiff.is_subset(origin, target)
+
+
+def test_iter_subdirs(tmp_path, rng):
+    root = make_dirs(str(tmp_path), random_paths(rng, 30))
+    assert list(fst.dirdiff.iter_subdirs(root)) == walk_oracle(root)
+    assert list(fst.dirdiff.iter_subdirs(root, appended=True)) == [
+        os.path.join(root, p) for p in walk_oracle(root)
+    ]
+
+
+def test_iter_missing(pair):
+    target, origin = pair
+    in_target = set(walk_oracle(target))
+    assert list(fst.dirdiff.iter_missing(target, origin)) == [
+        p for p in walk_oracle(origin) if p not in in_target
+    ]
+
+
+def test_iter_missing_pre_order(tmp_path):
+    origin = make_dirs(str(tmp_path / "origin"), ["P/a/x", "P/b/c"])
+    target = make_dirs(str(tmp_path / "target"), ["P/a"])
+    assert list(fst.dirdiff.iter_missing(target, origin)) == [
+        "P/a/x", "P/b", "P/b/c"
+    ]
+
+
+def test_missing_from(pair):
+    target, origin = pair
+    expected = sorted(fst.dirdiff.iter_missing(target, origin))
+    assert fst.dirdiff.missing_from(target, origin) == expected
+    assert fst.dirdiff.missing_from(target, origin, True) == [
+        os.path.join(target, p) for p in expected
+    ]
+
+
+def test_dir_tree_subtree(tmp_path, rng):
+    root = make_dirs(str(tmp_path), random_paths(rng, 30))
+    tree = fst.dirdiff.DirTree.from_disk(root)
+    paths = walk_oracle(root)
+    assert tree.paths() == paths
+    for rel_path in paths:
+        assert list(tree.subtree(rel_path)) == [rel_path] + [
+            p for p in paths if p.startswith(rel_path + os.sep)
+        ]
+
+
+def test_iter_missing_from_dir_tree(pair):
+    target, origin = pair
+    tree = fst.dirdiff.DirTree.from_disk(origin)
+    assert list(fst.dirdiff.iter_missing(target, tree)) == list(
+        fst.dirdiff.iter_missing(target, origin)
+    )
+    assert list(fst.dirdiff.iter_missing(target, tree)) == [
+        p for p in walk_oracle(origin) if p not in set(walk_oracle(target))
+    ]
+
+
+def test_walk_ignore(tmp_path, rng):
+    root = make_dirs(str(tmp_path), random_paths(rng, 30))
+    ignore = fst.ignore.IgnoreRules(["b"])
+    expected = [p for p in walk_oracle(root) if "b" not in p.split(os.sep)]
+    assert list(fst.dirdiff.iter_subdirs(root, ignore=ignore)) == expected
+    assert fst.dirdiff.DirTree.from_disk(root, ignore=ignore).paths() == \
+        expected
@@ -0,0 +1,94 @@
+from fst.au.events import EventQueue, coalesce, subtree_roots
+
+
+def test_subtree_roots():
+    assert subtree_roots(["a/b", "a", "a/b/c", "ab", "b/c", "b/c/"]) == [
+        "a", "ab", "b/c"
+    ]
+
+
+def test_subtree_roots_sibling_prefix():
+    # a-b sorts between a and a/b as a string but isn't under a
+    assert subtree_roots(["a/b", "a-b", "a"]) == ["a", "a-b"]
+
+
+def test_subtree_roots_empty():
+    assert subtree_roots([]) == []
+
+
+def test_coalesce_merges_runs_per_handler():
+    batch = [
+        ("h1", "created", "a", 1),
+        ("h2", "deleted", "x", 2),
+        ("h1", "created", "a/b", 3),
+        ("h1", "moved", ("a", "c"), 4),
+        ("h1", "created", "d", 5),
+        ("h2", "deleted", "y", 6),
+    ]
+    assert coalesce(batch) == [
+        ("h1", "created", ["a"], [1, 3]),
+        ("h1", "moved", [("a", "c")], [4]),
+        ("h1", "created", ["d"], [5]),
+        ("h2", "deleted", ["x", "y"], [2, 6]),
+    ]
+
+
+def test_coalesce_keeps_order_of_other_kinds():
+    batch = [
+        ("h", "file_changed", "b/f", 1),
+        ("h", "file_changed", "a/f", 2),
+        ("h", "file_changed", "b/f", 3),
+    ]
+    assert coalesce(batch) == [
+        ("h", "file_changed", ["b/f", "a/f", "b/f"], [1, 2, 3]),
+    ]
+
+
+class RecordingHandler:
+    template = {"name": "template"}
+
+    def __init__(self):
+        self.applied = []
+
+    def apply_created(self, rel_paths):
+        self.applied.append(("created", rel_paths))
+
+    def apply_deleted(self, rel_paths):
+        self.applied.append(("deleted", rel_paths))
+
+    def apply_failing(self, rel_paths):
+        raise RuntimeError("broken handler")
+
+
+def test_event_queue_applies_batches_in_order():
+    events = EventQueue(debounce=0.05, batch_size=100)
+    handler = RecordingHandler()
+    events.start()
+    for rel_path in ["a", "a/b", "c"]:
+        events.put(handler, "created", rel_path)
+    events.put(handler, "failing", "x")
+    events.put(handler, "deleted", "c")
+    events.stop()
+    assert handler.applied == [
+        ("created", ["a", "c"]),
+        ("deleted", ["c"]),
+    ]
+    rendered = events.metrics.render()
+    assert 'fstd_errors_total{template="template"} 1\n' in rendered
+    assert 'fstd_events_total{kind="created",template="template"} 3\n' in \
+        rendered
+
+
+def test_coalesce_drops_moves_of_moved_subtrees():
+    batch = [
+        ("h", "moved", ("a/b", "m"), 1),
+        ("h", "moved", ("a/b/c", "m/c"), 2),
+        ("h", "moved", ("a/b/c/d", "m/c/d"), 3),
+        # not implied by the first move
+        ("h", "moved", ("a/b/e", "x/e"), 4),
+        ("h", "moved", ("a/bc", "n"), 5),
+    ]
+    assert coalesce(batch) == [
+        ("h", "moved", [("a/b", "m"), ("a/b/e", "x/e"), ("a/bc", "n")],
+         [1, 2, 3, 4, 5]),
+    ]
@@ -0,0 +1,182 @@
+import errno
+import os
+import os.path
+
+import pytest
+
+import fst.files
+import fst.ignore
+from tests.trees import make_dirs
+
+
+def write(path, data, mtime_ns=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+    return path
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def unsupported(*args):
+    raise OSError(errno.EOPNOTSUPP, "not supported")
+
+
+@pytest.fixture
+def template(tmp_path):
+    root = make_dirs(str(tmp_path / "template"), ["a/b", "c", "skip/d"])
+    for rel_path in ["f", "a/g", "a/b/h", "skip/i", "skip/d/j"]:
+        write(os.path.join(root, rel_path), rel_path.encode(), 10 ** 18)
+    os.symlink("f", os.path.join(root, "link"))
+    return root
+
+
+def test_iter_files(template):
+    assert sorted(fst.files.iter_files(template)) == [
+        "a/b/h", "a/g", "f", "skip/d/j", "skip/i"
+    ]
+    ignore = fst.ignore.IgnoreRules(["skip"])
+    assert sorted(fst.files.iter_files(template, ignore)) == [
+        "a/b/h", "a/g", "f"
+    ]
+    assert sorted(fst.files.iter_files(template, rel_path="a")) == [
+        "a/b/h", "a/g"
+    ]
+
+
+def test_is_current(tmp_path):
+    src = write(str(tmp_path / "src"), b"data", 10 ** 18)
+    dest = str(tmp_path / "dest")
+    src_stat = os.stat(src)
+    assert not fst.files.is_current(src, dest, src_stat)
+
+    write(dest, b"data", 10 ** 18)
+    assert fst.files.is_current(src, dest, src_stat)
+    write(dest, b"longer", 10 ** 18)
+    assert not fst.files.is_current(src, dest, src_stat)
+    write(dest, b"atad", 2 * 10 ** 18)
+    assert not fst.files.is_current(src, dest, src_stat)
+
+    # the same content with another mtime gets the mtime of the source
+    write(dest, b"data", 2 * 10 ** 18)
+    assert fst.files.is_current(src, dest, src_stat)
+    assert os.stat(dest).st_mtime_ns == src_stat.st_mtime_ns
+
+
+def test_is_current_hardlink(tmp_path):
+    src = write(str(tmp_path / "src"), b"data")
+    dest = write(str(tmp_path / "dest"), b"data")
+    os.utime(dest, ns=(os.stat(src).st_atime_ns, os.stat(src).st_mtime_ns))
+    src_stat = os.stat(src)
+    assert fst.files.is_current(src, dest, src_stat)
+    assert not fst.files.is_current(src, dest, src_stat, "hardlink")
+    os.unlink(dest)
+    os.link(src, dest)
+    assert fst.files.is_current(src, dest, src_stat, "hardlink")
+
+
+def test_copy_file(tmp_path):
+    src = write(str(tmp_path / "src"), b"data" * 1000, 10 ** 18)
+    os.chmod(src, 0o640)
+    dest = str(tmp_path / "dest")
+    assert fst.files.copy_file(src, dest) in (
+        "reflink", "copy_file_range", "buffered"
+    )
+    assert read(dest) == read(src)
+    assert os.stat(dest).st_mtime_ns == 10 ** 18
+    assert os.stat(dest).st_mode & 0o777 == 0o640
+    assert fst.files.copy_file(src, dest) is None
+    assert sorted(os.listdir(str(tmp_path))) == ["dest", "src"]
+
+
+def test_copy_file_fallbacks(tmp_path, monkeypatch):
+    src = write(str(tmp_path / "src"), os.urandom(3 * fst.files.CHUNK_SIZE))
+    monkeypatch.setattr(fst.files.fcntl, "ioctl", unsupported)
+    if hasattr(os, "copy_file_range"):
+        dest = str(tmp_path / "range")
+        assert fst.files.copy_file(src, dest) == "copy_file_range"
+        assert read(dest) == read(src)
+
+    # a failure after a partial copy starts over in user space
+    real_copy_file_range = getattr(os, "copy_file_range", None)
+    calls = []
+
+    def fail_second(src_fd, dest_fd, count):
+        calls.append(count)
+        if len(calls) > 1:
+            raise OSError(errno.EXDEV, "cross device")
+        return real_copy_file_range(src_fd, dest_fd, count)
+
+    if real_copy_file_range:
+        monkeypatch.setattr(os, "copy_file_range", fail_second)
+    dest = str(tmp_path / "buffered")
+    assert fst.files.copy_file(src, dest) == "buffered"
+    assert read(dest) == read(src)
+
+
+def test_copy_file_error(tmp_path, monkeypatch):
+    src = write(str(tmp_path / "src"), b"data")
+    dest = str(tmp_path / "dest")
+
+    def fail(*args):
+        raise OSError(errno.EIO, "input/output error")
+
+    monkeypatch.setattr(fst.files.fcntl, "ioctl", fail)
+    with pytest.raises(OSError):
+        fst.files.copy_file(src, dest)
+    # the temporary file is removed
+    assert os.listdir(str(tmp_path)) == ["src"]
+
+
+def test_copy_file_hardlink(tmp_path):
+    src = write(str(tmp_path / "src"), b"data")
+    dest = write(str(tmp_path / "dest"), b"old")
+    assert fst.files.copy_file(src, dest, "hardlink") == "hardlink"
+    assert os.path.samefile(src, dest)
+    assert fst.files.copy_file(src, dest, "hardlink") is None
+
+
+def test_sync_files(template, tmp_path):
+    instance = make_dirs(str(tmp_path / "instance"), ["a"])
+    rel_paths = ["f", "a/g", "a/b/h", "gone"]
+    synced = fst.files.sync_files(template, instance, rel_paths)
+    # files removed from the template are left out
+    assert [rel_path for rel_path, _ in synced] == ["f", "a/g", "a/b/h"]
+    assert all(method for _, method in synced)
+    assert read(os.path.join(instance, "a/b/h")) == b"a/b/h"
+    assert fst.files.sync_files(template, instance, rel_paths) == [
+        ("f", None), ("a/g", None), ("a/b/h", None)
+    ]
+
+
+def test_sync_instances(template, tmp_path, monkeypatch):
+    instances = [
+        make_dirs(str(tmp_path / name), []) for name in ["i1", "i2", "i3"]
+    ]
+    write(os.path.join(instances[1], "f"), b"f", 10 ** 18)
+    copy_file = fst.files.copy_file
+
+    def fail_in_i3(src, dest, mode="copy"):
+        if dest.startswith(instances[2]):
+            raise OSError(errno.EIO, "input/output error")
+        return copy_file(src, dest, mode)
+
+    monkeypatch.setattr(fst.files, "copy_file", fail_in_i3)
+    ignore = fst.ignore.IgnoreRules(["skip"])
+    triples = [(path, template, ignore) for path in instances]
+    results = list(fst.files.sync_instances(triples, "copy", jobs=2))
+
+    assert [r.path for r in results] == instances
+    assert sorted(results[0].copied) == ["a/b/h", "a/g", "f"]
+    assert results[0].skipped == 0
+    assert results[0].error is None
+    # the current file is skipped
+    assert sorted(results[1].copied) == ["a/b/h", "a/g"]
+    assert results[1].skipped == 1
+    assert results[2].copied == []
+    assert results[2].error.errno == errno.EIO
@@ -0,0 +1,136 @@
+import io
+import os
+import time
+
+import pytest
+
+import fst.hooks
+from tests.trees import make_dirs
+
+TEMPLATE = {"name": "music", "path": "/templates/music"}
+
+
+class RecordingOutput:
+    def __init__(self):
+        self.lines = []
+
+    def write(self, tag, line):
+        self.lines.append((tag, line.rstrip("\n")))
+
+
+def alive(pid):
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            stat = f.read()
+    except (FileNotFoundError, ProcessLookupError):
+        return False
+    # a zombie that wasn't reaped yet is dead too
+    return stat.rsplit(")", 1)[1].split()[0] != "Z"
+
+
+@pytest.fixture
+def instances(tmp_path):
+    root = make_dirs(str(tmp_path), ["i1", "i2", "i3"])
+    return [os.path.join(root, name) for name in ["i1", "i2", "i3"]]
+
+
+def test_tagged_output():
+    stream = io.StringIO()
+    output = fst.hooks.TaggedOutput(stream)
+    output.write("/i1", "line\n")
+    output.write("/i2", "no newline")
+    assert stream.getvalue() == "[/i1] line\n[/i2] no newline\n"
+
+
+def test_run_hook(instances):
+    output = RecordingOutput()
+    env = fst.hooks.hook_env(TEMPLATE, instances[0])
+    result = fst.hooks.run_hook(
+        'echo "$FST_TEMPLATE $FST_TEMPLATE_PATH $FST_INSTANCE"; pwd; '
+        'echo err >&2; exit 3',
+        instances[0], env, output=output
+    )
+    assert result.returncode == 3
+    assert not result.timed_out
+    assert result.error is None
+    assert output.lines == [
+        (instances[0], "music /templates/music " + instances[0]),
+        (instances[0], instances[0]),
+        (instances[0], "err"),
+    ]
+
+
+def test_run_hook_argv(instances):
+    output = RecordingOutput()
+    result = fst.hooks.run_hook(
+        ["echo", "$FST_INSTANCE"], instances[0], {}, output=output
+    )
+    assert result.returncode == 0
+    assert output.lines == [(instances[0], "$FST_INSTANCE")]
+
+
+def test_run_hook_not_started(instances):
+    result = fst.hooks.run_hook(
+        ["/nonexistent/hook"], instances[0], {}, output=RecordingOutput()
+    )
+    assert result.returncode is None
+    assert isinstance(result.error, FileNotFoundError)
+
+
+def test_run_hook_timeout(instances, monkeypatch):
+    monkeypatch.setattr(fst.hooks, "KILL_GRACE", 0.5)
+    output = RecordingOutput()
+    # the child ignores SIGTERM and keeps the output open, the hook exits
+    start = time.perf_counter()
+    result = fst.hooks.run_hook(
+        "trap '' TERM; sleep 30 & echo $!; wait",
+        instances[0], {}, timeout=0.2, output=output
+    )
+    elapsed = time.perf_counter() - start
+    assert result.timed_out
+    assert result.returncode != 0
+    assert elapsed < 5
+    # SIGKILL of the process group got the child too
+    child = int(output.lines[0][1])
+    deadline = time.monotonic() + 2
+    while alive(child) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not alive(child)
+
+
+def test_run_hooks(instances):
+    output = RecordingOutput()
+    pairs = [(TEMPLATE, path) for path in instances]
+    results = list(fst.hooks.run_hooks(
+        '[ "$FST_INSTANCE" != "{}" ]'.format(instances[1]), pairs, jobs=2,
+        output=output
+    ))
+    assert [r.path for r in results] == instances
+    assert [r.returncode for r in results] == [0, 1, 0]
+
+
+def test_run_hooks_stopped(instances):
+    started = []
+
+    class Output(RecordingOutput):
+        def write(self, tag, line):
+            started.append(int(line))
+
+    pairs = [(TEMPLATE, path) for path in instances]
+    results = fst.hooks.run_hooks(
+        '[ "$FST_INSTANCE" = "{}" ] && exit; echo $$; exec sleep 30'.format(
+            instances[0]
+        ),
+        pairs, jobs=3, output=Output()
+    )
+    assert next(results).returncode == 0
+    deadline = time.monotonic() + 5
+    while len(started) < 2 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert len(started) == 2
+    # stopping, e.g. on ^C, terminates the hooks that still run
+    results.close()
+    deadline = time.monotonic() + 5
+    while any(map(alive, started)) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not any(map(alive, started))
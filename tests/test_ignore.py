@@ -0,0 +1,28 @@
+from fst.ignore import IgnoreRules
+
+
+def test_match():
+    rules = IgnoreRules([".git", "*.cache"])
+    assert rules.match(".git")
+    assert rules.match("pip.cache")
+    assert not rules.match("git")
+    assert not rules.match("cache")
+
+
+def test_ignores_any_component():
+    rules = IgnoreRules(["*.cache"])
+    assert rules.ignores("a/b.cache/c")
+    assert not rules.ignores("a/b/c")
+    assert not IgnoreRules().ignores("a.cache")
+
+
+def test_filter_keeps_order():
+    rules = IgnoreRules(["node_modules"])
+    assert rules.filter(["z", "node_modules", "a"]) == ["z", "a"]
+    assert IgnoreRules().filter(("b", "a")) == ["b", "a"]
+
+
+def test_equality_ignores_order_and_duplicates():
+    assert IgnoreRules(["b", "a", "a"]) == IgnoreRules(["a", "b"])
+    assert not IgnoreRules()
+    assert IgnoreRules(["a"])
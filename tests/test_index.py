@@ -0,0 +1,146 @@
+import os.path
+
+import pytest
+
+import fst.db
+import fst.dirdiff
+import fst.ignore
+import fst.index
+from tests.trees import make_dirs, random_paths, walk_oracle
+
+
+@pytest.fixture
+def cursor(tmp_path):
+    conn = fst.db.connect(str(tmp_path / "fst.db"))
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT INTO templates (path, name, checksum) VALUES (?, ?, ?)",
+        ["/template", "template", ""]
+    )
+    yield cursor
+    conn.close()
+
+
+def tree_of(rel_paths):
+    pairs = set()
+    for rel_path in rel_paths:
+        while rel_path:
+            pairs.add(os.path.split(rel_path))
+            rel_path = os.path.dirname(rel_path)
+    return fst.dirdiff.DirTree.from_pairs(pairs)
+
+
+def test_dir_tree_from_disk(tmp_path, rng):
+    root = make_dirs(str(tmp_path), random_paths(rng, 30))
+    tree = fst.dirdiff.DirTree.from_disk(root)
+    assert tree.paths() == walk_oracle(root)
+    assert tree == tree_of(walk_oracle(root))
+
+
+def test_store_and_pull_tree(cursor, rng):
+    tree = tree_of(random_paths(rng, 30))
+    fst.index.store_tree(cursor, 1, tree)
+    assert fst.index.pull_tree(cursor, 1) == tree
+    # replaced, not merged
+    other = tree_of(random_paths(rng, 5))
+    fst.index.store_tree(cursor, 1, other)
+    assert fst.index.pull_tree(cursor, 1) == other
+
+
+def test_add_and_remove_dirs(cursor, rng):
+    tree = tree_of(random_paths(rng, 30))
+    fst.index.add_dirs(cursor, 1, tree.paths())
+    assert fst.index.pull_tree(cursor, 1) == tree
+    removed = tree.paths()[0]
+    fst.index.remove_dirs(cursor, 1, removed)
+    assert fst.index.pull_tree(cursor, 1).paths() == [
+        p for p in tree.paths()
+        if p != removed and not p.startswith(removed + os.sep)
+    ]
+
+
+def stored_checksums(cursor):
+    cursor.execute("SELECT path, checksum FROM template_checksums")
+    return {row['path']: row['checksum'] for row in cursor.fetchall()}
+
+
+def assert_indexes(cursor, tree):
+    assert fst.index.pull_tree(cursor, 1).paths() == tree.paths()
+    assert stored_checksums(cursor) == tree.checksums()
+    cursor.execute("SELECT checksum FROM templates WHERE id=1")
+    assert cursor.fetchone()['checksum'] == tree.checksum()
+
+
+def test_checksums_depend_on_structure_only(tmp_path):
+    first = make_dirs(str(tmp_path / "first"), ["a/b", "c"])
+    second = make_dirs(str(tmp_path / "second"), ["c", "a/b"])
+    third = make_dirs(str(tmp_path / "third"), ["a/c", "b"])
+    checksum = fst.dirdiff.DirTree.from_disk(first).checksum()
+    assert fst.dirdiff.DirTree.from_disk(second).checksum() == checksum
+    assert fst.dirdiff.DirTree.from_disk(third).checksum() != checksum
+    assert fst.dirdiff.DirTree.from_disk(first).checksum("a") != \
+        fst.dirdiff.DirTree.from_disk(third).checksum("a")
+
+
+def test_store_tree_checksums(cursor, rng):
+    tree = tree_of(random_paths(rng, 30))
+    fst.index.store_tree(cursor, 1, tree)
+    assert_indexes(cursor, tree)
+
+
+def test_update_checksums_after_add(cursor, rng):
+    paths = random_paths(rng, 20)
+    fst.index.store_tree(cursor, 1, tree_of(paths))
+    for rel_path in random_paths(rng, 10):
+        old = set(tree_of(paths).paths())
+        new = tree_of(paths + [rel_path])
+        fst.index.add_dirs(cursor, 1, [p for p in new.paths() if p not in old])
+        fst.index.update_checksums(cursor, 1, rel_path.split(os.sep)[0])
+        paths.append(rel_path)
+        assert_indexes(cursor, new)
+
+
+def test_update_checksums_after_remove(cursor, rng):
+    tree = tree_of(random_paths(rng, 30))
+    fst.index.store_tree(cursor, 1, tree)
+    # later paths can be under earlier ones that are already removed
+    for rel_path in tree.paths()[::7]:
+        remaining = [
+            p for p in fst.index.pull_tree(cursor, 1).paths()
+            if p != rel_path and not p.startswith(rel_path + os.sep)
+        ]
+        fst.index.remove_dirs(cursor, 1, rel_path)
+        fst.index.update_checksums(cursor, 1, rel_path)
+        assert_indexes(cursor, tree_of(remaining))
+
+
+def test_move_dirs(cursor, rng):
+    paths = random_paths(rng, 30, names="abc")
+    fst.index.store_tree(cursor, 1, tree_of(paths))
+    src = fst.index.pull_tree(cursor, 1).paths()[1]
+    dest = os.path.join("moved", "here")
+    assert fst.index.move_dirs(cursor, 1, src, dest)
+    moved = [
+        dest + p[len(src):]
+        if p == src or p.startswith(src + os.sep) else p
+        for p in tree_of(paths).paths()
+    ]
+    assert_indexes(cursor, tree_of(moved))
+    assert not fst.index.is_recorded(cursor, 1, src)
+    assert not fst.index.move_dirs(cursor, 1, src, dest)
+
+
+def test_remove_ignored(cursor, rng):
+    paths = random_paths(rng, 30, names="abc")
+    fst.index.store_tree(cursor, 1, tree_of(paths))
+    ignore = fst.ignore.IgnoreRules(["b"])
+    remaining = [p for p in tree_of(paths).paths() if not ignore.ignores(p)]
+    removed = fst.index.remove_ignored(cursor, 1, ignore)
+    # only the tops of the ignored subtrees
+    assert all(not ignore.ignores(os.path.dirname(p)) for p in removed)
+    assert set(removed) == {
+        p for p in tree_of(paths).paths()
+        if ignore.ignores(p) and not ignore.ignores(os.path.dirname(p))
+    }
+    assert_indexes(cursor, tree_of(remaining))
+    assert fst.index.remove_ignored(cursor, 1, ignore) == []
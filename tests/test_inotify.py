@@ -0,0 +1,144 @@
+import os
+import os.path
+import queue
+
+import pytest
+import watchdog.events
+
+import fst.au.inotify
+import fst.ignore
+from tests.trees import make_dirs
+
+pytestmark = pytest.mark.skipif(
+    not fst.au.inotify.available(), reason="needs inotify"
+)
+
+TIMEOUT = 5
+
+
+class RecordingHandler:
+    def __init__(self, ignore=None, propagate_files=None):
+        self.ignore = ignore
+        self.propagate_files = propagate_files
+        self.events = queue.Queue()
+
+    def dispatch(self, event):
+        self.events.put(event)
+
+    def on_lost_events(self, reason):
+        self.events.put(reason)
+
+    def next(self):
+        return self.events.get(timeout=TIMEOUT)
+
+    def assert_quiet(self):
+        with pytest.raises(queue.Empty):
+            self.events.get(timeout=0.2)
+
+
+def created(path):
+    return watchdog.events.DirCreatedEvent(path)
+
+
+@pytest.fixture
+def observer():
+    observer = fst.au.inotify.InotifyObserver()
+    observer.start()
+    yield observer
+    observer.stop()
+    observer.join()
+
+
+@pytest.fixture
+def root(tmp_path):
+    return make_dirs(str(tmp_path / "root"), ["a/b"])
+
+
+def test_directory_events(observer, root):
+    handler = RecordingHandler()
+    watch = observer.schedule(handler, root, recursive=True)
+    assert observer.watch_count(watch) == 3
+
+    os.mkdir(os.path.join(root, "a/b/c"))
+    assert handler.next() == created(os.path.join(root, "a/b/c"))
+    # new directories are watched
+    os.mkdir(os.path.join(root, "a/b/c/d"))
+    assert handler.next() == created(os.path.join(root, "a/b/c/d"))
+    os.rmdir(os.path.join(root, "a/b/c/d"))
+    assert handler.next() == watchdog.events.DirDeletedEvent(
+        os.path.join(root, "a/b/c/d")
+    )
+    # files are dropped
+    open(os.path.join(root, "a/f"), "w").close()
+    handler.assert_quiet()
+
+
+def test_moves(observer, root, tmp_path):
+    handler = RecordingHandler()
+    observer.schedule(handler, root, recursive=True)
+
+    os.rename(os.path.join(root, "a"), os.path.join(root, "m"))
+    assert handler.next() == watchdog.events.DirMovedEvent(
+        os.path.join(root, "a"), os.path.join(root, "m")
+    )
+    # watches of the moved subtree follow it
+    os.mkdir(os.path.join(root, "m/b/c"))
+    assert handler.next() == created(os.path.join(root, "m/b/c"))
+
+    # out of the tree and back in
+    outside = str(tmp_path / "outside")
+    os.rename(os.path.join(root, "m"), outside)
+    assert handler.next() == watchdog.events.DirDeletedEvent(
+        os.path.join(root, "m")
+    )
+    os.rename(outside, os.path.join(root, "n"))
+    assert handler.next() == created(os.path.join(root, "n"))
+    os.mkdir(os.path.join(root, "n/b/c/d"))
+    assert handler.next() == created(os.path.join(root, "n/b/c/d"))
+
+
+def test_ignore(observer, root):
+    handler = RecordingHandler(ignore=fst.ignore.IgnoreRules(["b"]))
+    watch = observer.schedule(handler, root, recursive=True)
+    assert observer.watch_count(watch) == 2
+    os.mkdir(os.path.join(root, "a/b/c"))
+    handler.assert_quiet()
+
+
+def test_file_events(observer, root):
+    handler = RecordingHandler(propagate_files="copy")
+    plain = RecordingHandler()
+    observer.schedule(handler, root, recursive=True)
+    observer.schedule(plain, root, recursive=True)
+    path = os.path.join(root, "a/f")
+    with open(path, "w") as f:
+        f.write("data")
+    assert handler.next() == watchdog.events.FileModifiedEvent(path)
+    plain.assert_quiet()
+
+
+def test_rewatch(observer, root):
+    handler = RecordingHandler()
+    watch = observer.schedule(handler, root, recursive=False)
+    assert observer.watch_count(watch) == 1
+    os.mkdir(os.path.join(root, "a/b/c"))
+    handler.assert_quiet()
+
+    assert observer.rewatch(watch, ["", "a", "a/b", "gone"]) == ["a", "a/b"]
+    assert observer.rewatch(watch, ["a"]) == []
+    os.mkdir(os.path.join(root, "a/b/d"))
+    assert handler.next() == created(os.path.join(root, "a/b/d"))
+
+
+def test_unschedule(observer, root):
+    handler = RecordingHandler()
+    other = RecordingHandler()
+    watch = observer.schedule(handler, root, recursive=True)
+    observer.schedule(other, root, recursive=True)
+    observer.unschedule(watch)
+    assert observer.watch_count(watch) == 0
+    # watches are shared and kept for the other handler
+    assert observer.watch_count() == 3
+    os.mkdir(os.path.join(root, "c"))
+    assert other.next() == created(os.path.join(root, "c"))
+    handler.assert_quiet()
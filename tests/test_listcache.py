@@ -0,0 +1,104 @@
+import os
+import pickle
+import time
+
+import pytest
+
+import fst.dirdiff
+import fst.listcache
+from tests.trees import make_dirs, random_paths, walk_oracle
+
+OLD_NS = 10 ** 18
+
+
+class FakeStat:
+    def __init__(self, ino, mtime_ns=OLD_NS, dev=1):
+        self.st_dev = dev
+        self.st_ino = ino
+        self.st_mtime_ns = mtime_ns
+
+
+@pytest.fixture
+def cached_walks(monkeypatch):
+    cache = fst.listcache.ListingCache()
+    monkeypatch.setattr(fst.dirdiff, "listing_cache", cache)
+    return cache
+
+
+def test_get_and_put():
+    cache = fst.listcache.ListingCache()
+    assert cache.get(FakeStat(1)) is None
+    cache.put(FakeStat(1), ["a", "b"])
+    assert cache.get(FakeStat(1)) == ("a", "b")
+    # a change in the directory changes its mtime and so the key
+    assert cache.get(FakeStat(1, OLD_NS + 1)) is None
+    assert cache.get(FakeStat(1, dev=2)) is None
+    assert (cache.hits, cache.misses, cache.added) == (1, 3, 1)
+
+
+def test_racy_window():
+    cache = fst.listcache.ListingCache()
+    cache.put(FakeStat(1, time.time_ns()), ["a"])
+    assert len(cache) == 0
+    assert cache.added == 0
+    cache.put(FakeStat(2, time.time_ns() - 2 * fst.listcache.RACY_WINDOW_NS),
+              ["a"])
+    assert len(cache) == 1
+
+
+def test_lru_eviction():
+    cache = fst.listcache.ListingCache(max_entries=3)
+    for ino in range(1, 4):
+        cache.put(FakeStat(ino), [str(ino)])
+    cache.get(FakeStat(1))
+    cache.put(FakeStat(4), ["4"])
+    assert len(cache) == 3
+    assert cache.get(FakeStat(2)) is None
+    assert [cache.get(FakeStat(ino)) for ino in (1, 3, 4)] == [
+        ("1",), ("3",), ("4",)
+    ]
+
+
+def test_save_and_load(tmp_path):
+    cache = fst.listcache.ListingCache()
+    for ino in range(1, 6):
+        cache.put(FakeStat(ino), [str(ino)])
+    cache.get(FakeStat(1))
+    path = str(tmp_path / "cache")
+    cache.save(path)
+    assert os.listdir(str(tmp_path)) == ["cache"]
+
+    loaded = fst.listcache.ListingCache.load(path)
+    assert len(loaded) == 5
+    assert loaded.get(FakeStat(3)) == ("3",)
+    # the least recently used entries are dropped first
+    loaded = fst.listcache.ListingCache.load(path, max_entries=2)
+    assert loaded.get(FakeStat(5)) == ("5",)
+    assert loaded.get(FakeStat(1)) == ("1",)
+    assert loaded.get(FakeStat(4)) is None
+
+
+def test_load_bad_file(tmp_path):
+    path = str(tmp_path / "cache")
+    assert len(fst.listcache.ListingCache.load(path)) == 0
+    with open(path, "wb") as f:
+        f.write(b"garbage")
+    assert len(fst.listcache.ListingCache.load(path)) == 0
+    with open(path, "wb") as f:
+        pickle.dump((fst.listcache.FORMAT_VERSION + 1, [((1, 1, 1), ())]), f)
+    assert len(fst.listcache.ListingCache.load(path)) == 0
+
+
+def test_cached_walk(tmp_path, rng, cached_walks, monkeypatch):
+    root = make_dirs(str(tmp_path), random_paths(rng, 20))
+    # listings of the fresh directories are only cached outside the window
+    monkeypatch.setattr(fst.listcache, "RACY_WINDOW_NS", -10 ** 18)
+    paths = walk_oracle(root)
+    assert list(fst.dirdiff.iter_subdirs(root)) == paths
+    assert cached_walks.added == len(paths) + 1
+    assert list(fst.dirdiff.iter_subdirs(root)) == paths
+    assert cached_walks.hits == len(paths) + 1
+
+    # a new directory changes the mtime of its parent
+    os.mkdir(os.path.join(root, "new"))
+    assert list(fst.dirdiff.iter_subdirs(root)) == walk_oracle(root)
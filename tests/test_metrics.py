@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+import fst.au.metrics
+
+
+def samples(rendered):
+    """ Maps the sample lines of rendered metrics to their values."""
+    return dict(
+        line.rsplit(" ", 1) for line in rendered.splitlines()
+        if not line.startswith("#")
+    )
+
+
+def test_render():
+    metrics = fst.au.metrics.Metrics()
+    metrics.inc("fstd_events_total", kind="created", template="music")
+    metrics.inc("fstd_events_total", 2, kind="created", template="music")
+    metrics.inc("fstd_mkdirs_total", template='a "quoted" \\ name')
+    metrics.gauge("fstd_queue_depth", lambda: 7)
+    for value in (0.001, 0.2, 100):
+        metrics.observe("fstd_resync_seconds", value, template="music")
+
+    rendered = metrics.render()
+    assert "# TYPE fstd_resync_seconds histogram" in rendered
+    values = samples(rendered)
+    assert values[
+        'fstd_events_total{kind="created",template="music"}'
+    ] == "3"
+    assert values['fstd_mkdirs_total{template="a \\"quoted\\" \\\\ name"}'] \
+        == "1"
+    assert values["fstd_queue_depth"] == "7"
+    buckets = {
+        key: value for key, value in values.items()
+        if key.startswith("fstd_resync_seconds_bucket")
+    }
+    assert buckets['fstd_resync_seconds_bucket{template="music",le="0.005"}'] \
+        == "1"
+    assert buckets['fstd_resync_seconds_bucket{template="music",le="0.25"}'] \
+        == "2"
+    assert buckets['fstd_resync_seconds_bucket{template="music",le="60"}'] \
+        == "2"
+    assert buckets['fstd_resync_seconds_bucket{template="music",le="+Inf"}'] \
+        == "3"
+    assert values['fstd_resync_seconds_count{template="music"}'] == "3"
+    assert float(values['fstd_resync_seconds_sum{template="music"}']) == \
+        pytest.approx(100.201)
+
+
+def test_write(tmp_path):
+    metrics = fst.au.metrics.Metrics()
+    metrics.inc("fstd_errors_total", template="music")
+    path = str(tmp_path / "fstd.prom")
+    metrics.write(path)
+    with open(path) as f:
+        assert f.read() == metrics.render()
+    assert os.listdir(str(tmp_path)) == ["fstd.prom"]
+
+
+def test_write_failure(tmp_path):
+    metrics = fst.au.metrics.Metrics()
+    path = str(tmp_path / "fstd.prom")
+    metrics.write(path)
+    written = metrics.render()
+
+    def fail():
+        raise ValueError("broken gauge")
+
+    metrics.gauge("fstd_queue_depth", fail)
+    with pytest.raises(ValueError):
+        metrics.write(path)
+    # the previous file is kept and the temporary one removed
+    assert os.listdir(str(tmp_path)) == ["fstd.prom"]
+    with open(path) as f:
+        assert f.read() == written
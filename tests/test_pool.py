@@ -0,0 +1,57 @@
+import threading
+import time
+
+import pytest
+
+import fst.pool
+
+
+def test_ordered_map_keeps_order():
+    # later items finish first
+    results = fst.pool.ordered_map(
+        lambda n: time.sleep((5 - n) * 0.01) or n * n, range(5), jobs=5
+    )
+    assert list(results) == [0, 1, 4, 9, 16]
+
+
+def test_ordered_map_runs_concurrently():
+    barrier = threading.Barrier(3, timeout=5)
+    assert list(fst.pool.ordered_map(
+        lambda n: barrier.wait() is not None, range(3), jobs=3
+    )) == [True] * 3
+
+
+def test_ordered_map_drops_pending_items_when_closed():
+    started = []
+    release = threading.Event()
+
+    def work(n):
+        started.append(n)
+        release.wait(5)
+        return n
+
+    results = fst.pool.ordered_map(work, range(10), jobs=1)
+    release.set()
+    assert next(results) == 0
+    results.close()
+    time.sleep(0.05)
+    assert len(started) < 10
+
+
+def test_timed_returns_errors():
+    def work(n):
+        if n == 1:
+            raise FileNotFoundError(n)
+        return -n
+
+    results = list(fst.pool.ordered_map(fst.pool.timed(work), range(3), 2))
+    assert [r.item for r in results] == [0, 1, 2]
+    assert [r.value for r in results] == [0, None, -2]
+    assert isinstance(results[1].error, FileNotFoundError)
+    assert results[0].error is None and results[0].elapsed >= 0
+
+
+def test_timed_raises_other_errors():
+    work = fst.pool.timed(lambda n: 1 / n)
+    with pytest.raises(ZeroDivisionError):
+        work(0)
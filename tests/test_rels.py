@@ -0,0 +1,75 @@
+import pytest
+
+import fst.db
+import fst.rels
+
+
+@pytest.fixture
+def cursor(tmp_path, rng):
+    """ Random templates and instances, some of either inactive."""
+    conn = fst.db.connect(str(tmp_path / "fst.db"))
+    cursor = conn.cursor()
+    for t in range(1, 9):
+        cursor.execute(
+            "INSERT INTO templates (id, name, path, checksum, active) "
+            "VALUES (?, ?, ?, '', ?)",
+            [t, "t{}".format(t), "/t/{}".format(t), int(t != 3)]
+        )
+    for i in range(1, 60):
+        cursor.execute(
+            "INSERT INTO instances (id, path, template_id, active) "
+            "VALUES (?, ?, ?, ?)",
+            [i, "/i/{}".format(i), rng.choice([1, 2, 3, 4, 6, 7, 8]),
+             int(rng.random() < 0.8)]
+        )
+    yield cursor
+    conn.close()
+
+
+def shape(rels):
+    return [
+        (t.id, t.name, t.path, [(i.id, i.path) for i in t.instances])
+        for t in rels.templates
+    ]
+
+
+def test_pull_all(cursor):
+    rels = fst.rels.pull(cursor)
+    active = {
+        row["id"]: row["template_id"] for row in cursor.execute(
+            "SELECT id, template_id FROM instances WHERE active=1"
+        )
+    }
+    assert [t.id for t in rels.templates] == [1, 2, 4, 5, 6, 7, 8]
+    assert [i.id for i in rels.instances] == sorted(
+        i for i, t in active.items() if t != 3
+    )
+    for template in rels.templates:
+        assert [i.id for i in template.instances] == sorted(
+            i for i, t in active.items() if t == template.id
+        )
+        assert rels.template(template.name) is template
+        assert rels.template(template.path) is template
+    for instance in rels.instances:
+        assert rels.instances_by_path[instance.path] is instance
+        assert rels.instances_by_id[instance.id] is instance
+        assert instance["template_id"] == instance.template_id
+    # the scans pull what the joined rows do
+    assert shape(rels) == shape(fst.rels.Relationships(
+        fst.rels.select(cursor)
+    ))
+
+
+def test_pull_one(cursor):
+    rels = fst.rels.pull(cursor, template="t2")
+    assert [t.name for t in rels.templates] == ["t2"]
+    assert shape(rels) == [
+        t for t in shape(fst.rels.pull(cursor)) if t[0] == 2
+    ]
+    assert shape(fst.rels.pull(cursor, template="/t/2")) == shape(rels)
+    assert fst.rels.pull(cursor, template="t3").templates == []
+
+    instance = rels.instances[0]
+    rels = fst.rels.pull(cursor, instance=instance.path)
+    assert [i.id for i in rels.instances] == [instance.id]
+    assert [i.id for i in rels.templates[0].instances] == [instance.id]
@@ -0,0 +1,34 @@
+"""
+Helpers for building directory trees in tests.
+"""
+import os
+import os.path
+
+
+def make_dirs(root, rel_paths):
+    os.makedirs(root, exist_ok=True)
+    for rel_path in rel_paths:
+        os.makedirs(os.path.join(root, rel_path), exist_ok=True)
+    return root
+
+
+def random_paths(rng, count, names="abcd", max_depth=4):
+    """ Returns relative paths of a random tree built from few names so that
+    trees made with the same names overlap."""
+    paths = []
+    for _ in range(count):
+        depth = rng.randint(1, max_depth)
+        paths.append(os.path.join(*(rng.choice(names) for _ in range(depth))))
+    return paths
+
+
+def walk_oracle(root):
+    """ Returns the relative paths of all subdirectories of root in sorted
+    pre-order as os.walk sees them."""
+    paths = []
+    for dir_path, dir_names, _ in os.walk(root):
+        dir_names.sort()
+        rel_path = os.path.relpath(dir_path, root)
+        if rel_path != ".":
+            paths.append(rel_path)
+    return paths